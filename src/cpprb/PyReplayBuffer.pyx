@@ -1,17 +1,27 @@
 # distutils: language = c++
 # cython: linetrace=True
 
+import asyncio
 import ctypes
+import functools
 from logging import getLogger, StreamHandler, Formatter, INFO
 import multiprocessing as mp
+import os
+import threading
 import time
 from typing import Any, Dict, Callable, Optional
 import warnings
+import weakref
 
 cimport numpy as np
 import numpy as np
 import cython
 from cython.operator cimport dereference
+from libc.stdint cimport int32_t, int64_t
+from libc.string cimport memcpy
+from cpython.pythread cimport (PyThread_type_lock, PyThread_allocate_lock,
+                               PyThread_free_lock, PyThread_acquire_lock,
+                               PyThread_release_lock, WAIT_LOCK)
 
 from cpprb.ReplayBuffer cimport *
 from cpprb.multiprocessing import RawArray, RawValue, _has_SharedMemory, try_start
@@ -471,6 +481,9 @@ cdef class SharedBuffer:
     def __setitem__(self,key,value):
         self.view[key] = value
 
+    def take(self,indices,axis=None,out=None,mode="raise"):
+        return self.view.take(indices,axis=axis,out=out,mode=mode)
+
     def __reduce__(self):
         return (SharedBuffer,(self.view.shape,self.dtype,self.data,None,self.backend))
 
@@ -561,12 +574,193 @@ def find_array(dict,key):
     return None if not key in dict else np.array(dict[key], ndmin=1,
                                                  copy=COPY_ONLY_NECESSARY)
 
+def gather(b,idx,out,key):
+    """Gather 'b[idx]' into 'out[key]' if exists, otherwise into new array.
+
+    Parameters
+    ----------
+    b : numpy.ndarray
+        Source array
+    idx : array_like of int
+        Indexes along the first axis
+    out : dict of numpy.ndarray or None
+        Preallocated output arrays
+    key : str
+        dictionary key of the output array
+
+    Returns
+    -------
+    : numpy.ndarray
+        Gathered array
+    """
+    if (out is None) or (key not in out):
+        return b[idx]
+    # `mode="raise"` buffers output, so that we use "clip" for valid indexes.
+    return np.take(b, idx, axis=0, out=out[key], mode="clip")
+
+def sequence_priorities(errors,mask=None,eta=0.9):
+    r"""Calculate priorities of sequences from step-wise errors
+
+    Like R2D2 [1]_, the priority is a mixture of the max and the mean of
+    absolute errors; :math:`p = \eta \max_t |\delta_t| +
+    (1-\eta) \overline{|\delta_t|}`.
+
+    Parameters
+    ----------
+    errors : array like
+        Step-wise errors with shape ``(N, T)``
+    mask : array like of bool, optional
+        ``True`` for valid steps. Invalid steps are ignored.
+    eta : float, optional
+        Mixture coefficient. The default is ``0.9``.
+
+    Returns
+    -------
+    : numpy.ndarray
+        Priorities of sequences with shape ``(N,)``
+
+    References
+    ----------
+    .. [1] S. Kapturowski et al., "Recurrent Experience Replay in Distributed
+       Reinforcement Learning", ICLR (2019), https://openreview.net/forum?id=r1lyTjAqYX
+    """
+    cdef const float [:,::1] e = np.array(errors,copy=COPY_ONLY_NECESSARY,
+                                          ndmin=2,dtype=np.single,order="C")
+    cdef size_t N = e.shape[0]
+    cdef size_t T = e.shape[1]
+    cdef const bool [:,::1] m
+    cdef const bool* m_ptr = NULL
+    if mask is not None:
+        m = np.array(np.broadcast_to(mask,(N,T)),dtype=np.bool_,order="C")
+        m_ptr = &m[0,0] if N*T > 0 else NULL
+
+    p = np.zeros(N,dtype=np.single)
+    cdef float [::1] _p = p
+    if N*T > 0:
+        SequencePriorities(&e[0,0],m_ptr,N,T,<float>eta,&_p[0])
+    return p
+
+def empty_rows(N,b):
+    r"""Allocate rows keeping memory order of buffer
+
+    Like NumPy fancy indexing, dimensions are laid out in descending order of
+    strides of ``b``, so that rows are copied from ``b`` without transposition.
+
+    Parameters
+    ----------
+    N : int
+        The number of rows
+    b : numpy.ndarray
+        Buffer whose first axis is the index of rows
+
+    Returns
+    -------
+    : numpy.ndarray
+        Uninitialized array with shape ``(N,) + b.shape[1:]``
+    """
+    order = np.argsort([-abs(st) for st in b.strides[1:]], kind="stable")
+    shape = tuple(np.take(b.shape[1:],order).astype(int))
+    return np.empty((N,)+shape,dtype=b.dtype).transpose((0,)+
+                                                        tuple(np.argsort(order)+1))
+
+def copy_rows(v):
+    r"""Copy rows keeping memory order
+
+    Parameters
+    ----------
+    v : numpy.ndarray
+        Rows to be copied
+
+    Returns
+    -------
+    : numpy.ndarray
+        Writable copy of ``v``
+    """
+    c = empty_rows(v.shape[0],v)
+    c[:] = v
+    return c
+
+def select_keys(names,keys,exclude):
+    r"""Select names of values to be gathered
+
+    Parameters
+    ----------
+    names : iterable of str
+        Names of all the values
+    keys : str or array like of str or None
+        Names to be selected. ``None`` means all the names.
+    exclude : str or array like of str or None
+        Names not to be selected
+
+    Returns
+    -------
+    : set of str or None
+        Selected names. ``None`` when all the names are selected.
+
+    Raises
+    ------
+    KeyError
+        When unknown name is specified
+    """
+    if keys is None and exclude is None:
+        return None
+
+    names = set(names)
+    selected = names if keys is None else set(np.ravel(keys).tolist())
+    excluded = set() if exclude is None else set(np.ravel(exclude).tolist())
+
+    unknown = (selected | excluded) - names
+    if unknown:
+        raise KeyError(f"Unknown keys: {sorted(unknown)}")
+
+    return selected - excluded
+
+def split_batches(sample,k):
+    r"""Split flattened batches into stacked ones
+
+    Parameters
+    ----------
+    sample : dict of numpy.ndarray
+        ``k`` batches concatenated along the first axis
+    k : int
+        The number of batches
+
+    Returns
+    -------
+    : dict of numpy.ndarray
+        Arrays with shape ``(k, batch_size, ...)``
+    """
+    return {name: v.reshape((k,-1)+v.shape[1:]) for name, v in sample.items()}
+
+def copy_into(v,out,key):
+    """Copy 'v' into 'out[key]' if exists, otherwise return 'v' itself.
+
+    Parameters
+    ----------
+    v : numpy.ndarray
+        Source array
+    out : dict of numpy.ndarray or None
+        Preallocated output arrays
+    key : str
+        dictionary key of the output array
+
+    Returns
+    -------
+    : numpy.ndarray
+        'out[key]' or 'v'
+    """
+    if (out is None) or (key not in out):
+        return v
+    np.copyto(out[key], v)
+    return out[key]
+
 @cython.embedsignature(True)
 cdef class StepChecker:
     """Check the step size of addition
     """
     cdef check_str
     cdef check_shape
+    cdef size_t check_size
 
     def __init__(self,env_dict,special_keys = None):
         """Initialize StepChecker class.
@@ -582,6 +776,7 @@ cdef class StepChecker:
                 continue
             self.check_str = name
             self.check_shape = defs["add_shape"]
+            self.check_size = np.prod(self.check_shape[1:])
 
     cdef size_t step_size(self,kwargs) except *:
         """Return step size.
@@ -591,8 +786,355 @@ cdef class StepChecker:
         kwargs: dict
             Added values.
         """
-        return np.reshape(np.asarray(kwargs[self.check_str]),
-                          self.check_shape,order='A').shape[0]
+        v = kwargs[self.check_str]
+        if (type(v) is np.ndarray) and (np.PyArray_SIZE(v) % self.check_size == 0):
+            return np.PyArray_SIZE(v) // self.check_size
+        if (self.check_size == 1) and isinstance(v,(float,int)):
+            return 1
+        return np.reshape(np.asarray(v),self.check_shape,order='A').shape[0]
+
+
+cdef enum:
+    _ADD_GENERIC = 0
+    _ADD_DOUBLE = 1
+    _ADD_FLOAT = 2
+    _ADD_INT64 = 3
+    _ADD_INT32 = 4
+    _ADD_BOOL = 5
+
+@cython.embedsignature(True)
+cdef class AddPlan:
+    """Precompiled writer of added values
+
+    Memory layouts of buffers are analyzed at construction. A value is copied
+    by at most two ``memcpy`` (or slice assignments) even when it wraps around
+    the ring buffer. A single scalar is written through a typed pointer.
+    """
+    cdef list names
+    cdef list arrays
+    cdef list add_shapes
+    cdef vector[char*] data
+    cdef vector[size_t] rows
+    cdef vector[size_t] row_bytes
+    cdef vector[size_t] row_size
+    cdef vector[int] type_num
+    cdef vector[int] kind
+    cdef vector[bool] contiguous
+    cdef vector[bool] overlap
+    cdef bool check
+
+    def __init__(self,buffer,*,check=True):
+        """Initialize AddPlan class.
+
+        Parameters
+        ----------
+        buffer : dict of numpy.ndarray
+            Destination arrays, whose first axis is the index of transitions.
+        check : bool, optional
+            Whether values are converted with shape check before writing.
+        """
+        self.names = []
+        self.arrays = []
+        self.add_shapes = []
+        self.check = check
+
+        kinds = {np.dtype(np.double): _ADD_DOUBLE,
+                 np.dtype(np.single): _ADD_FLOAT,
+                 np.dtype(np.int64): _ADD_INT64,
+                 np.dtype(np.int32): _ADD_INT32,
+                 np.dtype(np.bool_): _ADD_BOOL}
+
+        for name, b in buffer.items():
+            row = b[0]
+            extent = sum((n-1)*abs(st) for n, st in zip(row.shape,row.strides))
+
+            self.names.append(name)
+            self.arrays.append(b)
+            self.add_shapes.append((-1,)+row.shape)
+            self.data.push_back(<char*>np.PyArray_DATA(b))
+            self.rows.push_back(b.shape[0])
+            self.row_bytes.push_back(row.nbytes)
+            self.row_size.push_back(row.size)
+            self.type_num.push_back(b.dtype.num)
+            self.kind.push_back(kinds.get(b.dtype,_ADD_GENERIC)
+                                if row.size == 1 else _ADD_GENERIC)
+            contiguous = (b.flags.c_contiguous and b.dtype.isnative and
+                          not b.dtype.hasobject)
+            self.contiguous.push_back(contiguous)
+            self.overlap.push_back(b.strides[0] < extent + b.itemsize)
+
+    cdef void _write(self,size_t k,v,size_t index,size_t N) except *:
+        cdef char* dst = self.data[k] + index * self.row_bytes[k]
+        cdef size_t n1
+        cdef size_t end = index + N
+        cdef t = type(v)
+
+        if self.contiguous[k]:
+            if (N == 1) and (self.kind[k] != _ADD_GENERIC):
+                if self.kind[k] == _ADD_DOUBLE and (t is float or t is int):
+                    (<double*>dst)[0] = v
+                    return
+                if self.kind[k] == _ADD_FLOAT and (t is float or t is int):
+                    (<float*>dst)[0] = v
+                    return
+                if self.kind[k] == _ADD_INT64 and t is int:
+                    (<int64_t*>dst)[0] = v
+                    return
+                if self.kind[k] == _ADD_INT32 and t is int:
+                    (<int32_t*>dst)[0] = v
+                    return
+                if self.kind[k] == _ADD_BOOL and (v is True or v is False):
+                    (<bool*>dst)[0] = v
+                    return
+
+            if ((t is np.ndarray) and
+                (np.PyArray_TYPE(v) == self.type_num[k]) and
+                np.PyArray_ISCARRAY_RO(v) and np.PyArray_ISNOTSWAPPED(v) and
+                (N <= self.rows[k]) and
+                (<size_t>np.PyArray_SIZE(v) == N * self.row_size[k])):
+                n1 = min(end,self.rows[k]) - index
+                memcpy(dst,np.PyArray_DATA(v),n1 * self.row_bytes[k])
+                if n1 < N:
+                    memcpy(self.data[k],
+                           <char*>np.PyArray_DATA(v) + n1 * self.row_bytes[k],
+                           (N - n1) * self.row_bytes[k])
+                return
+
+        if not self.check:
+            pass
+        elif ((t is np.ndarray) and
+              (<size_t>np.PyArray_SIZE(v) == N * self.row_size[k])):
+            v = v.reshape(self.add_shapes[k])
+        else:
+            v = np.reshape(np.array(v,copy=COPY_ONLY_NECESSARY,ndmin=2),
+                           self.add_shapes[k])
+
+        b = self.arrays[k]
+        if self.overlap[k] and N > 1:
+            # Rows share memory (stack_compress). Later row must win.
+            b[np.arange(index,end) % self.rows[k]] = v
+        elif end <= self.rows[k]:
+            b[index:end] = v
+        else:
+            n1 = self.rows[k] - index
+            b[index:] = v[:n1]
+            b[:end-self.rows[k]] = v[n1:]
+
+    cdef void write(self,kwargs,size_t index,size_t N) except *:
+        """Write values into rows from ``index`` to ``index+N`` (with wrap)
+
+        Parameters
+        ----------
+        kwargs : dict
+            Added values.
+        index : size_t
+            The first row.
+        N : size_t
+            The number of rows.
+        """
+        cdef size_t k
+        for k in range(self.data.size()):
+            self._write(k,kwargs[self.names[k]],index,N)
+
+    cdef dict tail(self,kwargs,size_t skip):
+        """Drop the first rows of values
+
+        Parameters
+        ----------
+        kwargs : dict
+            Added values.
+        skip : size_t
+            The number of dropped rows.
+
+        Returns
+        -------
+        dict
+            Values without the first ``skip`` rows. Other values are
+            kept as they are.
+        """
+        cdef size_t k
+        kwargs = dict(kwargs)
+        for k in range(self.data.size()):
+            v = kwargs[self.names[k]]
+            kwargs[self.names[k]] = np.reshape(np.array(v,copy=COPY_ONLY_NECESSARY,
+                                                        ndmin=2),
+                                               self.add_shapes[k])[skip:]
+        return kwargs
+
+    cdef void write_last(self,kwargs,size_t N) except *:
+        """Write the last row of values into the first row
+
+        Parameters
+        ----------
+        kwargs : dict
+            Added values.
+        N : size_t
+            The number of rows of values.
+        """
+        cdef size_t k
+        for k in range(self.data.size()):
+            v = kwargs[self.names[k]]
+            if N != 1:
+                if self.check:
+                    v = np.reshape(np.array(v,copy=COPY_ONLY_NECESSARY,ndmin=2),
+                                   self.add_shapes[k])
+                v = v[-1:]
+            self._write(k,v,0,1)
+
+@cython.embedsignature(True)
+cdef class SlotCache:
+    """Array-backed cache of overlapped values at episode boundaries
+
+    Every slot of the ring buffer has an id of cache row (``-1`` if not
+    cached). Cached values are written into preallocated rows, which are
+    reused after their slots are overwritten. When all the rows are used,
+    capacity is doubled.
+    """
+    cdef size_t size
+    cdef ids_array
+    cdef int64_t* ids
+    cdef dict fields
+    cdef dict rows
+    cdef vector[int64_t] free
+    cdef size_t capacity
+
+    def __init__(self,size,fields,capacity=16):
+        """Initialize SlotCache class.
+
+        Parameters
+        ----------
+        size : int
+            Buffer size
+        fields : dict of numpy.ndarray
+            Buffer of each cached value, whose row layout is used.
+        capacity : int, optional
+            Initial number of cache rows.
+        """
+        self.size = size
+        self.ids_array = np.full(self.size,-1,dtype=np.int64)
+        self.ids = <int64_t*>np.PyArray_DATA(self.ids_array)
+        self.capacity = 0
+        self.fields = fields
+        self.rows = {name: empty_rows(0,b) for name, b in fields.items()}
+        self._grow(max(capacity,1))
+
+    cdef void _grow(self,size_t capacity) except *:
+        cdef int64_t i
+        for name, r in self.rows.items():
+            self.rows[name] = empty_rows(capacity,self.fields[name])
+            self.rows[name][:self.capacity] = r
+        for i in range(capacity-1,self.capacity-1,-1):
+            self.free.push_back(i)
+        self.capacity = capacity
+
+    cdef bool contains(self,size_t key):
+        return self.ids[key] >= 0
+
+    cdef int64_t allocate(self,size_t key) except -1:
+        """Assign a cache row to slot
+
+        Parameters
+        ----------
+        key : size_t
+            Slot index
+
+        Returns
+        -------
+        int64_t
+            Cache row id
+        """
+        if self.free.empty():
+            self._grow(2*self.capacity)
+
+        cdef int64_t i = self.free.back()
+        self.free.pop_back()
+        self.ids[key] = i
+        return i
+
+    cdef void evict(self,size_t first,size_t N):
+        """Release cache rows of slots from ``first`` to ``first+N`` (with wrap)
+
+        Parameters
+        ----------
+        first : size_t
+            The first slot
+        N : size_t
+            The number of slots
+        """
+        cdef size_t n, key
+        for n in range(min(N,self.size)):
+            key = (first + n) % self.size
+            if self.ids[key] >= 0:
+                self.free.push_back(self.ids[key])
+                self.ids[key] = -1
+
+    cdef void patch(self,sample,idx) except *:
+        """Overwrite sampled values with cached values
+
+        Parameters
+        ----------
+        sample : dict of numpy.ndarray
+            Sampled values. Values not in ``sample`` are skipped.
+        idx : numpy.ndarray
+            Sampled slots
+        """
+        ids = self.ids_array[idx]
+        mask = ids >= 0
+        if not mask.any():
+            return
+
+        ids = ids[mask]
+        for name, r in self.rows.items():
+            if name in sample:
+                sample[name][mask] = r[ids]
+
+    cdef void patch_range(self,sample,size_t begin,size_t end) except *:
+        """Overwrite values of contiguous slots with cached values
+
+        Read-only views in ``sample`` are replaced with their copies
+        only when they contain cached slots.
+
+        Parameters
+        ----------
+        sample : dict of numpy.ndarray
+            Values of slots from ``begin`` to ``end``
+        begin : size_t
+            The first slot
+        end : size_t
+            The end slot (exclusive)
+        """
+        ids = self.ids_array[begin:end]
+        mask = ids >= 0
+        if not mask.any():
+            return
+
+        ids = ids[mask]
+        for name, r in self.rows.items():
+            if not sample[name].flags.writeable:
+                sample[name] = copy_rows(sample[name])
+            sample[name][mask] = r[ids]
+
+    cdef void clear(self):
+        self.ids_array[:] = -1
+        self.free.clear()
+        cdef int64_t i
+        for i in range(self.capacity-1,-1,-1):
+            self.free.push_back(i)
+
+    def to_dict(self):
+        """Convert to dictionary
+
+        Returns
+        -------
+        dict of dict of numpy.ndarray
+            Cached values keyed by slot index
+        """
+        return {key: {name: r[i].copy() for name, r in self.rows.items()}
+                for key, i in enumerate(self.ids_array) if i >= 0}
+
+    def __len__(self):
+        return self.capacity - self.free.size()
+
 
 @cython.embedsignature(True)
 cdef class NstepBuffer:
@@ -605,18 +1147,26 @@ cdef class NstepBuffer:
     cdef size_t buffer_size
     cdef default_dtype
     cdef size_t stored_size
+    cdef size_t head
     cdef size_t Nstep_size
     cdef float Nstep_gamma
     cdef Nstep_rew
     cdef Nstep_next
+    cdef set rew_names
+    cdef set next_names
     cdef env_dict
     cdef stack_compress
     cdef StepChecker size_check
+    cdef dict scratch
+    cdef gamma
 
     def __cinit__(self,env_dict=None,Nstep=None,*,
                   stack_compress = None,default_dtype = None,next_of = None):
         self.env_dict = env_dict.copy() if env_dict else {}
         self.stored_size = 0
+        self.head = 0
+        self.scratch = {}
+        self.gamma = None
         self.stack_compress = None # stack_compress is not support yet.
         self.default_dtype = default_dtype or np.single
 
@@ -628,6 +1178,8 @@ cdef class NstepBuffer:
         self.Nstep_gamma = Nstep.get("gamma",0.99)
         self.Nstep_rew = find_array(Nstep,"rew")
         self.Nstep_next = find_array(Nstep,"next")
+        self.rew_names = set() if self.Nstep_rew is None else set(self.Nstep_rew)
+        self.next_names = set() if self.Nstep_next is None else set(self.Nstep_next)
 
         self.buffer_size = self.Nstep_size - 1
         self.buffer = dict2buffer(self.buffer_size,self.env_dict,
@@ -679,113 +1231,62 @@ cdef class NstepBuffer:
             store enough cache items, returns 'None'.
         """
         cdef size_t N = self.size_check.step_size(kwargs)
-        cdef ssize_t end = self.stored_size + N
-
-        cdef ssize_t i
-        cdef ssize_t stored_begin
-        cdef ssize_t stored_end
-        cdef ssize_t ext_begin
-        cdef ssize_t max_slide
+        cdef size_t end = self.stored_size + N
+        ext = {name: self._extract(kwargs,name) for name in self.buffer}
 
         # Case 1
         #   If Nstep buffer don't become full, store all the input transitions.
-        #   These transitions are partially calculated.
         if end <= self.buffer_size:
-            for name, stored_b in self.buffer.items():
-                if self.Nstep_rew is not None and np.isin(name,self.Nstep_rew).any():
-                    # Calculate later.
-                    pass
-                elif (self.Nstep_next is not None
-                      and np.isin(name,self.Nstep_next).any()):
-                    # Do nothing.
-                    pass
-                else:
-                    stored_b[self.stored_size:end] = self._extract(kwargs,name)
-
-            # Nstep reward must be calculated after "done" filling
-            gamma = (1.0 - self.buffer["done"][:end]) * self.Nstep_gamma
-
-            if self.Nstep_rew is not None:
-                max_slide = min(self.Nstep_size - self.stored_size,N)
-                max_slide *= -1
-                for name in self.Nstep_rew:
-                    ext_b = self._extract(kwargs,name).copy()
-                    self.buffer[name][self.stored_size:end] = ext_b
-
-                    for i in range(self.stored_size-1,max_slide,-1):
-                        stored_begin = max(i,0)
-                        stored_end = i+N
-                        ext_begin = max(-i,0)
-                        ext_b[ext_begin:] *= gamma[stored_begin:stored_end]
-                        self.buffer[name][stored_begin:stored_end] +=ext_b[ext_begin:]
-
+            for name, ext_b in ext.items():
+                self._store(self.buffer[name],ext_b,self.stored_size)
             self.stored_size = end
             return None
 
         # Case 2
-        #   If we have enough transitions, return calculated transtions
+        #   The oldest `add_N` transitions of (stored + added) have full windows.
         cdef size_t diff_N = self.buffer_size - self.stored_size
-        cdef size_t add_N = N - diff_N
-        cdef bool NisBigger = (add_N > self.buffer_size)
-        end = self.buffer_size if NisBigger else add_N
+        cdef size_t add_N = end - self.buffer_size
+        cdef size_t old_N = min(self.stored_size,add_N)
+        cdef size_t keep_N = min(N,self.buffer_size)
+        cdef ssize_t i
+        d = self._sequence("done",ext["done"],end)
 
         # Nstep reward must be calculated before "done" filling
-        cdef ssize_t spilled_N
-        gamma = np.ones((self.stored_size + N,1),dtype=np.single)
-        gamma[:self.stored_size] -= self.buffer["done"][:self.stored_size]
-        gamma[self.stored_size:] -= self._extract(kwargs,"done")
-        gamma *= self.Nstep_gamma
         if self.Nstep_rew is not None:
-            max_slide = min(self.Nstep_size - self.stored_size,N)
-            max_slide *= -1
-            for name in self.Nstep_rew:
-                stored_b = self.buffer[name]
-                ext_b = self._extract(kwargs,name)
-
-                copy_ext = ext_b.copy()
-                if diff_N:
-                    stored_b[self.stored_size:] = ext_b[:diff_N]
-                    ext_b = ext_b[diff_N:]
-
-                for i in range(self.stored_size-1,max_slide,-1):
-                    stored_begin = max(i,0)
-                    stored_end = i+N
-                    ext_begin = max(-i,0)
-                    copy_ext[ext_begin:] *= gamma[stored_begin:stored_end]
-                    if stored_end <= self.buffer_size:
-                        stored_b[stored_begin:stored_end] += copy_ext[ext_begin:]
-                    else:
-                        spilled_N = stored_end - self.buffer_size
-                        stored_b[stored_begin:] += copy_ext[ext_begin:-spilled_N]
-                        ext_b[:spilled_N] += copy_ext[-spilled_N:]
-
-                self._roll(stored_b,ext_b,end,NisBigger,kwargs,name,add_N)
+            gamma = self._discount(d)
 
-        for name, stored_b in self.buffer.items():
-            if self.Nstep_rew is not None and np.isin(name,self.Nstep_rew).any():
+            # Backward Horner over the window:
+            #   rew[q] = r[q] + g[q] * (r[q+1] + g[q+1] * (... r[q+Nstep-1]))
+            for name in self.Nstep_rew:
+                r = self._sequence(name,ext[name],end)
+                rew = r[self.buffer_size:].copy()
+                for i in range(self.buffer_size-1,-1,-1):
+                    np.multiply(rew,gamma[i:i+add_N],out=rew)
+                    np.add(rew,r[i:i+add_N],out=rew)
+                kwargs[name] = rew
+
+        for name, ext_b in ext.items():
+            if name in self.rew_names:
                 # Calculated.
                 pass
-            elif (self.Nstep_next is not None
-                  and np.isin(name,self.Nstep_next).any()):
-                kwargs[name] = self._extract(kwargs,name)[diff_N:]
+            elif name in self.next_names:
+                kwargs[name] = ext_b[diff_N:]
             else:
-                ext_b = self._extract(kwargs,name)
-
-                if diff_N:
-                    stored_b[self.stored_size:] = ext_b[:diff_N]
-                    ext_b = ext_b[diff_N:]
-
-                self._roll(stored_b,ext_b,end,NisBigger,kwargs,name,add_N)
+                v = np.empty((add_N,*ext_b.shape[1:]),dtype=ext_b.dtype)
+                self._load(self.buffer[name],v[:old_N],0)
+                v[old_N:] = ext_b[:add_N-old_N]
+                kwargs[name] = v
 
+        # done[q] = sum(done[q:q+Nstep-1])
         done = kwargs["done"]
-
         for i in range(1,self.buffer_size):
-            if i <= add_N:
-                done[:-i] += kwargs["done"][i:]
-                done[-i:] += self.buffer["done"][:i]
-            else:
-                done += self.buffer["done"][i-add_N:i]
+            np.add(done,d[i:i+add_N],out=done)
 
+        # Keep the latest (Nstep - 1) transitions.
+        for name, ext_b in ext.items():
+            self._store(self.buffer[name],ext_b[N-keep_N:],end-keep_N)
+        if self.buffer_size:
+            self.head = (self.head + add_N) % self.buffer_size
         self.stored_size = self.buffer_size
         return kwargs
 
@@ -795,42 +1296,99 @@ cdef class NstepBuffer:
                                    dtype=_dict.get("dtype",self.default_dtype)),
                           _dict["add_shape"])
 
-    cdef void _roll(self,stored_b,ext_b,
-                    ssize_t end,bool NisBigger,kwargs,name,size_t add_N):
-        # Swap numpy.ndarray
-        copy_ext = ext_b.copy() # ext_b might be unwriteable, so that copy it.
-        copy_ext[-end:] = stored_b[:end]
-        stored_b[:end] = ext_b[-end:]
-
-        if NisBigger:
-            # buffer: XXXX, add: YYYYY
-            # buffer: YYYY, add: YXXXX
-            copy_ext = np.roll(copy_ext,end,axis=0)
-            # buffer: YYYY, add: XXXXY
-        else:
-            # buffer: XXXZZZZ, add: YYY
-            # buffer: YYYZZZZ, add: XXX
-            stored_b[:] = np.roll(stored_b,-end,axis=0)[:]
-            # buffer: ZZZZYYY, add: XXX
-        kwargs[name] = copy_ext[:add_N]
+    cdef void _load(self,stored_b,dst,size_t begin):
+        # Copy stored items [begin, begin + len(dst)) (oldest first) into dst
+        cdef size_t n = dst.shape[0]
+        if n == 0:
+            return
+        cdef size_t p = (self.head + begin) % self.buffer_size
+        cdef size_t m = min(n,self.buffer_size - p)
+        dst[:m] = stored_b[p:p+m]
+        dst[m:] = stored_b[:n-m]
+
+    cdef void _store(self,stored_b,src,size_t begin):
+        # Copy src into stored items [begin, begin + len(src)) (oldest first)
+        cdef size_t n = src.shape[0]
+        if n == 0:
+            return
+        cdef size_t p = (self.head + begin) % self.buffer_size
+        cdef size_t m = min(n,self.buffer_size - p)
+        stored_b[p:p+m] = src[:m]
+        stored_b[:n-m] = src[m:]
+
+    cdef _sequence(self,name,ext_b,size_t end):
+        # Stored items followed by added items in a reused contiguous scratch
+        seq = self.scratch.get(name)
+        if (seq is None) or (seq.shape[0] < end):
+            seq = np.empty((max(end,2*(0 if seq is None else seq.shape[0])),
+                            *ext_b.shape[1:]),
+                           dtype=ext_b.dtype)
+            self.scratch[name] = seq
+        seq = seq[:end]
+        self._load(self.buffer[name],seq[:self.stored_size],0)
+        seq[self.stored_size:] = ext_b
+        return seq
+
+    cdef _discount(self,done):
+        # gamma * (1 - done) in a reused scratch
+        cdef size_t end = done.shape[0]
+        if (self.gamma is None) or (self.gamma.shape[0] < end):
+            self.gamma = np.empty((max(end,2*(0 if self.gamma is None
+                                              else self.gamma.shape[0])),
+                                   *done.shape[1:]),
+                                  dtype=np.single)
+        gamma = self.gamma[:end]
+        np.subtract(1.0,done,out=gamma)
+        np.multiply(gamma,self.Nstep_gamma,out=gamma)
+        return gamma
 
     cpdef void clear(self):
         """Clear the bufer.
         """
         self.stored_size = 0
+        self.head = 0
 
     cpdef on_episode_end(self):
         """Terminate episode.
         """
-        kwargs = {k: v[:self.stored_size].copy() for k, v in self.buffer.items()}
-        done = kwargs["done"]
+        cdef size_t n = self.stored_size
+        cdef ssize_t i
+        kwargs = {}
+        for name, stored_b in self.buffer.items():
+            kwargs[name] = np.empty((n,*stored_b.shape[1:]),dtype=stored_b.dtype)
+            self._load(stored_b,kwargs[name],0)
+
+        if n > 0:
+            done = kwargs["done"]
+            if self.Nstep_rew is not None:
+                gamma = self._discount(done)
+                for name in self.Nstep_rew:
+                    rew = kwargs[name]
+                    for i in range(n-2,-1,-1):
+                        rew[i] += gamma[i] * rew[i+1]
 
-        for i in range(1,self.stored_size):
-            done[:-i] += kwargs["done"][i:]
+            if self.Nstep_next is not None:
+                for name in self.Nstep_next:
+                    kwargs[name][:] = kwargs[name][n-1]
+
+            # done[q] = sum(done[q:])
+            done[:] = np.cumsum(done[::-1],axis=0)[::-1]
 
         self.clear()
         return kwargs
 
+    def __reduce__(self):
+        Nstep = {"size": self.Nstep_size, "gamma": self.Nstep_gamma}
+        if self.Nstep_rew is not None:
+            Nstep["rew"] = self.Nstep_rew
+        if self.Nstep_next is not None:
+            Nstep["next"] = self.Nstep_next
+        return (NstepBuffer, (self.env_dict, Nstep),
+                (self.buffer, self.stored_size, self.head, self.default_dtype))
+
+    def __setstate__(self,state):
+        self.buffer, self.stored_size, self.head, self.default_dtype = state
+
     cpdef size_t get_Nstep_size(self):
         """Get Nstep size
 
@@ -845,18 +1403,17 @@ cdef class NstepBuffer:
 cdef class RingBufferIndex:
     """Ring Buffer Index class
     """
-    cdef index
-    cdef buffer_size
-    cdef is_full
+    cdef size_t index
+    cdef size_t buffer_size
+    cdef bool is_full
 
     def __init__(self, buffer_size, ctx = None, backend = "sharedctypes"):
-        ctx = ctx or mp.get_context()
-        self.index = RawValue(ctx, ctypes.c_size_t, 0, backend)
-        self.buffer_size = RawValue(ctx, ctypes.c_size_t, buffer_size, backend)
-        self.is_full = RawValue(ctx, ctypes.c_int, 0, backend)
+        self.index = 0
+        self.buffer_size = buffer_size
+        self.is_full = False
 
     cdef size_t get_next_index(self):
-        return self.index.value
+        return self.index
 
     cdef size_t fetch_add(self,size_t N):
         """
@@ -872,53 +1429,277 @@ cdef class RingBufferIndex:
         size_t
             index before add
         """
-        cdef size_t ret = self.index.value
-        self.index.value += N
+        cdef size_t ret = self.index
+        self.index += N
 
-        if self.index.value >= self.buffer_size.value:
-            self.is_full.value = 1
+        if self.index >= self.buffer_size:
+            self.is_full = True
 
-        while self.index.value >= self.buffer_size.value:
-            self.index.value -= self.buffer_size.value
+        while self.index >= self.buffer_size:
+            self.index -= self.buffer_size
 
         return ret
 
     cdef void clear(self):
-        self.index.value = 0
-        self.is_full.value = 0
+        self.index = 0
+        self.is_full = False
 
     cdef size_t get_stored_size(self):
-        if self.is_full.value:
-            return self.buffer_size.value
+        if self.is_full:
+            return self.buffer_size
         else:
-            return self.index.value
+            return self.index
 
 
 cdef class ProcessSafeRingBufferIndex(RingBufferIndex):
     """Process Safe Ring Buffer Index class
+
+    Next index and full flag are packed into a single word on shared memory,
+    and are updated by atomic operations without lock.
+
+    Additionally, every slot has a sequence number on shared memory, so that
+    writers can publish reserved slots without lock and readers can detect
+    slots under writing.
     """
-    cdef lock
+    cdef size_t size
+    cdef backend
+    cdef word
+    cdef seq
+    cdef CppThreadSafeRingBufferIndex* ptr
+    cdef CppThreadSafeSlotSequence* seq_ptr
 
-    def __init__(self, buffer_size, ctx=None, backend="sharedctypes"):
+    def __init__(self, buffer_size, ctx=None, backend="sharedctypes",
+                 word=None, seq=None):
         ctx = ctx or mp.get_context()
-        super().__init__(buffer_size, ctx, backend)
-        self.lock = ctx.Lock()
+        self.size = buffer_size
+        self.backend = backend
+        self.word = word or RawArray(ctx, ctypes.c_size_t, 1, self.backend)
+        self.seq = seq or RawArray(ctx, ctypes.c_uint64, self.size, self.backend)
+
+        cdef size_t [:] view_word = self.word.ndarray
+        self.ptr = new CppThreadSafeRingBufferIndex(self.size,
+                                                    &view_word[0],
+                                                    word is None)
+
+        cdef uint64_t [:] view_seq = self.seq.ndarray
+        self.seq_ptr = new CppThreadSafeSlotSequence(self.size,
+                                                     &view_seq[0],
+                                                     seq is None)
+
+    def __dealloc__(self):
+        del self.ptr
+        del self.seq_ptr
+
+    cdef size_t reserve(self,size_t N):
+        """
+        Reserve slots for writing
+
+        Parameters
+        ----------
+        N : size_t
+            The number of slots
+
+        Returns
+        -------
+        size_t
+            The first index of reserved slots
+        """
+        cdef size_t index = self.ptr.fetch_add(N)
+        self.seq_ptr.reserve(index, N)
+        return index
+
+    cdef void commit(self,size_t index,size_t N):
+        """
+        Publish reserved slots
+
+        Parameters
+        ----------
+        index : size_t
+            The first index of reserved slots
+        N : size_t
+            The number of slots
+        """
+        self.seq_ptr.commit(index, N)
+
+    cdef load_sequence(self,const size_t [:] idx):
+        cdef uint64_t [:] before = np.empty(idx.shape[0], dtype=np.uint64)
+        if idx.shape[0] > 0:
+            self.seq_ptr.load(&idx[0], idx.shape[0], &before[0])
+        return before
+
+    cdef validate_sequence(self,const size_t [:] idx,const uint64_t [:] before):
+        cdef ok = np.empty(idx.shape[0], dtype=np.bool_)
+        cdef bool [:] view_ok = ok
+        if idx.shape[0] > 0:
+            self.seq_ptr.validate(&idx[0], idx.shape[0], &before[0], &view_ok[0])
+        return ok
 
     cdef size_t get_next_index(self):
-        with self.lock:
-            return RingBufferIndex.get_next_index(self)
+        return self.ptr.get_next_index()
 
     cdef size_t fetch_add(self,size_t N):
-        with self.lock:
-            return RingBufferIndex.fetch_add(self,N)
+        return self.ptr.fetch_add(N)
 
     cdef void clear(self):
-        with self.lock:
-            RingBufferIndex.clear(self)
+        self.ptr.clear()
 
     cdef size_t get_stored_size(self):
-        with self.lock:
-            return RingBufferIndex.get_stored_size(self)
+        return self.ptr.get_stored_size()
+
+    def __reduce__(self):
+        return (ProcessSafeRingBufferIndex,
+                (self.size, None, self.backend, self.word, self.seq))
+
+
+cdef class ProcessSafeGroupLock:
+    """Process Safe Group Lock class
+
+    Processes in the same group can hold the lock simultaneously, however,
+    processes in different groups cannot. When the other groups are
+    waiting, a newcomer waits, too, and the waiting groups are admitted in
+    round robin order (phase fair), so that no group starves.
+    """
+    cdef size_t n
+    cdef backend
+    cdef cond
+    cdef state
+    cdef size_t* active
+    cdef size_t* waiting
+    cdef size_t* admit
+
+    def __init__(self, n_groups, ctx=None, backend="sharedctypes",
+                 cond=None, state=None):
+        ctx = ctx or mp.get_context()
+        self.n = n_groups
+        self.backend = backend
+        self.cond = cond or ctx.Condition()
+        if state is None:
+            state = RawArray(ctx, ctypes.c_size_t, 3*self.n, self.backend)
+            state[:] = 0
+        self.state = state
+
+        cdef size_t [:] view = self.state.ndarray
+        self.active  = &view[0]
+        self.waiting = &view[self.n]
+        self.admit   = &view[2*self.n]
+
+    cdef bool _is_free(self,size_t group):
+        cdef size_t g
+        for g in range(self.n):
+            if (g != group) and (self.active[g] or
+                                 self.waiting[g] or
+                                 self.admit[g]):
+                return False
+        return True
+
+    cdef bool _enter(self,size_t group):
+        # Acquire if free, otherwise queue. (`cond` must be held.)
+        if self._is_free(group):
+            self.active[group] += 1
+            return True
+        self.waiting[group] += 1
+        return False
+
+    cdef bool _take(self,size_t group):
+        # Acquire if queued process is admitted. (`cond` must be held.)
+        if self.admit[group] == 0:
+            return False
+        self.admit[group] -= 1
+        self.waiting[group] -= 1
+        self.active[group] += 1
+        return True
+
+    cdef void _release(self,size_t group) except *:
+        # (`cond` must be held.)
+        cdef size_t i, g
+        self.active[group] -= 1
+        if self.active[group] or self.admit[group]:
+            return
+
+        for i in range(1, self.n):
+            g = (group + i) % self.n
+            if self.waiting[g]:
+                self.admit[g] = self.waiting[g]
+                self.cond.notify_all()
+                return
+
+    cdef void acquire(self,size_t group) except *:
+        with self.cond:
+            if not self._enter(group):
+                while not self._take(group):
+                    self.cond.wait()
+
+    cdef void release(self,size_t group) except *:
+        with self.cond:
+            self._release(group)
+
+    cdef bool try_enter(self,size_t group) except *:
+        """Acquire without wait, or queue for ``poll``
+
+        Returns
+        -------
+        bool
+            ``True`` if acquired. Otherwise, ``poll`` or ``cancel`` must follow.
+        """
+        with self.cond:
+            return self._enter(group)
+
+    cdef bool poll(self,size_t group) except *:
+        """Acquire without wait if admitted after ``try_enter``
+
+        Returns
+        -------
+        bool
+            ``True`` if acquired.
+        """
+        with self.cond:
+            return self._take(group)
+
+    cdef void cancel(self,size_t group) except *:
+        """Leave the queue after ``try_enter``
+        """
+        with self.cond:
+            if self._take(group):
+                # Admission cannot be returned, so that it is passed to others.
+                self._release(group)
+            else:
+                self.waiting[group] -= 1
+
+    async def acquire_async(self,group,delay=1e-4,max_delay=1e-3):
+        """Acquire without blocking event loop
+
+        Admission is polled with exponential backoff, while keeping the
+        order in the queue.
+
+        Parameters
+        ----------
+        group : int
+            Group
+        delay : float, optional
+            The first polling interval in second
+        max_delay : float, optional
+            The max polling interval in second
+
+        Notes
+        -----
+        Since the lock is shared with other processes, admission is not
+        notified to the event loop but polled. Under contention, the lock is
+        acquired up to ``max_delay`` (default 1 ms) after it is admitted.
+        """
+        if self.try_enter(group):
+            return
+
+        try:
+            while not self.poll(group):
+                await asyncio.sleep(delay)
+                delay = min(2*delay, max_delay)
+        except BaseException:
+            self.cancel(group)
+            raise
+
+    def __reduce__(self):
+        return (ProcessSafeGroupLock,
+                (self.n, None, self.backend, self.cond, self.state))
 
 
 @cython.embedsignature(True)
@@ -951,16 +1732,26 @@ cdef class ReplayBuffer:
     cdef next_
     cdef bool compress_any
     cdef stack_compress
-    cdef cache
+    cdef SlotCache cache
     cdef default_dtype
     cdef StepChecker size_check
     cdef NstepBuffer nstep
     cdef bool use_nstep
     cdef size_t cache_size
+    cdef CppGather* gather_engine
+    cdef size_t gather_threads
+    cdef gather_keys
+    cdef AddPlan add_plan
+    cdef AddPlan next_plan
+    cdef size_t reserved
+    cdef episode_ids
+    cdef int64_t* episode_ids_ptr
+    cdef int64_t episode_id
+    cdef CppThreadSafeSlotSequence* seq
 
     def __cinit__(self,size,env_dict=None,*,
                   next_of=None,stack_compress=None,default_dtype=None,Nstep=None,
-                  mmap_prefix =None,
+                  mmap_prefix =None,gather_threads=0,unchecked_add=False,
                   **kwargs):
         self.env_dict = env_dict.copy() if env_dict else {}
         cdef special_keys = []
@@ -969,6 +1760,15 @@ cdef class ReplayBuffer:
         self.index = RingBufferIndex(self.buffer_size)
         self.episode_len = 0
 
+        # Per-slot sequence numbers, which are used only by thread-safe
+        # subclasses to copy slots without lock.
+        self.seq = NULL
+
+        # Episode of each slot (-1: not stored)
+        self.episode_ids = np.full(self.buffer_size,-1,dtype=np.int64)
+        self.episode_ids_ptr = <int64_t*>np.PyArray_DATA(self.episode_ids)
+        self.episode_id = 0
+
         self.compress_any = stack_compress
         self.stack_compress = np.array(stack_compress, ndmin=1, copy=COPY_ONLY_NECESSARY)
 
@@ -978,7 +1778,7 @@ cdef class ReplayBuffer:
         self.next_of = np.array(next_of, ndmin=1,
                                 copy=COPY_ONLY_NECESSARY) if self.has_next_of else None
         self.next_ = {}
-        self.cache = {} if (self.has_next_of or self.compress_any) else None
+        cdef bool use_cache = (self.has_next_of or self.compress_any)
 
         self.use_nstep = Nstep
         if self.use_nstep:
@@ -1003,7 +1803,7 @@ cdef class ReplayBuffer:
         #     No "next_of" nor "stack_compress": -> 0
         #     If "stack_compress": -> max of stack size -1
         #     If "next_of": -> Increase by 1
-        self.cache_size = 1 if (self.cache is not None) else 0
+        self.cache_size = 1 if use_cache else 0
         if self.compress_any:
             for name in self.stack_compress:
                 self.cache_size = max(self.cache_size,
@@ -1015,9 +1815,42 @@ cdef class ReplayBuffer:
             for name in self.next_of:
                 self.next_[name] = self.buffer[name][0].copy()
 
+        self.cache = None
+        if use_cache:
+            cache_fields = {}
+            if self.has_next_of:
+                for name in self.next_of:
+                    cache_fields[f"next_{name}"] = self.buffer[name]
+            if self.compress_any:
+                for name in self.stack_compress:
+                    cache_fields[name] = self.buffer[name]
+            self.cache = SlotCache(self.buffer_size,cache_fields,
+                                   2*self.cache_size)
+
+        self.add_plan = AddPlan(self.buffer,check=not unchecked_add)
+        if self.has_next_of:
+            self.next_plan = AddPlan({f"next_{name}": self.next_[name][np.newaxis]
+                                      for name in self.next_of},
+                                     check=not unchecked_add)
+
+        self.gather_threads = gather_threads or 0
+        self.gather_engine = NULL
+        if self.gather_threads > 0:
+            self.gather_engine = new CppGather()
+            self.gather_keys = []
+            for name in self.buffer:
+                self._add_gather_field(name,name,0)
+            if self.has_next_of:
+                for name in self.next_of:
+                    self._add_gather_field(f"next_{name}",name,1)
+
+    def __dealloc__(self):
+        del self.gather_engine
+        del self.seq
+
     def __init__(self,size,env_dict=None,*,
                  next_of=None,stack_compress=None,default_dtype=None,Nstep=None,
-                 mmap_prefix =None,
+                 mmap_prefix =None,gather_threads=0,unchecked_add=False,
                  **kwargs):
         r"""Initialize ``ReplayBuffer``
 
@@ -1051,6 +1884,17 @@ cdef class ReplayBuffer:
             File name prefix to map buffer data using mmap. If ``None`` (default),
             stores only on memory. This feature is designed for very large data
             which cannot be located on physical memory.
+        gather_threads : int, optional
+            If positive, sampled transitions are gathered by C++ kernel without
+            GIL, where the batch is split into this number of threads. Small
+            batch is gathered at a single thread. If ``0`` (default), NumPy
+            indexing is used. Like NumPy, returned arrays keep memory order of
+            the buffer (e.g. ``stack_compress``), and ``out`` with another
+            layout is filled by NumPy.
+        unchecked_add : bool, optional
+            If ``True``, ``add`` skips shape conversion of values. Every value
+            must already be a single transition or a batch of transitions with
+            the defined shape. The default is ``False``.
 
 
         Examples
@@ -1147,45 +1991,172 @@ cdef class ReplayBuffer:
             if kwargs is None:
                 return
 
-        cdef size_t N = self.size_check.step_size(kwargs)
+        if self.reserved:
+            raise ValueError("Reserved slots must be committed before add")
 
-        cdef size_t index = self.index.fetch_add(N)
+        cdef size_t N = self.size_check.step_size(kwargs)
+        cdef size_t skip
+        if N > self.buffer_size:
+            # Only the last transitions survive, as if they were added one by one.
+            skip = N - self.buffer_size
+            kwargs = self.add_plan.tail(kwargs,skip)
+            if self.has_next_of:
+                kwargs = self.next_plan.tail(kwargs,skip)
+            self.index.fetch_add(skip)
+            self.episode_len += skip
+            N = self.buffer_size
+
+        cdef size_t index = self._evict(N)
+
+        self.add_plan.write(kwargs,index,N)
+
+        return self._advance(N,kwargs,N)
+
+    cdef size_t _evict(self,size_t N) except *:
+        # Cached values of the next N slots are dropped, and overlapped data
+        # for stack_compress are evacuated before they are overwritten.
+        cdef size_t index = self.index.get_next_index()
         cdef size_t end = index + N
         cdef size_t remain = 0
-        cdef add_idx = np.arange(index,end)
         cdef size_t key_min = 0
+        cdef size_t _i
 
         if end > self.buffer_size:
             remain = end - self.buffer_size
-            add_idx[add_idx >= self.buffer_size] -= self.buffer_size
 
         if self.cache is not None:
-            for _i in add_idx:
-                self.cache.pop(_i, None)
+            self.cache.evict(index,N)
 
         if self.compress_any and (remain or
                                   self.get_stored_size() == self.buffer_size):
             key_min = remain or end
             for key in range(key_min,
                              min(key_min + self.cache_size, self.buffer_size)):
-                self.add_cache_i(key, index)
+                # Slots to be overwritten by this call must not be cached.
+                if (key + self.buffer_size - index) % self.buffer_size >= N:
+                    self.add_cache_i(key, index)
 
-        for name, b in self.buffer.items():
-            b[add_idx] = np.reshape(np.array(kwargs[name],
-                                             copy=COPY_ONLY_NECESSARY, ndmin=2),
-                                    self.env_dict[name]["add_shape"])
+        if self.seq is not NULL:
+            self.seq.reserve(index,N)
 
+        return index
+
+    cdef size_t _advance(self,size_t N,kwargs,size_t n_next) except *:
         if self.has_next_of:
-            for name in self.next_of:
-                self.next_[name][...]=np.reshape(np.array(kwargs[f"next_{name}"],
-                                                          copy=COPY_ONLY_NECESSARY,
-                                                          ndmin=2),
-                                                 self.env_dict[name]["add_shape"])[-1]
+            self.next_plan.write_last(kwargs,n_next)
+
+        cdef size_t index = self.index.get_next_index()
+        cdef size_t n
+        for n in range(N):
+            self.episode_ids_ptr[(index + n) % self.buffer_size] = self.episode_id
 
         self.episode_len += N
+        index = self.index.fetch_add(N)
+
+        if self.seq is not NULL:
+            self.seq.commit(index,N)
+
         return index
 
-    def get_all_transitions(self,shuffle: bool=False):
+    def reserve(self,n):
+        r"""Reserve the next slots to be written in place
+
+        Environment can render values directly into the returned views,
+        which removes a copy at ``add``. Written values are stored by
+        ``commit``.
+
+        Parameters
+        ----------
+        n : int
+            The number of transitions
+
+        Returns
+        -------
+        list of dict of numpy.ndarray
+            Writable views of the reserved slots. When the slots wrap around
+            the ring buffer, they are split into two segments.
+
+        Raises
+        ------
+        ValueError
+            If slots have already been reserved, ``n`` is larger than buffer
+            size, or Nstep is used.
+
+        Examples
+        --------
+        >>> rb = ReplayBuffer(32, {"obs": {"shape": 3}}, next_of="obs")
+        >>> for seg in rb.reserve(2):
+        ...     seg["obs"][:] = 1
+        >>> rb.commit(next_obs=[1,1,1])
+        0
+        """
+        if self.reserved:
+            raise ValueError("Slots have already been reserved")
+        if self.use_nstep:
+            raise ValueError("reserve() does not support Nstep")
+        if n > self.buffer_size:
+            raise ValueError(f"n ({n}) is larger than buffer size")
+
+        cdef size_t index = self._evict(n)
+        cdef size_t end = index + n
+        self.reserved = n
+
+        segments = [(index, min(end, self.buffer_size))]
+        if end > self.buffer_size:
+            segments.append((0, end - self.buffer_size))
+
+        return [{name: b[first:last] for name, b in self.buffer.items()}
+                for first, last in segments]
+
+    def commit(self,**kwargs):
+        r"""Store transitions written into reserved slots
+
+        Parameters
+        ----------
+        **kwargs : array like or float or int
+            ``next_***`` values of the last reserved transition for ``next_of``.
+
+        Returns
+        -------
+        int
+            The first index of stored position.
+
+        Raises
+        ------
+        ValueError
+            If no slots have been reserved.
+        KeyError
+            If ``next_***`` for ``next_of`` is missing.
+        """
+        if not self.reserved:
+            raise ValueError("No slots have been reserved")
+
+        cdef size_t index = self._advance(self.reserved,kwargs,1)
+        self.reserved = 0
+        return index
+
+    cdef _reserved_mask(self,idx):
+        # Reserved slots start at the next index, which is kept until commit.
+        cdef size_t index = self.index.get_next_index()
+        return ((np.asarray(idx,dtype=np.int64) + (self.buffer_size - index))
+                % self.buffer_size) < self.reserved
+
+    cdef _unreserved_index(self,size_t batch_size):
+        # Stored slots overlapped by reserved ones are the oldest ones, so that
+        # the others are consecutive from the end of the reserved ones.
+        if self.reserved == self.buffer_size:
+            raise ValueError("All the stored transitions are reserved")
+
+        cdef size_t stored_size = self.get_stored_size()
+        cdef size_t skip = (max(stored_size + self.reserved, self.buffer_size)
+                            - self.buffer_size)
+        cdef size_t first = ((self.index.get_next_index() + skip
+                              + (self.buffer_size - stored_size))
+                             % self.buffer_size)
+        return ((first + np.random.randint(0,stored_size - skip,batch_size))
+                % self.buffer_size)
+
+    def get_all_transitions(self,shuffle: bool=False,*,keys=None,exclude=None):
         r"""
         Get all transitions stored in replay buffer.
 
@@ -1193,6 +2164,11 @@ cdef class ReplayBuffer:
         ----------
         shuffle : bool, optional
             When ``True``, transitions are shuffled. The default value is ``False``.
+        keys : str or array like of str, optional
+            Names of returned values. If ``None`` (default), all values are
+            returned. Values which are not returned are never gathered.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
 
         Returns
         -------
@@ -1204,7 +2180,132 @@ cdef class ReplayBuffer:
         if shuffle:
             np.random.shuffle(idx)
 
-        return self._encode_sample(idx)
+        return self._encode_sample(idx,keys=keys,exclude=exclude)
+
+    def iter_transitions(self,batch_size,*,shuffle: bool=False,
+                         drop_last: bool=False):
+        r"""Iterate over all stored transitions without replacement
+
+        Unlike ``get_all_transitions``, only a mini-batch is materialized at
+        once. In chronological order (``shuffle=False``), mini-batches which
+        don't wrap around the ring buffer are read-only views of the buffer
+        except values restored for ``next_of`` and ``stack_compress``.
+
+        Parameters
+        ----------
+        batch_size : int
+            Mini-batch size
+        shuffle : bool, optional
+            When ``True``, transitions are shuffled. The default value is ``False``.
+        drop_last : bool, optional
+            When ``True``, the last mini-batch smaller than ``batch_size`` is
+            dropped. The default value is ``False``.
+
+        Yields
+        ------
+        transitions : dict of numpy.ndarray
+            Mini-batch of transitions
+
+        Notes
+        -----
+        Views are overwritten by later ``add``. Don't add transitions
+        during iteration, or copy mini-batches before that.
+
+        Examples
+        --------
+        >>> rb = ReplayBuffer(32, {"obs": {}})
+        >>> rb.add(obs=np.arange(10))
+        >>> [b["obs"].ravel().tolist() for b in rb.iter_transitions(4)]
+        [[0.0, 1.0, 2.0, 3.0], [4.0, 5.0, 6.0, 7.0], [8.0, 9.0]]
+        """
+        cdef size_t N = self.get_stored_size()
+        cdef size_t B = batch_size
+        cdef size_t first = self.get_next_index() if N == self.buffer_size else 0
+        cdef size_t i, begin, end
+
+        if B == 0:
+            raise ValueError("batch_size must be positive")
+
+        if shuffle:
+            idx = np.random.permutation(N)
+            for i in range(0,N,B):
+                if drop_last and i + B > N:
+                    return
+                yield self._encode_sample(idx[i:i+B])
+            return
+
+        for i in range(0,N,B):
+            if drop_last and i + B > N:
+                return
+            begin = (first + i) % self.buffer_size
+            end = begin + min(B,N-i)
+            if end <= self.buffer_size:
+                yield self._encode_range(begin,end)
+            else:
+                yield self._encode_sample(np.arange(begin,end) % self.buffer_size)
+
+    def unroll(self):
+        r"""Get all stored transitions in chronological order as views
+
+        Returns
+        -------
+        segments : list of dict of numpy.ndarray
+            Transitions in the ring buffer from the oldest to the end of the
+            buffer and from the beginning of the buffer to the latest. When
+            the buffer has never wrapped around, only one segment is returned.
+            Values are read-only views of the buffer except values restored
+            for ``next_of`` and ``stack_compress``.
+
+        See Also
+        --------
+        iter_transitions
+
+        Examples
+        --------
+        >>> rb = ReplayBuffer(4, {"obs": {}})
+        >>> rb.add(obs=np.arange(6))
+        >>> [s["obs"].ravel().tolist() for s in rb.unroll()]
+        [[2.0, 3.0], [4.0, 5.0]]
+        """
+        cdef size_t N = self.get_stored_size()
+        cdef size_t next_index = self.get_next_index()
+
+        if N < self.buffer_size or next_index == 0:
+            return [self._encode_range(0,N)]
+
+        return [self._encode_range(next_index,self.buffer_size),
+                self._encode_range(0,next_index)]
+
+    def _encode_range(self,size_t begin,size_t end):
+        cdef sample = {}
+        cdef size_t last
+
+        for name, b in self.buffer.items():
+            sample[name] = b[begin:end]
+            sample[name].flags.writeable = False
+
+        if self.has_next_of:
+            # Transition just before `next_index` refers `self.next_`.
+            last = (self.get_next_index() + self.buffer_size - 1) % self.buffer_size
+            for name in self.next_of:
+                b = self.buffer[name]
+                if end < self.buffer_size:
+                    v = b[begin+1:end+1]
+                    v.flags.writeable = False
+                else:
+                    v = copy_rows(b[begin:end])
+                    v[:-1] = b[begin+1:end]
+                    v[-1] = b[0]
+                if begin <= last < end:
+                    if not v.flags.writeable:
+                        v = copy_rows(v)
+                    v[last-begin] = self.next_[name]
+                sample[f"next_{name}"] = v
+
+        if self.cache is not None:
+            self.cache.patch_range(sample,begin,end)
+
+        return sample
 
     def save_transitions(self, file, *, safe=True):
         r"""
@@ -1238,7 +2339,7 @@ cdef class ReplayBuffer:
                     "version": FORMAT_VERSION,
                     "data": b,
                     "Nstep": self.is_Nstep(),
-                    "cache": self.cache,
+                    "cache": self.cache.to_dict(),
                     "next_of": self.next_of}
         np.savez_compressed(file, **data)
 
@@ -1326,57 +2427,183 @@ cdef class ReplayBuffer:
             else:
                 raise ValueError(f"Unknown Format Version: {version}")
 
-    def _encode_sample(self,idx):
+    cdef void _add_gather_field(self,key,name,size_t shift) except *:
+        # Output keeps memory order of the buffer like NumPy fancy indexing,
+        # so that rows of stack_compress are copied without transposition.
+        b = self.buffer[name]
+        row = empty_rows(1,b)[0]
+
+        cdef const size_t [::1] _shape = np.array(b.shape[1:]+(1,),
+                                                  dtype=np.uint64)
+        cdef const ptrdiff_t [::1] src = np.array(b.strides[1:]+(0,),
+                                                  dtype=np.intp)
+        cdef const ptrdiff_t [::1] dst = np.array(row.strides+(0,),
+                                                  dtype=np.intp)
+
+        self.gather_engine.add_field(np.PyArray_DATA(<np.ndarray>b),
+                                     b.shape[0],b.strides[0],b.itemsize,
+                                     b.ndim-1,&_shape[0],&src[0],&dst[0],shift)
+        self.gather_keys.append((key,name,shift,row))
+
+    cdef _gather(self,idx,out,names):
+        cdef const size_t [::1] _idx = Csize(idx)
+        cdef size_t N = _idx.shape[0]
+        cdef vector[void*] dst
         cdef sample = {}
-        cdef next_idx
-        cdef cache_idx
-        cdef bool use_cache
+        cdef o
+
+        if N > 0 and np.max(_idx) >= self.buffer_size:
+            raise IndexError("index is out of buffer")
+
+        for key, name, shift, row in self.gather_keys:
+            if (names is not None) and (key not in names):
+                dst.push_back(NULL)
+                continue
+            o = out.get(key) if out is not None else None
+            if o is None:
+                o = empty_rows(N,self.buffer[name])
+            elif not ((o.shape == (N,)+row.shape) and (o.dtype == row.dtype) and
+                      o.flags.writeable and
+                      ((N <= 1) or (o.strides[0] == row.nbytes)) and
+                      all((st == rs) or (n == 1) for st, rs, n
+                          in zip(o.strides[1:],row.strides,row.shape))):
+                # Layout differs from the engine. Fall back to NumPy.
+                sample[key] = gather(self.buffer[name],
+                                     (idx + shift) % self.buffer_size,out,key)
+                dst.push_back(NULL)
+                continue
+            dst.push_back(np.PyArray_DATA(<np.ndarray>o))
+            sample[key] = o
+
+        if N > 0:
+            with nogil:
+                self.gather_engine.gather(&_idx[0],N,dst.data(),self.gather_threads)
+
+        return sample
+
+    def _encode_sample(self,idx,out=None,keys=None,exclude=None):
+        cdef names, next_of
+        names, next_of = self._sample_names(keys,exclude)
 
         idx = np.array(idx,copy=COPY_ONLY_NECESSARY, ndmin=1)
+        cdef sample = self._gather_rows(idx,out,names,next_of)
+        self._restore_rows(sample,idx,next_of)
+        return sample
+
+    cdef _sample_names(self,keys,exclude):
+        # Selected names (``None`` for all) and selected names of next_of
+        cdef names = None
+        cdef next_of = self.next_of if self.has_next_of else []
+
+        if keys is not None or exclude is not None:
+            names = select_keys(list(self.buffer) + [f"next_{n}" for n in next_of],
+                                keys,exclude)
+            next_of = [n for n in next_of if f"next_{n}" in names]
+
+        return names, next_of
+
+    def _gather_rows(self,idx,out,names,next_of):
+        # Copy rows in the buffer as they are. Values kept outside of the
+        # buffer are restored by `_restore_rows`.
+        cdef sample = {}
+        cdef next_idx
+
+        if self.gather_engine is not NULL:
+            return self._gather(idx,out,names)
+
         for name, b in self.buffer.items():
-            sample[name] = b[idx]
+            if (names is None) or (name in names):
+                sample[name] = gather(b,idx,out,name)
 
-        if self.has_next_of:
+        if len(next_of) > 0:
+            next_idx = idx + 1
+            next_idx[next_idx == self.get_buffer_size()] = 0
+            for name in next_of:
+                sample[f"next_{name}"] = gather(self.buffer[name],next_idx,
+                                                out,f"next_{name}")
+
+        return sample
+
+    cdef void _restore_rows(self,sample,idx,next_of) except *:
+        cdef next_idx
+        cdef cache_idx
+
+        if len(next_of) > 0:
             next_idx = idx + 1
             next_idx[next_idx == self.get_buffer_size()] = 0
             cache_idx = (next_idx == self.get_next_index())
-            use_cache = cache_idx.any()
 
-            for name in self.next_of:
-                sample[f"next_{name}"] = self.buffer[name][next_idx]
-                if use_cache:
-                    # Cache for the latest "next_***" stored at `self.next_`
+            if cache_idx.any():
+                # Cache for the latest "next_***" stored at `self.next_`
+                for name in next_of:
                     sample[f"next_{name}"][cache_idx] = self.next_[name]
 
-        cdef size_t i,_i
-        cdef size_t N = idx.shape[0]
         if self.cache is not None:
             # Cache for episode ends stored at `self.cache`
-            for _i in range(N):
-                i = idx[_i]
-                if i in self.cache:
-                    if self.has_next_of:
-                        for name in self.next_of:
-                            sample[f"next_{name}"][_i] = self.cache[i][f"next_{name}"]
-                    if self.compress_any:
-                        for name in self.stack_compress:
-                            sample[name][_i] = self.cache[i][name]
+            self.cache.patch(sample,idx)
 
-        return sample
+    cdef _encode_checked(self,idx,out,keys,exclude,lock):
+        # For thread-safe subclasses. Rows are copied without `lock`, and
+        # rows whose slots are written meanwhile are copied again under
+        # `lock`, which must be held by writers. Rows in reserved slots are
+        # returned as not ``ok``.
+        cdef names, next_of
+        names, next_of = self._sample_names(keys,exclude)
 
-    def sample(self,batch_size):
+        idx = np.array(idx,copy=COPY_ONLY_NECESSARY, ndmin=1)
+        cdef const size_t [::1] slots = Csize(idx)
+        if len(next_of) > 0:
+            slots = Csize(np.concatenate((idx, (idx + 1) % self.buffer_size)))
+
+        cdef size_t N = slots.shape[0]
+        cdef uint64_t [::1] before = np.empty(N, dtype=np.uint64)
+        cdef ok = np.empty(N, dtype=np.bool_)
+        cdef bool [::1] view_ok = ok
+
+        with lock:
+            if N > 0:
+                self.seq.load(&slots[0],N,&before[0])
+
+        cdef sample = self._gather_rows(idx,out,names,next_of)
+
+        with lock:
+            if N > 0 and self.seq.validate(&slots[0],N,&before[0],&view_ok[0]) < N:
+                if len(next_of) > 0:
+                    ok = ok.reshape(2,-1).all(axis=0)
+
+                rewritten = np.flatnonzero(~ok)
+                for name, v in self._gather_rows(idx[rewritten],None,
+                                                 names,next_of).items():
+                    sample[name][rewritten] = v
+            self._restore_rows(sample,idx,next_of)
+
+            if self.reserved:
+                return sample, ~self._reserved_mask(idx)
+            return sample, np.ones(idx.shape[0], dtype=np.bool_)
+
+    def sample(self,batch_size,*,out=None,keys=None,exclude=None):
         r"""Sample the stored transitions randomly with specified size
 
         Parameters
         ----------
         batch_size : int
             sampled batch size
+        out : dict of ndarray, optional
+            Preallocated arrays to store sampled transitions into. The shape and
+            dtype of each array must match with the corresponding returned
+            value. Values whose key is not in ``out`` are newly allocated.
+        keys : str or array like of str, optional
+            Names of returned values. If ``None`` (default), all values are
+            returned. Values which are not returned are never gathered.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
 
         Returns
         -------
         sample : dict of ndarray
             Sampled batch transitions, which might contains
             the same transition multiple times.
+            Arrays in ``out`` are returned as they are.
 
         Examples
         --------
@@ -1390,7 +2617,200 @@ cdef class ReplayBuffer:
                        [1., 2., 3.]], dtype=float32)}
         """
         cdef idx = np.random.randint(0,self.get_stored_size(),batch_size)
-        return self._encode_sample(idx)
+        return self._encode_sample(idx,out,keys,exclude)
+
+    def sample_many(self,k,batch_size):
+        r"""Sample multiple independent batches at once
+
+        Parameters
+        ----------
+        k : int
+            The number of batches
+        batch_size : int
+            Batch size of each batch
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled batches stacked with shape ``(k, batch_size, ...)``,
+            which are gathered at once.
+
+        Examples
+        --------
+        >>> rb = ReplayBuffer(32, {"obs": {"shape": 3}})
+        >>> rb.add(obs=np.ones((8,3)))
+        >>> rb.sample_many(4, 2)["obs"].shape
+        (4, 2, 3)
+        """
+        cdef idx = np.random.randint(0,self.get_stored_size(),k*batch_size)
+        return split_batches(self._encode_sample(idx),k)
+
+    def sample_sequences(self,batch_size,length,*,burn_in=0):
+        r"""Sample contiguous sequences of transitions randomly
+
+        Sequences start at uniformly sampled transitions, and are gathered
+        as ``(batch_size, burn_in + length, ...)`` arrays. Steps after the
+        end of the episode (``on_episode_end``) or beyond the latest stored
+        transition are padded with ``0`` and masked out.
+
+        Parameters
+        ----------
+        batch_size : int
+            The number of sequences
+        length : int
+            Sequence length used for training
+        burn_in : int, optional
+            Sequence length prepended for burn-in of recurrent state.
+            The default is ``0``.
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled sequences. Additionally, ``"mask"`` (``True`` for valid
+            steps) and ``"indexes"`` (stored positions) of shape
+            ``(batch_size, burn_in + length)`` are included.
+
+        Examples
+        --------
+        >>> rb = ReplayBuffer(32, {"obs": {"shape": 3}, "done": {}})
+        >>> rb.add(obs=np.ones((8,3)), done=np.zeros(8))
+        >>> rb.on_episode_end()
+        >>> s = rb.sample_sequences(4, 5, burn_in=2)
+        >>> s["obs"].shape
+        (4, 7, 3)
+        >>> s["mask"].shape
+        (4, 7)
+        """
+        cdef start = np.random.randint(0,self.get_stored_size(),batch_size)
+        return self._encode_sequences(start,burn_in+length)
+
+    def _encode_sequences(self,start,size_t T):
+        start = np.array(start,copy=COPY_ONLY_NECESSARY,ndmin=1)
+        cdef size_t B = start.shape[0]
+        cdef steps = np.arange(T,dtype=start.dtype)
+        cdef idx = (start[:,np.newaxis] + steps) % self.buffer_size
+
+        # Steps in other episodes (or not stored) and newer than the latest
+        # are masked out. The latter keeps a long episode from wrapping around
+        # to its own oldest transitions.
+        cdef latest = ((self.get_next_index() + self.buffer_size - 1 - start)
+                       % self.buffer_size)
+        cdef ep = self.episode_ids[idx]
+        cdef mask = ((ep == ep[:,:1]) & (ep >= 0) &
+                     (steps <= latest[:,np.newaxis]))
+        cdef pad = ~mask
+
+        # Flattened sequences are gathered at once, so that next_of and
+        # stack_compress are restored.
+        cdef sample = self._encode_sample(idx.ravel())
+        for name, v in sample.items():
+            v = v.reshape((B,T)+v.shape[1:])
+            v[pad] = 0
+            sample[name] = v
+
+        sample["mask"] = mask
+        sample["indexes"] = idx
+        return sample
+
+    def sample_nstep(self,batch_size,size,*,gamma=0.99,rew=None,next=None,
+                     keys=None,exclude=None):
+        r"""Sample transitions with Nstep reward calculated at sample time
+
+        Transitions are stored as usual 1-step transitions, and Nstep reward,
+        ``done``, and next values are calculated for sampled transitions only.
+        Unlike ``Nstep`` constructor option, Nstep size and discount factor
+        can be changed at every call, and ``next_of`` compression can be used.
+
+        Parameters
+        ----------
+        batch_size : int
+            sampled batch size
+        size : int
+            Nstep size
+        gamma : float, optional
+            Discount factor, whose default is ``0.99``
+        rew : str or array like of str, optional
+            Reward(s) to be summed
+        next : str or array like of str, optional
+            Next value(s) (e.g. ``"next_obs"``) taken from the last step
+        keys : str or array like of str, optional
+            Names of returned values. If ``None`` (default), all values are
+            returned.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled batch transitions. Additionally, ``"discounts"`` of
+            shape ``(batch_size, 1)`` is included.
+
+        Notes
+        -----
+        Nstep window of each transition stops at the first ``done``, at the
+        episode end (``on_episode_end``), or at the latest stored transition.
+        ``done`` is ``1`` when the window stops at ``done``. ``"discounts"``
+        is ``gamma ** n`` with the actual window length ``n``, so that the
+        bootstrap target is ``rew + discounts * (1 - done) * V(next_obs)``.
+
+        ``"done"`` must be stored.
+
+        Examples
+        --------
+        >>> rb = ReplayBuffer(32, {"obs": {}, "rew": {}, "done": {}},
+        ...                   next_of="obs")
+        >>> rb.add(obs=np.arange(8), rew=np.ones(8), done=np.zeros(8),
+        ...        next_obs=np.arange(8)+1)
+        >>> rb.on_episode_end()
+        >>> s = rb.sample_nstep(4, 3, gamma=0.9, rew="rew", next="next_obs")
+        """
+        cdef idx = np.random.randint(0,self.get_stored_size(),batch_size)
+        return self._encode_nstep(idx,size,gamma,rew,next,keys,exclude)
+
+    def _encode_nstep(self,idx,size_t N,float gamma,rew,next,keys,exclude):
+        idx = np.array(idx,copy=COPY_ONLY_NECESSARY,ndmin=1)
+        cdef size_t B = idx.shape[0]
+        cdef steps = np.arange(N,dtype=idx.dtype)
+        cdef window = (idx[:,np.newaxis] + steps) % self.buffer_size
+
+        # Steps in other episodes, newer than the latest, or after "done"
+        # are not used.
+        cdef latest = ((self.get_next_index() + self.buffer_size - 1 - idx)
+                       % self.buffer_size)
+        cdef ep = self.episode_ids[window]
+        cdef done = self.buffer["done"][window].reshape((B,N))
+        cdef use = (ep == ep[:,:1]) & (steps <= latest[:,np.newaxis])
+        use &= (np.cumsum(done,axis=1) - done) == 0
+        use = np.logical_and.accumulate(use,axis=1)
+
+        cdef n = use.sum(axis=1)
+        cdef coef = np.power(gamma,steps,dtype=np.single) * use
+
+        cdef next_of = self.next_of if self.has_next_of else []
+        cdef names = list(self.buffer) + [f"next_{name}" for name in next_of]
+        cdef selected = select_keys(names,keys,exclude)
+        if selected is not None:
+            names = [name for name in names if name in selected]
+        next = [] if next is None else np.ravel(next).tolist()
+        rew = [] if rew is None else np.ravel(rew).tolist()
+
+        cdef sample = self._encode_sample(idx,keys=[name for name in names
+                                                    if name not in next])
+        for name in rew:
+            if name in sample:
+                sample[name] = np.einsum("bn,bn...->b...",coef,
+                                         self.buffer[name][window]
+                                         ).astype(sample[name].dtype,copy=False)
+        if "done" in sample:
+            sample["done"] = np.max(done * use,axis=1).reshape(sample["done"].shape)
+
+        # Next values are taken from the last used step
+        cdef last = [name for name in names if name in next]
+        if last:
+            sample.update(self._encode_sample(window[np.arange(B),n-1],keys=last))
+
+        sample["discounts"] = np.power(gamma,n,dtype=np.single).reshape(B,1)
+        return sample
 
     cpdef void clear(self) except *:
         r"""Clear replay buffer.
@@ -1411,10 +2831,16 @@ cdef class ReplayBuffer:
         >>> rb.get_next_index()
         0
         """
+        if self.seq is not NULL and self.reserved:
+            self.seq.commit(self.index.get_next_index(),self.reserved)
+
         self.index.clear()
         self.episode_len = 0
+        self.reserved = 0
+        self.episode_ids[:] = -1
 
-        self.cache = {} if (self.has_next_of or self.compress_any) else None
+        if self.cache is not None:
+            self.cache.clear()
 
         if self.use_nstep:
             self.nstep.clear()
@@ -1482,28 +2908,27 @@ cdef class ReplayBuffer:
 
     cdef void add_cache_i(self, size_t key, size_t key_end) except *:
         # If key is already cached, don't do anything
-        if key in self.cache:
+        if self.cache.contains(key):
             return
 
         cdef size_t next_key = key + 1
-        cdef cache_key = {}
+        cdef int64_t i = self.cache.allocate(key)
+        cdef dict rows = self.cache.rows
 
         if self.has_next_of:
             if next_key == key_end:
                 for name, value in self.next_.items():
-                    cache_key[f"next_{name}"] = value.copy()
+                    rows[f"next_{name}"][i] = value
             else:
                 if next_key == self.buffer_size:
                     # Fix: GitHub Discussion 28
                     next_key = 0
                 for name in self.next_.keys():
-                    cache_key[f"next_{name}"] = self.buffer[name][next_key].copy()
+                    rows[f"next_{name}"][i] = self.buffer[name][next_key]
 
         if self.compress_any:
             for name in self.stack_compress:
-                cache_key[name] = self.buffer[name][key].copy()
-
-        self.cache[key] = cache_key
+                rows[name][i] = self.buffer[name][key]
 
     cpdef void on_episode_end(self) except *:
         r"""Call on episode end
@@ -1526,6 +2951,7 @@ cdef class ReplayBuffer:
         self.add_cache()
 
         self.episode_len = 0
+        self.episode_id += 1
 
     cpdef size_t get_current_episode_len(self):
         r"""Get current episode length
@@ -1570,15 +2996,23 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
     cdef CppPrioritizedSampler[float]* per
     cdef NstepBuffer priorities_nstep
     cdef bool check_for_update
-    cdef bool [:] unchange_since_sample
+    cdef uint64_t [:] write_stamp
+    cdef uint64_t sample_epoch
     cdef vector[size_t] idx_vec
     cdef vector[float] ps_vec
+    cdef PyThread_type_lock tree_lock
 
     def __cinit__(self,size,env_dict=None,*,alpha=0.6,Nstep=None,eps=1e-4,
-                  check_for_update=False,**kwrags):
+                  check_for_update=False,wide_tree=False,**kwrags):
+        self.tree_lock = PyThread_allocate_lock()
+        if self.tree_lock is NULL:
+            raise MemoryError("Fail to allocate lock")
+
         self.alpha = alpha
-        self.per = new CppPrioritizedSampler[float](size,alpha)
-        self.per.set_eps(eps)
+        self.per = new CppPrioritizedSampler[float](size,alpha,
+                                                    NULL,NULL,NULL,NULL,NULL,
+                                                    True,eps,NULL,NULL,
+                                                    wide_tree)
         self.weights = VectorFloat()
         self.indexes = VectorSize_t()
 
@@ -1589,16 +3023,23 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
 
         self.check_for_update = check_for_update
         if self.check_for_update:
-            self.unchange_since_sample = np.ones(np.array(size,
-                                                          copy=COPY_ONLY_NECESSARY,
-                                                          dtype='int'),
-                                                 dtype='bool')
+            # Slot i is unchanged since the last sample,
+            # iff write_stamp[i] < sample_epoch.
+            self.write_stamp = np.zeros(np.array(size,
+                                                 copy=COPY_ONLY_NECESSARY,
+                                                 dtype='int'),
+                                        dtype=np.uint64)
+            self.sample_epoch = 1
 
         self.idx_vec = vector[size_t]()
         self.ps_vec = vector[float]()
 
+    def __dealloc__(self):
+        if self.tree_lock is not NULL:
+            PyThread_free_lock(self.tree_lock)
+
     def __init__(self,size,env_dict=None,*,alpha=0.6,Nstep=None,eps=1e-4,
-                 check_for_update=False,**kwargs):
+                 check_for_update=False,wide_tree=False,**kwargs):
         r"""Initialize ``PrioritizedReplayBuffer``
 
         Parameters
@@ -1621,6 +3062,11 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
             this buffer traces updated indices after the last calling of
             ``sample()`` method to avoid mis-updating priorities of already
             overwritten values. This feature is designed for multiprocess learning.
+        wide_tree : bool, optional
+            If the value is ``True`` (default value is ``False``), priorities are
+            stored at segment trees whose node has 16 children packed in a cache
+            line instead of binary trees. This layout reduces cache misses for
+            very large buffer (e.g. :math:`10^7`).
 
         See Also
         --------
@@ -1635,6 +3081,14 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
         """
         pass
 
+    cdef void _lock_tree(self) noexcept nogil:
+        # Segment trees are accessed without GIL, so that other threads can
+        # run during tree operations.
+        PyThread_acquire_lock(self.tree_lock, WAIT_LOCK)
+
+    cdef void _unlock_tree(self) noexcept nogil:
+        PyThread_release_lock(self.tree_lock)
+
     def add(self,*,priorities = None,**kwargs):
         r"""Add transition(s) into replay buffer.
 
@@ -1665,6 +3119,15 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
         All values must be passed by key-value style (keyword arguments).
         It is user responsibility that all the values have the same step-size.
         """
+        maybe_index, N, priorities = self._add(priorities,kwargs)
+        if maybe_index is None:
+            return None
+
+        self._set_priorities(maybe_index,N,priorities)
+        return maybe_index
+
+    def _add(self,priorities,kwargs):
+        # Store transitions, and return their priorities to be set.
         cdef size_t N = self.size_check.step_size(kwargs)
         if priorities is not None:
             priorities = np.ravel(np.array(priorities, copy=COPY_ONLY_NECESSARY,
@@ -1683,30 +3146,85 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
                 priorities = np.ravel(priorities["priorities"])
                 N = priorities.shape[0]
 
-        cdef maybe_index = super().add(**kwargs)
-        if maybe_index is None:
-            return None
+        cdef size_t buffer_size = self.get_buffer_size()
+        if N > buffer_size:
+            # Only the last transitions survive. (See ReplayBuffer.add)
+            if priorities is not None:
+                priorities = priorities[N-buffer_size:]
+            N = buffer_size
 
-        cdef size_t index = maybe_index
-        cdef const float [:] ps
+        return super().add(**kwargs), N, priorities
 
-        if priorities is not None:
-            ps = np.ravel(np.array(priorities, copy=COPY_ONLY_NECESSARY,
-                                   ndmin=1, dtype=np.single))
-            self.per.set_priorities(index,&ps[0],N,self.get_buffer_size())
-        else:
-            self.per.set_priorities(index,N,self.get_buffer_size())
+    def commit(self,*,priorities = None,**kwargs):
+        r"""Store transitions written into reserved slots
 
-        if self.check_for_update:
-            if index+N <= self.buffer_size:
-                self.unchange_since_sample[index:index+N] = False
-            else:
-                self.unchange_since_sample[index:] = False
-                self.unchange_since_sample[:index+N-self.buffer_size] = False
+        Parameters
+        ----------
+        priorities : array like or float, optional
+            Priorities of reserved transitions. When no priorities are passed,
+            the maximum priorities until then are used.
+        **kwargs : array like or float or int
+            ``next_***`` values of the last reserved transition for ``next_of``.
 
+        Returns
+        -------
+        int
+            The first index of stored position.
+
+        Raises
+        ------
+        ValueError
+            If no slots have been reserved, or ``priorities`` shape is
+            incompatible.
+        KeyError
+            If ``next_***`` for ``next_of`` is missing.
+        """
+        index, N, priorities = self._commit(priorities,kwargs)
+        self._set_priorities(index,N,priorities)
         return index
 
-    def sample(self,batch_size,beta = 0.4):
+    def _commit(self,priorities,kwargs):
+        # Store reserved transitions, and return their priorities to be set.
+        cdef size_t N = self.reserved
+        if priorities is not None:
+            priorities = np.ravel(np.array(priorities, copy=COPY_ONLY_NECESSARY,
+                                           ndmin=1, dtype=np.single))
+            if N != priorities.shape[0]:
+                raise ValueError("`priorities` shape is incompatible")
+
+        return super().commit(**kwargs), N, priorities
+
+    cdef void _set_priorities(self,size_t index,size_t N,priorities) except *:
+        with nogil:
+            self._lock_tree()
+        self._write_priorities_unlock(index,N,priorities)
+
+    cdef void _write_priorities_unlock(self,size_t index,size_t N,
+                                       priorities) except *:
+        # (`tree_lock` must be held, and is released after writing.)
+        cdef const float [:] ps
+        cdef const float* ps_ptr = NULL
+        cdef size_t i
+
+        try:
+            if priorities is not None:
+                ps = np.ravel(np.array(priorities, copy=COPY_ONLY_NECESSARY,
+                                       ndmin=1, dtype=np.single))
+                ps_ptr = &ps[0]
+
+            with nogil:
+                if ps_ptr is not NULL:
+                    self.per.set_priorities(index,ps_ptr,N,self.buffer_size)
+                else:
+                    self.per.set_priorities(index,N,self.buffer_size)
+
+                if self.check_for_update:
+                    for i in range(index,index+N):
+                        self.write_stamp[i % self.buffer_size] = self.sample_epoch
+        finally:
+            self._unlock_tree()
+
+    def sample(self,batch_size,beta = 0.4,*,out=None,keys=None,exclude=None):
         r"""Sample the stored transitions.
 
         Transitions are sampled depending on correspoinding priorities
@@ -1719,12 +3237,24 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
         beta : float, optional
             The exponent of weight for relaxation of importance
             sampling effect, whose default value is ``0.4``
+        out : dict of ndarray, optional
+            Preallocated arrays to store sampled transitions, ``"weights"``,
+            and ``"indexes"`` into. The shape and dtype of each array must match
+            with the corresponding returned value. Values whose key is not
+            in ``out`` are newly allocated.
+        keys : str or array like of str, optional
+            Names of returned values except ``"weights"`` and
+            ``"indexes"``, which are always returned. If ``None`` (default), all values are
+            returned. Values which are not returned are never gathered.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
 
         Returns
         -------
         dict of ndarray
             Sampled batch transitions which also includes
-            ``"weights"`` and ``"indexes"``
+            ``"weights"`` and ``"indexes"``.
+            Arrays in ``out`` are returned as they are.
 
         Notes
         -----
@@ -1733,33 +3263,190 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
         The ``weights`` are also normalized by the weight for minimum priority
         (:math:`= w_{i}/\max_{j}(w_{j})`), which ensures the weights :math:`\leq` 1.
         """
-        self.per.sample(batch_size,beta,
-                        self.weights.vec,self.indexes.vec,
-                        self.get_stored_size())
-        cdef idx = self.indexes.as_numpy()
+        return self._sample(batch_size,beta,self.weights,self.indexes,out,
+                            keys,exclude)
+
+    cdef _draw(self,size_t k,size_t batch_size,float beta,
+               VectorFloat weights,VectorSize_t indexes):
+        # Sample indexes of k batches under the tree lock.
+        cdef size_t stored_size = self.get_stored_size()
+
+        with nogil:
+            self._lock_tree()
+            if k == 1:
+                self.per.sample(batch_size,beta,weights.vec,indexes.vec,
+                                stored_size)
+            else:
+                self.per.sample_many(k,batch_size,beta,weights.vec,indexes.vec,
+                                     stored_size)
+            if self.check_for_update:
+                self.sample_epoch += 1
+            self._unlock_tree()
+
+        return indexes.as_numpy()
+
+    cdef _sample(self,size_t batch_size,float beta,
+                 VectorFloat weights,VectorSize_t indexes,out,
+                 keys=None,exclude=None):
+        cdef idx = self._draw(1,batch_size,beta,weights,indexes)
+        samples = self._encode_sample(idx,out,keys,exclude)
+        samples['weights'] = copy_into(weights.as_numpy(),out,'weights')
+        samples['indexes'] = copy_into(idx,out,'indexes')
+
+        return samples
+
+    def sample_many(self,k,batch_size,beta=0.4):
+        r"""Sample multiple independent batches at once
+
+        Each batch is sampled as ``sample`` does, but the tree is traversed
+        and weights are normalized only once for all the batches.
+
+        Parameters
+        ----------
+        k : int
+            The number of batches
+        batch_size : int
+            Batch size of each batch
+        beta : float, optional
+            The exponent of weight for relaxation of importance
+            sampling effect, whose default value is ``0.4``
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled batches stacked with shape ``(k, batch_size, ...)``, which
+            also includes ``"weights"`` and ``"indexes"``.
+
+        Notes
+        -----
+        Priorities can be updated by each batch (e.g.
+        ``update_priorities(s["indexes"][i], td_i)``) or by all the batches
+        with flattened arrays.
+        """
+        cdef VectorFloat weights = VectorFloat()
+        cdef idx = self._draw(k,batch_size,beta,weights,VectorSize_t())
         samples = self._encode_sample(idx)
-        samples['weights'] = self.weights.as_numpy()
+        samples['weights'] = weights.as_numpy()
         samples['indexes'] = idx
 
-        if self.check_for_update:
-            self.unchange_since_sample[:] = True
+        return split_batches(samples,k)
+
+    def sample_sequences(self,batch_size,length,*,burn_in=0,beta=0.4):
+        r"""Sample contiguous sequences of transitions depending on priorities
+
+        Sequence starts are sampled depending on their priorities, which can
+        be updated by passing step-wise errors to ``update_priorities``.
+
+        Parameters
+        ----------
+        batch_size : int
+            The number of sequences
+        length : int
+            Sequence length used for training
+        burn_in : int, optional
+            Sequence length prepended for burn-in of recurrent state.
+            The default is ``0``.
+        beta : float, optional
+            The exponent of weight for relaxation of importance
+            sampling effect, whose default value is ``0.4``
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled sequences, which also includes ``"mask"`` and
+            ``"indexes"`` of shape ``(batch_size, burn_in + length)`` and
+            ``"weights"`` of shape ``(batch_size,)``.
+
+        See Also
+        --------
+        ReplayBuffer.sample_sequences
+        sequence_priorities
 
+        Examples
+        --------
+        >>> rb = PrioritizedReplayBuffer(32, {"obs": {}, "done": {}})
+        >>> rb.add(obs=np.arange(8), done=np.zeros(8))
+        >>> rb.on_episode_end()
+        >>> s = rb.sample_sequences(4, 3)
+        >>> rb.update_priorities(s["indexes"], np.random.rand(4, 3), mask=s["mask"])
+        """
+        cdef VectorFloat weights = VectorFloat()
+        cdef idx = self._draw(1,batch_size,beta,weights,VectorSize_t())
+        samples = self._encode_sequences(idx,burn_in+length)
+        samples['weights'] = weights.as_numpy()
         return samples
 
-    def update_priorities(self,indexes,priorities):
+    def sample_nstep(self,batch_size,size,beta=0.4,*,gamma=0.99,rew=None,
+                     next=None,keys=None,exclude=None):
+        r"""Sample transitions depending on priorities with Nstep reward
+        calculated at sample time
+
+        Parameters
+        ----------
+        batch_size : int
+            sampled batch size
+        size : int
+            Nstep size
+        beta : float, optional
+            The exponent of weight for relaxation of importance
+            sampling effect, whose default value is ``0.4``
+        gamma : float, optional
+            Discount factor, whose default is ``0.99``
+        rew : str or array like of str, optional
+            Reward(s) to be summed
+        next : str or array like of str, optional
+            Next value(s) (e.g. ``"next_obs"``) taken from the last step
+        keys : str or array like of str, optional
+            Names of returned values. If ``None`` (default), all values are
+            returned.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled batch transitions, which also includes ``"discounts"``,
+            ``"weights"``, and ``"indexes"``.
+
+        See Also
+        --------
+        ReplayBuffer.sample_nstep
+        """
+        cdef VectorFloat weights = VectorFloat()
+        cdef idx = self._draw(1,batch_size,beta,weights,VectorSize_t())
+        samples = self._encode_nstep(idx,size,gamma,rew,next,keys,exclude)
+        samples['weights'] = weights.as_numpy()
+        samples['indexes'] = idx
+        return samples
+
+    def update_priorities(self,indexes,priorities,*,mask=None,eta=0.9):
         r"""Update priorities
 
         Update priorities specified with indicies. If this
         ``PrioritizedReplayBuffer`` is constructed with
         ``check_for_update=True``, then ignore indices which updated
         values after the last calling of ``sample()`` method.
+        When ``indexes`` contains duplicated indices, the last priority
+        is used.
+
+        For sequences from ``sample_sequences``, step-wise errors with shape
+        ``(batch_size, T)`` can be passed as ``priorities``. Then, the
+        priority of each sequence start is updated once by
+        ``sequence_priorities``.
 
         Parameters
         ----------
         indexes : array_like
-            Indexes to update priorities
+            Indexes to update priorities. For sequences, ``indexes`` of
+            ``sample_sequences`` (or their first column) can be passed.
         priorities : array_like
-            Priorities to update
+            Priorities to update, or step-wise errors of sequences
+        mask : array_like of bool, optional
+            Valid steps of step-wise errors (e.g. a part of ``mask`` of
+            ``sample_sequences``).
+        eta : float, optional
+            Mixture coefficient of max and mean for sequences.
+            The default is ``0.9``.
 
         Raises
         ------
@@ -1770,34 +3457,43 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
         if priorities is None:
             raise TypeError("``properties`` must not be ``None``")
 
+        if np.ndim(priorities) == 2:
+            priorities = sequence_priorities(priorities,mask,eta)
+            if np.ndim(indexes) == 2:
+                indexes = np.asarray(indexes)[:,0]
+
         cdef const size_t [:] idx = Csize(indexes)
         cdef const float [:] ps = Cfloat(priorities)
 
-        if not self.check_for_update:
-            self.per.update_priorities(&idx[0],&ps[0],idx.shape[0])
+        if idx.shape[0] == 0:
             return None
 
-        self.idx_vec.clear()
-        self.idx_vec.reserve(idx.shape[0])
-
-        self.ps_vec.clear()
-        self.ps_vec.reserve(ps.shape[0])
-
-        if self.check_for_update:
-            for _i in range(idx.shape[0]):
-                if self.unchange_since_sample[idx[_i]]:
-                    self.idx_vec.push_back(idx[_i])
-                    self.ps_vec.push_back(ps[_i])
+        cdef size_t N = idx.shape[0]
+        cdef size_t stored_size = self.get_stored_size()
 
-        cdef N = self.idx_vec.size()
-        if N > 0:
-            self.per.update_priorities(self.idx_vec.data(),self.ps_vec.data(),N)
+        with nogil:
+            self._lock_tree()
+            if not self.check_for_update:
+                self.per.update_priorities(&idx[0],&ps[0],N)
+            else:
+                N = FilterUnchangedSinceSample(&idx[0],&ps[0],N,
+                                               &self.write_stamp[0],
+                                               self.sample_epoch,
+                                               stored_size,
+                                               self.idx_vec,self.ps_vec)
+                if N > 0:
+                    self.per.update_priorities(self.idx_vec.data(),
+                                               self.ps_vec.data(),N)
+            self._unlock_tree()
 
     cpdef void clear(self) except *:
         r"""Clear replay buffer
         """
         super(PrioritizedReplayBuffer,self).clear()
+        with nogil:
+            self._lock_tree()
         clear(self.per)
+        self._unlock_tree()
         if self.use_nstep:
             self.priorities_nstep.clear()
 
@@ -1830,9 +3526,312 @@ cdef class PrioritizedReplayBuffer(ReplayBuffer):
                      priorities=self.priorities_nstep.on_episode_end()["priorities"])
             self.use_nstep = True
 
-        self.add_cache()
+        self.add_cache()
+
+        self.episode_len = 0
+        self.episode_id += 1
+
+
+@cython.embedsignature(True)
+cdef class ThreadSafeReplayBuffer(ReplayBuffer):
+    r"""Thread-safe Replay Buffer class for multi-threading in a single process.
+
+    All the methods of ``ReplayBuffer`` can be called from multiple threads
+    without manual lock.
+
+    See Also
+    --------
+    ReplayBuffer : Non thread-safe version
+    MPReplayBuffer : Multi-process version
+
+    Notes
+    -----
+    An internal lock is held only while transitions are written into the
+    buffer and while indexes to be read are taken. Sampled transitions are
+    copied without the lock, and transitions overwritten during the copy
+    are detected by per-slot sequence numbers and are copied again under
+    the lock. Therefore, ``add`` doesn't wait ``sample`` copying a large
+    batch.
+
+    Between ``reserve`` and ``commit``, ``add`` and ``reserve`` from other
+    threads wait, and ``sample`` excludes the reserved slots. Other readers
+    (e.g. ``get_all_transitions`` and ``sample_sequences``) might observe
+    partially written reserved slots until ``commit``.
+    """
+    cdef lock
+    cdef reserver
+
+    def __cinit__(self,*args,**kwargs):
+        self.lock = threading.Condition(threading.RLock())
+        self.reserver = None
+        self.seq = new CppThreadSafeSlotSequence(self.buffer_size,NULL,True)
+
+    cdef void _wait_commit(self) except *:
+        # Slots reserved by the other thread must be committed at first.
+        while self.reserved and (self.reserver != threading.get_ident()):
+            self.lock.wait()
+
+    def add(self,*,**kwargs):
+        r"""Add transition(s) into replay buffer.
+
+        This method can be called from multiple threads. While slots are
+        reserved by another thread, this method waits for its ``commit``.
+
+        See Also
+        --------
+        ReplayBuffer.add
+        """
+        with self.lock:
+            self._wait_commit()
+            return super().add(**kwargs)
+
+    def reserve(self,n):
+        r"""Reserve the next slots to be written in place
+
+        Until ``commit``, ``add`` and ``reserve`` from other threads wait,
+        and the reserved slots are not sampled.
+
+        See Also
+        --------
+        ReplayBuffer.reserve
+        """
+        with self.lock:
+            self._wait_commit()
+            segments = super().reserve(n)
+            self.reserver = threading.get_ident()
+            return segments
+
+    def commit(self,**kwargs):
+        r"""Store transitions written into reserved slots
+
+        See Also
+        --------
+        ReplayBuffer.commit
+        """
+        with self.lock:
+            index = super().commit(**kwargs)
+            self.lock.notify_all()
+            return index
+
+    def sample(self,batch_size,*,out=None,keys=None,exclude=None):
+        r"""Sample the stored transitions randomly with specified size
+
+        This method can be called from multiple threads. Reserved slots are
+        not sampled until ``commit``.
+
+        See Also
+        --------
+        ReplayBuffer.sample
+        """
+        cdef idx = self._sample_index(batch_size)
+        sample, ok = self._encode_checked(idx,out,keys,exclude,self.lock)
+
+        # Slots reserved during the copy are redrawn.
+        redraw = np.flatnonzero(~ok)
+        while redraw.shape[0] > 0:
+            idx = self._sample_index(redraw.shape[0])
+            s, ok = self._encode_checked(idx,None,keys,exclude,self.lock)
+            for name, v in s.items():
+                sample[name][redraw] = v
+            redraw = redraw[~ok]
+
+        return sample
+
+    cdef _sample_index(self,size_t batch_size):
+        with self.lock:
+            if self.reserved:
+                return self._unreserved_index(batch_size)
+            return np.random.randint(0,self.get_stored_size(),batch_size)
+
+    def _encode_sample(self,idx,out=None,keys=None,exclude=None):
+        return self._encode_checked(idx,out,keys,exclude,self.lock)[0]
+
+    def _encode_range(self,begin,end):
+        with self.lock:
+            return super()._encode_range(begin,end)
+
+    def _encode_nstep(self,idx,N,gamma,rew,next,keys,exclude):
+        with self.lock:
+            return super()._encode_nstep(idx,N,gamma,rew,next,keys,exclude)
+
+    cpdef void clear(self) except *:
+        r"""Clear replay buffer.
+        """
+        with self.lock:
+            super(ThreadSafeReplayBuffer,self).clear()
+            self.lock.notify_all()
+
+    cpdef void on_episode_end(self) except *:
+        r"""Call on episode end
+
+        See Also
+        --------
+        ReplayBuffer.on_episode_end
+        """
+        with self.lock:
+            super(ThreadSafeReplayBuffer,self).on_episode_end()
+
+
+@cython.embedsignature(True)
+cdef class ThreadSafePrioritizedReplayBuffer(PrioritizedReplayBuffer):
+    r"""Thread-safe Prioritized Replay Buffer class for multi-threading in a single process.
+
+    All the methods of ``PrioritizedReplayBuffer`` can be called from multiple
+    threads without manual lock.
+
+    See Also
+    --------
+    PrioritizedReplayBuffer : Non thread-safe version
+    MPPrioritizedReplayBuffer : Multi-process version
+
+    Notes
+    -----
+    Transitions and segment trees are protected by separated locks. The
+    lock for transitions is held only while transitions are written into
+    the buffer and while indexes to be read are taken. Sampled transitions
+    are copied without the lock, and transitions overwritten during the
+    copy are detected by per-slot sequence numbers and are copied again
+    under the lock. Segment tree operations in ``add``, ``sample``, and
+    ``update_priorities`` hold only the lock for segment trees, and run
+    without GIL. Therefore, ``add`` doesn't wait ``sample`` copying a large
+    batch, and other threads (e.g. environment stepping and priority
+    update) can progress during segment tree operations. Returned
+    ``weights`` and ``indexes`` are not shared with other ``sample`` calls.
+
+    Between ``reserve`` and ``commit``, ``add`` and ``reserve`` from other
+    threads wait, and ``sample`` redraws transitions in the reserved slots.
+    Other readers (e.g. ``get_all_transitions`` and ``sample_sequences``)
+    might observe partially written reserved slots until ``commit``.
+    """
+    cdef lock
+    cdef reserver
+
+    def __cinit__(self,*args,**kwargs):
+        self.lock = threading.Condition(threading.RLock())
+        self.reserver = None
+        self.seq = new CppThreadSafeSlotSequence(self.buffer_size,NULL,True)
+
+    cdef void _wait_commit(self) except *:
+        # Slots reserved by the other thread must be committed at first.
+        while self.reserved and (self.reserver != threading.get_ident()):
+            self.lock.wait()
+
+    def add(self,*,priorities = None,**kwargs):
+        r"""Add transition(s) into replay buffer.
+
+        This method can be called from multiple threads. While slots are
+        reserved by another thread, this method waits for its ``commit``.
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.add
+        """
+        with self.lock:
+            self._wait_commit()
+            index, N, priorities = self._add(priorities,kwargs)
+            if index is None:
+                return None
+
+            # The tree lock is taken before the lock for transitions is
+            # released, so that priorities are set in the written order.
+            with nogil:
+                self._lock_tree()
+
+        self._write_priorities_unlock(index,N,priorities)
+        return index
+
+    def reserve(self,n):
+        r"""Reserve the next slots to be written in place
+
+        Until ``commit``, ``add`` and ``reserve`` from other threads wait,
+        and the reserved slots are not sampled.
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.reserve
+        """
+        with self.lock:
+            self._wait_commit()
+            segments = super().reserve(n)
+            self.reserver = threading.get_ident()
+            return segments
+
+    def commit(self,*,priorities = None,**kwargs):
+        r"""Store transitions written into reserved slots
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.commit
+        """
+        with self.lock:
+            index, N, priorities = self._commit(priorities,kwargs)
+            self.lock.notify_all()
+            with nogil:
+                self._lock_tree()
+
+        self._write_priorities_unlock(index,N,priorities)
+        return index
+
+    def sample(self,batch_size,beta = 0.4,*,out=None,keys=None,exclude=None):
+        r"""Sample the stored transitions.
+
+        This method can be called from multiple threads. Transitions in
+        reserved slots are redrawn until ``commit``.
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.sample
+        """
+        with self.lock:
+            if self.reserved == self.buffer_size:
+                raise ValueError("All the stored transitions are reserved")
+
+        cdef VectorFloat weights = VectorFloat()
+        cdef idx = self._draw(1,batch_size,beta,weights,VectorSize_t())
+        samples, ok = self._encode_checked(idx,out,keys,exclude,self.lock)
+        samples['weights'] = copy_into(weights.as_numpy(),out,'weights')
+        samples['indexes'] = copy_into(idx,out,'indexes')
+
+        redraw = np.flatnonzero(~ok)
+        while redraw.shape[0] > 0:
+            weights = VectorFloat()
+            idx = self._draw(1,redraw.shape[0],beta,weights,VectorSize_t())
+            s, ok = self._encode_checked(idx,None,keys,exclude,self.lock)
+            s['weights'] = weights.as_numpy()
+            s['indexes'] = idx
+            for name, v in s.items():
+                samples[name][redraw] = v
+            redraw = redraw[~ok]
+
+        return samples
+
+    def _encode_sample(self,idx,out=None,keys=None,exclude=None):
+        return self._encode_checked(idx,out,keys,exclude,self.lock)[0]
+
+    def _encode_range(self,begin,end):
+        with self.lock:
+            return super()._encode_range(begin,end)
+
+    def _encode_nstep(self,idx,N,gamma,rew,next,keys,exclude):
+        with self.lock:
+            return super()._encode_nstep(idx,N,gamma,rew,next,keys,exclude)
+
+    cpdef void clear(self) except *:
+        r"""Clear replay buffer
+        """
+        with self.lock:
+            super(ThreadSafePrioritizedReplayBuffer,self).clear()
+            self.lock.notify_all()
+
+    cpdef void on_episode_end(self) except *:
+        r"""Call on episode end
 
-        self.episode_len = 0
+        See Also
+        --------
+        PrioritizedReplayBuffer.on_episode_end
+        """
+        with self.lock:
+            super(ThreadSafePrioritizedReplayBuffer,self).on_episode_end()
 
 
 @cython.embedsignature(True)
@@ -1918,6 +3917,29 @@ cdef class ReverseReplayBuffer(ReplayBuffer):
             Sampled batch transitions, which might contains
             the same transition multiple times.
         """
+        return self._encode_sample(self._reverse_indexes(batch_size))
+
+    def sample_many(self,k,batch_size):
+        r"""Sample multiple successive batches reversely at once
+
+        Parameters
+        ----------
+        k : int
+            The number of batches
+        batch_size : int
+            Batch size of each batch
+
+        Returns
+        -------
+        dict of ndarray
+            Sampled batches stacked with shape ``(k, batch_size, ...)``, which
+            are same as ``k`` times calls of ``sample``.
+        """
+        cdef idx = np.concatenate([self._reverse_indexes(batch_size)
+                                   for _ in range(k)])
+        return split_batches(self._encode_sample(idx),k)
+
+    cdef _reverse_indexes(self,size_t batch_size):
         cdef size_t nidx = self.get_next_index()
         cdef size_t ssize = self.get_stored_size()
 
@@ -1941,7 +3963,64 @@ cdef class ReverseReplayBuffer(ReplayBuffer):
                 tmp += ssize
             tmp -= self.stride
 
-        return self._encode_sample(idx)
+        return idx
+
+
+# Redraws of MPReplayBuffer.sample without sleep
+cdef size_t _SPIN_REDRAW = 64
+
+
+cdef class _NstepStage:
+    # Nstep transitions staged by a single explorer
+    cdef NstepBuffer nstep
+    cdef list staged
+    cdef size_t size
+
+    def __cinit__(self,NstepBuffer nstep):
+        self.nstep = nstep
+        self.staged = []
+        self.size = 0
+
+
+cdef class _NstepStages:
+    # Nstep stages of explorers in this process. An explorer is the running
+    # asyncio task, or the calling thread outside of event loop. Stages are
+    # neither inherited at fork nor pickled.
+    cdef pid
+    cdef stages
+
+    def __cinit__(self):
+        self.pid = None
+        self.stages = None
+
+    def __reduce__(self):
+        return (_NstepStages, ())
+
+    cdef _explorer_stages(self):
+        cdef pid = os.getpid()
+        if self.pid != pid:
+            self.stages = weakref.WeakKeyDictionary()
+            self.pid = pid
+        return self.stages
+
+    cdef _explorer(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return threading.current_thread() if task is None else task
+
+    cdef _NstepStage get(self):
+        return self._explorer_stages().get(self._explorer())
+
+    cdef void set(self,_NstepStage stage) except *:
+        self._explorer_stages()[self._explorer()] = stage
+
+    cdef _NstepStage pop(self):
+        return self._explorer_stages().pop(self._explorer(),None)
+
+    cdef void clear(self) except *:
+        self._explorer_stages().clear()
 
 
 @cython.embedsignature(True)
@@ -1975,6 +4054,9 @@ cdef class MPReplayBuffer:
     This class assumes single learner (``sample``) and multiple explorers (``add``)
     like Ape-X [1]_.
 
+    Explorers write their reserved slots without global lock, and the learner
+    reads only committed slots, so that they don't wait each other.
+
     References
     ----------
     .. [1] D. Horgan et al., "Distributed Prioritized Experience Replay", ICLR (2018),
@@ -1987,15 +4069,14 @@ cdef class MPReplayBuffer:
     cdef ProcessSafeRingBufferIndex index
     cdef default_dtype
     cdef StepChecker size_check
-    cdef explorer_ready
-    cdef explorer_count
-    cdef explorer_count_lock
-    cdef learner_ready
     cdef backend
+    cdef Nstep
+    cdef nstep_env
+    cdef _NstepStages stages
 
     def __init__(self, size, env_dict=None, *,
                  default_dtype=None, logger=None,
-                 ctx=None, backend="sharedctypes",
+                 ctx=None, backend="sharedctypes", Nstep=None,
                  **kwargs):
         r"""Initialize ``MPReplayBuffer``
 
@@ -2017,6 +4098,24 @@ cdef class MPReplayBuffer:
         backend : {"sharedctypes", "SharedMemory"}
             Shared memory (shm) backend to map buffer. The default is
             ``"sharedctypes"``. ``"SharedMemory"`` is available only for Python 3.8+.
+        Nstep : dict, optional
+            If this option is specified, Nstep reward is used.
+            ``Nstep["size"]`` is ``int`` specifying step size of Nstep reward.
+            ``Nstep["rew"]`` is ``str`` or array like of ``str`` specifying
+            Nstep reward to be summed. ``Nstep["gamma"]`` is float specifying
+            discount factor, its default is ``0.99``. ``Nstep["next"]`` is ``str`` or
+            list of ``str`` specifying next values to be moved.
+
+        Notes
+        -----
+        When ``Nstep`` is specified, Nstep transitions are staged at each
+        explorer, and are written into shared memory at once when
+        ``Nstep["size"]`` transitions are staged or at ``on_episode_end``.
+        An explorer is an asyncio task when it runs inside event loop,
+        otherwise a thread, so that ``add`` (or ``add_async``) and
+        ``on_episode_end`` of an episode must be called from the same task
+        or thread. Staged transitions are lost unless ``on_episode_end`` is
+        called.
         """
         self.env_dict = env_dict.copy() if env_dict else {}
         ctx = ctx or mp.get_context()
@@ -2042,31 +4141,9 @@ cdef class MPReplayBuffer:
 
         self.size_check = StepChecker(self.env_dict,special_keys)
 
-        self.learner_ready = ctx.Event()
-        self.learner_ready.clear()
-        self.explorer_ready = ctx.Event()
-        self.explorer_ready.set()
-        self.explorer_count = RawValue(ctx, ctypes.c_size_t, 0, self.backend)
-        self.explorer_count_lock = ctx.Lock()
-
-    cdef void _lock_explorer(self) except *:
-        self.explorer_ready.wait() # Wait permission
-        self.learner_ready.clear()  # Block learner
-        with self.explorer_count_lock:
-            self.explorer_count.value += 1
-
-    cdef void _unlock_explorer(self) except *:
-        with self.explorer_count_lock:
-            self.explorer_count.value -= 1
-        if self.explorer_count.value == 0:
-            self.learner_ready.set()
-
-    cdef void _lock_learner(self) except *:
-        self.explorer_ready.clear() # New explorer cannot enter into critical section
-        self.learner_ready.wait() # Wait until all explorer exit from critical section
-
-    cdef void _unlock_learner(self) except *:
-        self.explorer_ready.set() # Allow workers to enter into critical section
+        self.Nstep = Nstep.copy() if Nstep else None
+        self.nstep_env = self.env_dict
+        self.stages = _NstepStages()
 
     def add(self,*,**kwargs):
         r"""Add transition(s) into replay buffer.
@@ -2081,8 +4158,9 @@ cdef class MPReplayBuffer:
 
         Returns
         -------
-        int
-            The first index of stored position.
+        int or None
+            The first index of stored position. If Nstep transitions are
+            staged without being stored, ``None``.
 
         Raises
         ------
@@ -2094,27 +4172,69 @@ cdef class MPReplayBuffer:
         All values must be passed by key-value style (keyword arguments).
         It is user responsibility that all the values have the same step-size.
         """
+        if self.Nstep:
+            kwargs = self._stage(kwargs)
+            if kwargs is None:
+                return None
+
+        return self._store(kwargs)
+
+    def _store(self,kwargs):
         cdef size_t N = self.size_check.step_size(kwargs)
 
-        cdef size_t index = self.index.fetch_add(N)
+        cdef size_t index = self.index.reserve(N)
         cdef size_t end = index + N
         cdef add_idx = np.arange(index,end)
 
         if end > self.buffer_size:
             add_idx[add_idx >= self.buffer_size] -= self.buffer_size
 
+        # Reserved slots are written without global lock,
+        # and are published at commit.
+        try:
+            for name, b in self.buffer.items():
+                b[add_idx] = np.reshape(np.array(kwargs[name], ndmin=2,
+                                                 copy=COPY_ONLY_NECESSARY),
+                                        self.env_dict[name]["add_shape"])
+        finally:
+            self.index.commit(index, N)
 
-        self._lock_explorer()
+        return index
 
-        for name, b in self.buffer.items():
-            b[add_idx] = np.reshape(np.array(kwargs[name], ndmin=2,
-                                             copy=COPY_ONLY_NECESSARY),
-                                    self.env_dict[name]["add_shape"])
+    def _stage(self,kwargs):
+        # Stage Nstep transitions at this explorer. When enough transitions
+        # are staged, return them to be stored at once.
+        cdef _NstepStage stage = self.stages.get()
+        if stage is None:
+            stage = _NstepStage(NstepBuffer(self.nstep_env,self.Nstep.copy(),
+                                            default_dtype = self.default_dtype))
+            self.stages.set(stage)
+
+        self._push(stage,stage.nstep.add(**kwargs))
+        if stage.size < stage.nstep.get_Nstep_size():
+            return None
+        return self._pop(stage)
 
-        self._unlock_explorer()
-        return index
+    cdef void _push(self,_NstepStage stage,kwargs) except *:
+        if kwargs is None:
+            return
 
-    def get_all_transitions(self,shuffle: bool=False):
+        cdef size_t N = self.size_check.step_size(kwargs)
+        if N > 0:
+            stage.staged.append(kwargs)
+            stage.size += N
+
+    cdef _pop(self,_NstepStage stage):
+        if stage.size == 0:
+            return None
+
+        kwargs = {name: np.concatenate([s[name] for s in stage.staged])
+                  for name in self.nstep_env}
+        stage.staged = []
+        stage.size = 0
+        return kwargs
+
+    def get_all_transitions(self,shuffle: bool=False,*,keys=None,exclude=None):
         r"""
         Get all transitions stored in replay buffer.
 
@@ -2122,34 +4242,52 @@ cdef class MPReplayBuffer:
         ----------
         shuffle : bool, optional
             When ``True``, transitions are shuffled. The default value is ``False``.
+        keys : str or array like of str, optional
+            Names of returned values. If ``None`` (default), all values are
+            returned. Values which are not returned are never gathered.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
 
         Returns
         -------
         transitions : dict of numpy.ndarray
             All transitions stored in this replay buffer.
+
+        Notes
+        -----
+        Transitions which are being written by explorers are excluded.
         """
-        idx = np.arange(self.get_stored_size())
+        idx = np.arange(self.get_stored_size(), dtype=np.uintp)
 
         if shuffle:
             np.random.shuffle(idx)
 
-        self._lock_learner()
-        ret = self._encode_sample(idx)
-        self._unlock_learner()
+        ret, ok = self._encode_committed(idx,None,keys,exclude)
+        if not ok.all():
+            ret = {name: v[ok] for name, v in ret.items()}
 
         return ret
 
-    def _encode_sample(self,idx):
+    def _encode_sample(self,idx,out=None,keys=None,exclude=None):
         cdef sample = {}
+        cdef names = select_keys(self.buffer,keys,exclude)
 
         idx = np.array(idx, copy=COPY_ONLY_NECESSARY, ndmin=1)
 
         for name, b in self.buffer.items():
-            sample[name] = b[idx]
+            if (names is None) or (name in names):
+                sample[name] = gather(b,idx,out,name)
 
         return sample
 
-    def sample(self,batch_size):
+    def _encode_committed(self,idx,out=None,keys=None,exclude=None):
+        # Encode sample without lock, and check which slots had been committed
+        # and were not rewritten during the copy.
+        before = self.index.load_sequence(idx)
+        sample = self._encode_sample(idx,out,keys,exclude)
+        return sample, self.index.validate_sequence(idx, before)
+
+    def sample(self,batch_size,*,out=None,keys=None,exclude=None,timeout=10.0):
         r"""Sample the stored transitions randomly with specified size
 
         This method can be called from a single learner process.
@@ -2158,21 +4296,156 @@ cdef class MPReplayBuffer:
         ----------
         batch_size : int
             sampled batch size
+        out : dict of ndarray, optional
+            Preallocated arrays to store sampled transitions into. The shape and
+            dtype of each array must match with the corresponding returned
+            value. Values whose key is not in ``out`` are newly allocated.
+        keys : str or array like of str, optional
+            Names of returned values. If ``None`` (default), all values are
+            returned. Values which are not returned are never gathered.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
+        timeout : float, optional
+            Max seconds to wait transitions being written.
+            The default is ``10.0``.
 
         Returns
         -------
         dict of ndarray
             Sampled batch transitions, which might contains
             the same transition multiple times.
-        """
-        cdef idx = np.random.randint(0,self.get_stored_size(),batch_size)
+            Arrays in ``out`` are returned as they are.
 
-        self._lock_learner()
-        ret =  self._encode_sample(idx)
-        self._unlock_learner()
+        Raises
+        ------
+        TimeoutError
+            When transitions being written are kept redrawn for ``timeout``
+            seconds (e.g. all the stored slots are being written, or an
+            explorer died during writing).
+
+        Notes
+        -----
+        Transitions which are being written are redrawn from the other stored
+        transitions. After a few redraws, this method sleeps between redraws
+        to wait explorers.
+        """
+        cdef size_t stored_size = self.get_stored_size()
+        cdef idx = np.random.randint(0,stored_size,batch_size).astype(np.uintp)
+        cdef size_t retry = 0
+        cdef double delay = 1e-4
+        cdef double deadline = 0
+
+        ret, ok = self._encode_committed(idx,out,keys,exclude)
+        while not ok.all():
+            retry += 1
+            if retry > _SPIN_REDRAW:
+                if deadline == 0:
+                    deadline = time.monotonic() + timeout
+                elif time.monotonic() > deadline:
+                    raise TimeoutError("Stored transitions are kept being written")
+                time.sleep(delay)
+                delay = min(2*delay, 1e-2)
+
+            redraw = np.flatnonzero(~ok)
+            idx[redraw] = np.random.randint(0,stored_size,redraw.shape[0])
+
+            r, ok[redraw] = self._encode_committed(idx[redraw],None,keys,exclude)
+            for name, v in r.items():
+                ret[name][redraw] = v
 
         return ret
 
+    def sample_many(self,k,batch_size):
+        r"""Sample multiple independent batches at once
+
+        Parameters
+        ----------
+        k : int
+            The number of batches
+        batch_size : int
+            Batch size of each batch
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled batches stacked with shape ``(k, batch_size, ...)``,
+            which are gathered at once.
+
+        See Also
+        --------
+        MPReplayBuffer.sample
+        """
+        return split_batches(self.sample(k*batch_size),k)
+
+    async def add_async(self,**kwargs):
+        r"""Add transition(s) without blocking event loop
+
+        Data are copied at the default executor of the running event loop.
+
+        Returns
+        -------
+        int or None
+            The first index of stored position, or ``None`` when staged.
+
+        See Also
+        --------
+        MPReplayBuffer.add
+        """
+        if self.Nstep:
+            kwargs = self._stage(kwargs)
+            if kwargs is None:
+                return None
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._store, kwargs)
+
+    async def sample_async(self,batch_size,**kwargs):
+        r"""Sample the stored transitions without blocking event loop
+
+        Data are copied at the default executor of the running event loop.
+
+        Parameters
+        ----------
+        batch_size : int
+            sampled batch size
+        **kwargs : key-value
+            Additional keyword arguments of ``sample`` except ``out``
+
+        Returns
+        -------
+        dict of ndarray
+            Sampled batch transitions
+
+        See Also
+        --------
+        MPReplayBuffer.sample
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.sample,batch_size,**kwargs))
+
+    async def batches(self,batch_size,**kwargs):
+        r"""Stream of sampled batches
+
+        Parameters
+        ----------
+        batch_size : int
+            sampled batch size
+        **kwargs : key-value
+            Additional keyword arguments of ``sample_async``
+
+        Yields
+        ------
+        dict of ndarray
+            Sampled batch transitions
+
+        Examples
+        --------
+        >>> async for batch in rb.batches(32):
+        ...     await learn(batch)
+        """
+        while True:
+            yield await self.sample_async(batch_size,**kwargs)
+
     cpdef void clear(self) except *:
         r"""Clear replay buffer.
 
@@ -2193,6 +4466,7 @@ cdef class MPReplayBuffer:
         0
         """
         self.index.clear()
+        self.stages.clear()
 
     cpdef size_t get_stored_size(self):
         r"""Get stored size
@@ -2227,31 +4501,34 @@ cdef class MPReplayBuffer:
     cpdef void on_episode_end(self) except *:
         r"""Call on episode end
 
+        When Nstep is used, the remaining Nstep transitions of this explorer
+        (the calling asyncio task or thread) are finalized and are stored
+        together with staged ones.
+
         Notes
         -----
         Calling this function at episode end is the user responsibility,
         since episode exploration can be terminated at certain length
         even though any ``done`` flags from environment is not set.
-
-        Warnings
-        --------
-        Although nothing happens for ``MPReplayBuffer``, it is better to call this
-        because some functionalities might be added in the future version.
         """
-        pass
+        cdef _NstepStage stage = self.stages.pop()
+        if stage is None:
+            return
+
+        self._push(stage,stage.nstep.on_episode_end())
+        kwargs = self._pop(stage)
+        if kwargs is not None:
+            self._store(kwargs)
 
     cpdef bool is_Nstep(self):
         r"""Get whether use Nstep or not
 
-        Since ``MPReplayBuffer`` doesn't supports Nstep feature,
-        return value is always ``False``.
-
         Returns
         -------
         bool
-            ``False``
+            Whether Nstep is used
         """
-        return False
+        return self.Nstep is not None
 
 
 cdef class ThreadSafePrioritizedSampler:
@@ -2264,18 +4541,24 @@ cdef class ThreadSafePrioritizedSampler:
     cdef sum_a#nychanged
     cdef min
     cdef min_a#nychanged
+    cdef sum_d#irty
+    cdef min_d#irty
+    cdef bool wide
     cdef CppThreadSafePrioritizedSampler[float]* per
 
     def __init__(self,size,alpha,eps,max_p=None,
                  sum=None,sum_a=None,
                  min=None,min_a=None,
                  ctx = None,
-                 backend = "sharedctypes"):
+                 backend = "sharedctypes",
+                 sum_d=None,min_d=None,
+                 wide=False):
         ctx = ctx or mp.get_context()
         self.size = size
         self.alpha = alpha
         self.eps = eps
         self.backend = backend
+        self.wide = wide
 
         self.max_p = max_p or RawArray(ctx, ctypes.c_float,1,self.backend)
         cdef float [:] view_max_p = self.max_p.ndarray
@@ -2284,21 +4567,32 @@ cdef class ThreadSafePrioritizedSampler:
         while pow2size < size:
             pow2size *= 2
 
-        self.sum   = sum   or RawArray(ctx, ctypes.c_float,2*pow2size-1, self.backend)
+        cdef size_t tree_size = PriorityTreeSize[float](size, self.wide)
+
+        self.sum   = sum   or RawArray(ctx, ctypes.c_float,tree_size   , self.backend)
         self.sum_a = sum_a or RawArray(ctx, ctypes.c_bool ,1           , self.backend)
-        self.min   = min   or RawArray(ctx, ctypes.c_float,2*pow2size-1, self.backend)
+        self.min   = min   or RawArray(ctx, ctypes.c_float,tree_size   , self.backend)
         self.min_a = min_a or RawArray(ctx, ctypes.c_bool ,1           , self.backend)
 
+        # Dirty leaf bitmaps for incremental tree update
+        cdef size_t dirty_size = DirtyBitmapSize(pow2size)
+        self.sum_d = sum_d or RawArray(ctx, ctypes.c_uint64, dirty_size, self.backend)
+        self.min_d = min_d or RawArray(ctx, ctypes.c_uint64, dirty_size, self.backend)
+
         cdef float [:] view_sum   = self.sum.ndarray
         cdef bool  [:] view_sum_a = self.sum_a.ndarray
         cdef float [:] view_min   = self.min.ndarray
         cdef bool  [:] view_min_a = self.min_a.ndarray
+        cdef uint64_t [:] view_sum_d = self.sum_d.ndarray
+        cdef uint64_t [:] view_min_d = self.min_d.ndarray
 
         cdef bool init = ((max_p is None) and
                           (sum   is None) and
                           (sum_a is None) and
                           (min   is None) and
-                          (min_a is None))
+                          (min_a is None) and
+                          (sum_d is None) and
+                          (min_d is None))
 
         self.per = new CppThreadSafePrioritizedSampler[float](size,alpha,
                                                               &view_max_p[0],
@@ -2307,7 +4601,10 @@ cdef class ThreadSafePrioritizedSampler:
                                                               &view_min[0],
                                                               &view_min_a[0],
                                                               init,
-                                                              eps)
+                                                              eps,
+                                                              &view_sum_d[0],
+                                                              &view_min_d[0],
+                                                              self.wide)
 
     cdef CppThreadSafePrioritizedSampler[float]* ptr(self):
         return self.per
@@ -2316,7 +4613,14 @@ cdef class ThreadSafePrioritizedSampler:
         return (ThreadSafePrioritizedSampler,
                 (self.size, self.alpha, self.eps, self.max_p,
                  self.sum, self.sum_a, self.min, self.min_a,
-                 None, self.backend))
+                 None, self.backend, self.sum_d, self.min_d, self.wide))
+
+
+cdef enum:
+    # Groups of ProcessSafeGroupLock at MPPrioritizedReplayBuffer
+    _EXPLORER = 0
+    _SAMPLER = 1
+    _UPDATER = 2
 
 
 @cython.embedsignature(True)
@@ -2329,8 +4633,14 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
 
     Notes
     -----
-    This class assumes single learner (``sample``, ``update_priorities``) and
-    multiple explorers (``add``) like Ape-X [1]_.
+    This class supports multiple learners (``sample``, ``update_priorities``)
+    and multiple explorers (``add``) like Ape-X [1]_. Every learner process
+    has its own random number generator, and ignores priority updates of
+    transitions overwritten after its own last ``sample``.
+
+    Segment trees are protected by a group lock, where explorers, samplers,
+    and updaters are admitted group by group. The same group can work
+    simultaneously, and different groups take turns so that no one starves.
 
     References
     ----------
@@ -2341,16 +4651,19 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
     cdef VectorFloat weights
     cdef VectorSize_t indexes
     cdef ThreadSafePrioritizedSampler per
-    cdef unchange_since_sample
+    cdef write_stamp
+    cdef sample_epoch
     cdef terminate
-    cdef explorer_per_count
-    cdef explorer_per_count_lock
-    cdef learner_per_ready
-    cdef explorer_per_ready
+    cdef ProcessSafeGroupLock tree_lock
+    cdef ProcessSafeGroupLock data_lock
+    cdef repair_lock
+    cdef uint64_t learner_epoch
+    cdef learner_pid
     cdef vector[size_t] idx_vec
     cdef vector[float] ps_vec
 
-    def __init__(self,size,env_dict=None,*,alpha=0.6,eps=1e-4,ctx=None,**kwargs):
+    def __init__(self,size,env_dict=None,*,alpha=0.6,eps=1e-4,ctx=None,
+                 wide_tree=False,**kwargs):
         r"""Initialize ``MPPrioritizedReplayBuffer``
 
         Parameters
@@ -2368,6 +4681,11 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
         eps : float, optional
             :math:`\epsilon` small positive constant to ensure error-less state
             will be sampled, whose default value is ``1e-4``.
+        wide_tree : bool, optional
+            If the value is ``True`` (default value is ``False``), priorities are
+            stored at segment trees whose node has 16 children packed in a cache
+            line instead of binary trees. This layout reduces cache misses for
+            very large buffer (e.g. :math:`10^7`).
 
         See Also
         --------
@@ -2385,51 +4703,39 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
         super().__init__(size,env_dict,ctx=ctx,**kwargs)
 
         self.per = ThreadSafePrioritizedSampler(size,alpha,eps,
-                                                ctx=ctx, backend=self.backend)
+                                                ctx=ctx, backend=self.backend,
+                                                wide=wide_tree)
 
         self.weights = VectorFloat()
         self.indexes = VectorSize_t()
 
-        self.unchange_since_sample = RawArray(ctx, ctypes.c_bool, size, self.backend)
-        self.unchange_since_sample[:] = True
+        # Slot i is unchanged since the last sample,
+        # iff write_stamp[i] < sample_epoch.
+        self.write_stamp = RawArray(ctx, ctypes.c_uint64, size, self.backend)
+        self.write_stamp[:] = 0
+        self.sample_epoch = RawValue(ctx, ctypes.c_uint64, 1, self.backend)
 
         self.terminate = RawValue(ctx, ctypes.c_bool,0, self.backend)
         self.terminate.value = False
 
-        self.learner_per_ready = ctx.Event()
-        self.learner_per_ready.clear()
-        self.explorer_per_ready = ctx.Event()
-        self.explorer_per_ready.set()
-        self.explorer_per_count = RawValue(ctx, ctypes.c_size_t, 0, self.backend)
-        self.explorer_per_count_lock = ctx.Lock()
+        # Trees: explorers, samplers, and updaters.
+        self.tree_lock = ProcessSafeGroupLock(3, ctx, self.backend)
+        # Data: explorers and samplers.
+        self.data_lock = ProcessSafeGroupLock(2, ctx, self.backend)
+        # Samplers repair trees one by one before concurrent search.
+        self.repair_lock = ctx.Lock()
+
+        # Sample epoch of this learner process (0: not sampled yet)
+        self.learner_epoch = 0
+        self.learner_pid = None
 
         self.idx_vec = vector[size_t]()
         self.ps_vec = vector[float]()
 
-
-    cdef void _lock_explorer_per(self) except *:
-        self.explorer_per_ready.wait() # Wait permission
-        self.learner_per_ready.clear()  # Block learner
-        with self.explorer_per_count_lock:
-            self.explorer_per_count.value += 1
-
-    cdef void _unlock_explorer_per(self) except *:
-        with self.explorer_per_count_lock:
-            self.explorer_per_count.value -= 1
-        if self.explorer_per_count.value == 0:
-            self.learner_per_ready.set()
-
-    cdef void _lock_learner_per(self) except *:
-        self.explorer_per_ready.clear()
-        self.learner_per_ready.wait()
-
-    cdef void _unlock_learner_per(self) except *:
-        self.explorer_per_ready.set()
-
-    cdef void _lock_learner_unlock_learner_per(self) except *:
-        self.explorer_ready.clear()
-        self.explorer_per_ready.set()
-        self.learner_ready.wait()
+        if self.Nstep:
+            # Priorities are staged together with transitions.
+            self.nstep_env = dict(self.env_dict,
+                                  priorities={"dtype": np.single})
 
     def add(self,*,priorities = None,**kwargs):
         r"""Add transition(s) into replay buffer.
@@ -2447,8 +4753,9 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
 
         Returns
         -------
-        int
-            The first index of stored position.
+        int or None
+            The first index of stored position. If Nstep transitions are
+            staged without being stored, ``None``.
 
         Raises
         ------
@@ -2460,8 +4767,105 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
         All values must be passed by key-value style (keyword arguments).
         It is user responsibility that all the values have the same step-size.
         """
+        if self.Nstep:
+            kwargs = self._stage(self._with_priorities(priorities,kwargs))
+            if kwargs is None:
+                return None
+            priorities = kwargs.pop("priorities")
+
+        return self._store(dict(kwargs,priorities=priorities))
+
+    def _store(self,kwargs):
+        priorities = kwargs.pop("priorities",None)
+        priorities, index, N = self._reserve(priorities,kwargs)
+        self._store_reserved(priorities,kwargs,index,N)
+        return index
+
+    def _store_reserved(self,priorities,kwargs,size_t index,size_t N):
+        self.tree_lock.acquire(_EXPLORER)
+        self._set_priorities(priorities,index,N)
+        self._write_reserved(kwargs,index,N)
+
+    def _write_reserved(self,kwargs,size_t index,size_t N):
+        # (`tree_lock` must be held, and is released before writing.)
+        self.data_lock.acquire(_EXPLORER)
+        self.tree_lock.release(_EXPLORER)
+        self._write(kwargs,index,N)
+
+    async def add_async(self,*,priorities = None,**kwargs):
+        r"""Add transition(s) without blocking event loop
+
+        Waits for locks are awaited, and data are copied at the default
+        executor of the running event loop. Locks are polled, which
+        adds up to 1 ms latency per wait under contention.
+
+        Returns
+        -------
+        int or None
+            The first index of stored position, or ``None`` when staged.
+
+        See Also
+        --------
+        MPPrioritizedReplayBuffer.add
+        """
+        if self.Nstep:
+            kwargs = self._stage(self._with_priorities(priorities,kwargs))
+            if kwargs is None:
+                return None
+            priorities = kwargs.pop("priorities")
+
+        priorities, index, N = self._reserve(priorities,kwargs)
+
+        # Once reserved, slots are written even if this coroutine is
+        # cancelled, otherwise unwritten slots would be committed.
+        store = asyncio.ensure_future(self._store_async(priorities,kwargs,
+                                                        index,N))
+        try:
+            await asyncio.shield(store)
+        except asyncio.CancelledError:
+            while not store.done():
+                try:
+                    await asyncio.shield(store)
+                except asyncio.CancelledError:
+                    pass
+            raise
+        return index
+
+    async def _store_async(self,priorities,kwargs,size_t index,size_t N):
+        # When this task itself is cancelled (e.g. at event loop shutdown),
+        # the rest is handed over to blocking calls at the executor, because
+        # committing reserved slots without data exposes stale transitions.
+        loop = asyncio.get_running_loop()
+
+        try:
+            await self.tree_lock.acquire_async(_EXPLORER)
+        except asyncio.CancelledError:
+            loop.run_in_executor(None, self._store_reserved,
+                                 priorities, kwargs, index, N)
+            raise
+
+        self._set_priorities(priorities,index,N)
+        try:
+            await self.data_lock.acquire_async(_EXPLORER)
+        except asyncio.CancelledError:
+            # `tree_lock` is kept until `data_lock` is acquired, so that
+            # samplers don't draw the reserved slots before they are written.
+            loop.run_in_executor(None, self._write_reserved, kwargs, index, N)
+            raise
+        self.tree_lock.release(_EXPLORER)
+
+        # `_write` releases lock, even if this coroutine is cancelled.
+        await loop.run_in_executor(None, self._write, kwargs, index, N)
+
+    def _with_priorities(self,priorities,kwargs):
+        # Same as `priorities_nstep` at `PrioritizedReplayBuffer`
+        if priorities is None:
+            priorities = np.full(self.size_check.step_size(kwargs),
+                                 self.get_max_priority(),dtype=np.single)
+        return dict(kwargs,priorities=priorities)
+
+    def _reserve(self,priorities,kwargs):
         cdef size_t N = self.size_check.step_size(kwargs)
-        cdef const float [:] ps
 
         if priorities is not None:
             priorities = np.ravel(np.array(priorities, ndmin=1, dtype=np.single,
@@ -2469,45 +4873,45 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
             if N != priorities.shape[0]:
                 raise ValueError("`priorities` shape is incompatible")
 
-        cdef size_t index = self.index.fetch_add(N)
-        cdef size_t end = index + N
-        cdef add_idx = np.arange(index,end)
-
-        if end > self.buffer_size:
-            add_idx[add_idx >= self.buffer_size] -= self.buffer_size
-
-
-        self._lock_explorer_per()
+        return priorities, self.index.reserve(N), N
 
+    cdef void _set_priorities(self,priorities,size_t index,size_t N) except *:
+        # (`tree_lock` must be held.)
+        cdef const float [:] ps
         if priorities is not None:
-            ps = np.ravel(np.array(priorities, copy=COPY_ONLY_NECESSARY,
-                                   ndmin=1, dtype=np.single))
+            ps = priorities
             self.per.ptr().set_priorities(index,&ps[0],N,self.get_buffer_size())
         else:
             self.per.ptr().set_priorities(index,N,self.get_buffer_size())
 
+        cdef uint64_t epoch = self.sample_epoch.value
         if index+N <= self.buffer_size:
-            self.unchange_since_sample[index:index+N] = False
+            self.write_stamp[index:index+N] = epoch
         else:
-            self.unchange_since_sample[index:] = False
-            self.unchange_since_sample[:index+N-self.buffer_size] = False
-
-        self._lock_explorer()
-        self._unlock_explorer_per()
+            self.write_stamp[index:] = epoch
+            self.write_stamp[:index+N-self.buffer_size] = epoch
 
-        for name, b in self.buffer.items():
-            b[add_idx] = np.reshape(np.array(kwargs[name], ndmin=2,
-                                             copy=COPY_ONLY_NECESSARY),
-                                    self.env_dict[name]["add_shape"])
+    def _write(self,kwargs,size_t index,size_t N):
+        # Write reserved slots, then commit them and release `data_lock`.
+        cdef add_idx = np.arange(index,index+N)
+        if index+N > self.buffer_size:
+            add_idx[add_idx >= self.buffer_size] -= self.buffer_size
 
-        self._unlock_explorer()
-        return index
+        try:
+            for name, b in self.buffer.items():
+                b[add_idx] = np.reshape(np.array(kwargs[name], ndmin=2,
+                                                 copy=COPY_ONLY_NECESSARY),
+                                        self.env_dict[name]["add_shape"])
+        finally:
+            self.index.commit(index, N)
+            self.data_lock.release(_EXPLORER)
 
-    def sample(self,batch_size,beta = 0.4):
+    def sample(self,batch_size,beta = 0.4,*,out=None,keys=None,exclude=None):
         r"""Sample the stored transitions.
 
         Transitions are sampled depending on correspoinding priorities
-        with specified size. This method can be called from single learner process.
+        with specified size. This method can be called from multiple learner
+        processes simultaneously.
 
         Parameters
         ----------
@@ -2516,12 +4920,24 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
         beta : float, optional
             The exponent of weight for relaxation of importance
             sampling effect, whose default value is ``0.4``
+        out : dict of ndarray, optional
+            Preallocated arrays to store sampled transitions, ``"weights"``,
+            and ``"indexes"`` into. The shape and dtype of each array must match
+            with the corresponding returned value. Values whose key is not
+            in ``out`` are newly allocated.
+        keys : str or array like of str, optional
+            Names of returned values except ``"weights"`` and
+            ``"indexes"``, which are always returned. If ``None`` (default), all values are
+            returned. Values which are not returned are never gathered.
+        exclude : str or array like of str, optional
+            Names of values not to be returned.
 
         Returns
         -------
         dict of ndarray
             Sampled batch transitions which also includes
-            ``"weights"`` and ``"indexes"``
+            ``"weights"`` and ``"indexes"``.
+            Arrays in ``out`` are returned as they are.
 
         Notes
         -----
@@ -2530,29 +4946,151 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
         The ``weights`` are also normalized by the weight for minimum priority
         (:math:`= w_{i}/\max_{j}(w_{j})`), which ensure the weights :math:`\leq` 1.
         """
-        self._lock_learner_per()
-        self.per.ptr().sample(batch_size,beta,
-                              self.weights.vec,self.indexes.vec,
-                              self.get_stored_size())
-        cdef idx = self.indexes.as_numpy()
+        return self._sample(1,batch_size,beta,self.weights,self.indexes,out,
+                            keys,exclude)
 
-        self._lock_learner_unlock_learner_per()
+    def sample_many(self,k,batch_size,beta = 0.4):
+        r"""Sample multiple independent batches at once
 
-        samples = self._encode_sample(idx)
-        self.unchange_since_sample[:] = True
-        self._unlock_learner()
+        Each batch is sampled as ``sample`` does, but the tree is traversed
+        and weights are normalized only once for all the batches.
+
+        Parameters
+        ----------
+        k : int
+            The number of batches
+        batch_size : int
+            Batch size of each batch
+        beta : float, optional
+            The exponent of weight for relaxation of importance
+            sampling effect, whose default value is ``0.4``
+
+        Returns
+        -------
+        sample : dict of ndarray
+            Sampled batches stacked with shape ``(k, batch_size, ...)``, which
+            also includes ``"weights"`` and ``"indexes"``.
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.sample_many
+        """
+        return split_batches(self._sample(k,batch_size,beta,
+                                          VectorFloat(),VectorSize_t(),None),k)
+
+    cdef _sample(self,size_t k,size_t batch_size,float beta,
+                 VectorFloat weights,VectorSize_t indexes,out,
+                 keys=None,exclude=None):
+        self.tree_lock.acquire(_SAMPLER)
+        cdef idx = self._draw(k,batch_size,beta,weights,indexes)
+        self.data_lock.acquire(_SAMPLER)
+        self.tree_lock.release(_SAMPLER)
+
+        samples = self._encode_locked(idx,out,keys,exclude)
+        samples['weights'] = copy_into(weights.as_numpy(),out,'weights')
+        samples['indexes'] = copy_into(idx,out,'indexes')
+
+        return samples
+
+    async def sample_async(self,batch_size,beta = 0.4,*,keys=None,exclude=None):
+        r"""Sample the stored transitions without blocking event loop
+
+        Waits for locks are awaited, and data are copied at the default
+        executor of the running event loop. Locks are polled, which
+        adds up to 1 ms latency per wait under contention.
+
+        Returns
+        -------
+        dict of ndarray
+            Sampled batch transitions which also includes
+            ``"weights"`` and ``"indexes"``.
 
-        samples['weights'] = self.weights.as_numpy()
+        See Also
+        --------
+        MPPrioritizedReplayBuffer.sample
+        """
+        weights = VectorFloat()
+        indexes = VectorSize_t()
+
+        await self.tree_lock.acquire_async(_SAMPLER)
+        try:
+            idx = self._draw(1,batch_size,beta,weights,indexes)
+            await self.data_lock.acquire_async(_SAMPLER)
+        finally:
+            self.tree_lock.release(_SAMPLER)
+
+        # `_encode_locked` releases lock, even if this coroutine is cancelled.
+        samples = await asyncio.get_running_loop().run_in_executor(
+            None, self._encode_locked, idx, None, keys, exclude)
+        samples['weights'] = weights.as_numpy()
         samples['indexes'] = idx
 
         return samples
 
+    async def update_priorities_async(self,indexes,priorities):
+        r"""Update priorities without blocking event loop
+
+        See Also
+        --------
+        MPPrioritizedReplayBuffer.update_priorities
+        """
+        if priorities is None:
+            raise TypeError("`properties` must not be `None`")
+
+        idx = Csize(indexes)
+        ps = Cfloat(priorities)
+
+        if idx.shape[0] == 0:
+            return None
+
+        await self.tree_lock.acquire_async(_UPDATER)
+        try:
+            self._update_priorities(idx,ps)
+        finally:
+            self.tree_lock.release(_UPDATER)
+
+    def _encode_locked(self,idx,out,keys,exclude):
+        # Encode sample, then release `data_lock`.
+        try:
+            return self._encode_sample(idx,out,keys,exclude)
+        finally:
+            self.data_lock.release(_SAMPLER)
+
+    cdef _draw(self,size_t k,size_t batch_size,float beta,
+               VectorFloat weights,VectorSize_t indexes):
+        # Sample indexes. (`tree_lock` must be held.)
+
+        # A forked learner must not share random sequence with its parent.
+        cdef pid = os.getpid()
+        if self.learner_pid != pid:
+            self.per.ptr().seed()
+            self.learner_pid = pid
+
+        with self.repair_lock:
+            self.per.ptr().update_changed()
+
+            # Transitions written after here are newer than this sample.
+            self.sample_epoch.value += 1
+            self.learner_epoch = self.sample_epoch.value
+
+        if k == 1:
+            self.per.ptr().sample(batch_size,beta,weights.vec,indexes.vec,
+                                  self.get_stored_size())
+        else:
+            self.per.ptr().sample_many(k,batch_size,beta,
+                                       weights.vec,indexes.vec,
+                                       self.get_stored_size())
+        return indexes.as_numpy()
+
     def update_priorities(self,indexes,priorities):
         r"""Update priorities
 
         Update priorities specified with indicies. Ignores indices
         which updated values after the last calling of ``sample()``
-        method. This method can be called from single learner process.
+        method in this process. This method can be called from multiple
+        learner processes simultaneously.
+        When ``indexes`` contains duplicated indices, the last priority
+        is used.
 
         Parameters
         ----------
@@ -2573,23 +5111,29 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
         cdef const size_t [:] idx = Csize(indexes)
         cdef const float [:] ps = Cfloat(priorities)
 
-        self.idx_vec.clear()
-        self.idx_vec.reserve(idx.shape[0])
-
-        self.ps_vec.clear()
-        self.ps_vec.reserve(ps.shape[0])
-
-        self._lock_learner_per()
-        cdef size_t stored_size = self.get_stored_size()
-        for _i in range(idx.shape[0]):
-            if idx[_i] < stored_size and self.unchange_since_sample[idx[_i]]:
-                self.idx_vec.push_back(idx[_i])
-                self.ps_vec.push_back(ps[_i])
+        if idx.shape[0] == 0:
+            return None
 
-        cdef N = self.idx_vec.size()
+        self.tree_lock.acquire(_UPDATER)
+        try:
+            self._update_priorities(idx,ps)
+        finally:
+            self.tree_lock.release(_UPDATER)
+
+    cdef void _update_priorities(self,const size_t [:] idx,
+                                 const float [:] ps) except *:
+        # (`tree_lock` must be held.)
+        cdef const uint64_t [:] stamp = self.write_stamp.ndarray
+
+        # Process which has never sampled, falls back to the latest sample.
+        cdef uint64_t epoch = self.learner_epoch or self.sample_epoch.value
+        cdef size_t N = FilterUnchangedSinceSample(&idx[0],&ps[0],idx.shape[0],
+                                                   &stamp[0],
+                                                   epoch,
+                                                   self.get_stored_size(),
+                                                   self.idx_vec,self.ps_vec)
         if N > 0:
             self.per.ptr().update_priorities(self.idx_vec.data(),self.ps_vec.data(),N)
-        self._unlock_learner_per()
 
     cpdef void clear(self) except *:
         r"""Clear replay buffer
@@ -2607,17 +5151,6 @@ cdef class MPPrioritizedReplayBuffer(MPReplayBuffer):
         """
         return self.per.ptr().get_max_priority()
 
-    cpdef void on_episode_end(self) except *:
-        r"""Call on episode end
-
-        Notes
-        -----
-        Calling this function at episode end is the user responsibility,
-        since episode exploration can be terminated at certain length
-        even though any ``done`` flags from environment is not set.
-        """
-        pass
-
 
 @cython.embedsignature(True)
 def create_buffer(size,env_dict=None,*,prioritized = False,**kwargs):
@@ -14,6 +14,13 @@
 #include <memory>
 #include <mutex>
 #include <numeric>
+#include <variant>
+#include <cstdint>
+#include <cstdlib>
+#include <cstring>
+#include <thread>
+#include <condition_variable>
+#include <algorithm>
 
 #include "SegmentTree.hh"
 
@@ -145,6 +152,14 @@ namespace ymd {
       auto tmp = v->load(std::memory_order_acquire);
       while(tmp < N &&  !v->compare_exchange_weak(tmp,N)){}
     }
+    template<typename F>
+    static inline auto fetch_update(volatile type* v, F&& f){
+      auto tmp = v->load(std::memory_order_acquire);
+      while(!v->compare_exchange_weak(tmp,f(tmp),
+                                      std::memory_order_acq_rel,
+                                      std::memory_order_acquire)){}
+      return tmp;
+    }
   };
 
   template<typename T> struct ThreadSafe<false,T>{
@@ -161,8 +176,162 @@ namespace ymd {
     static inline auto store_max(T* v, T N){
       if(*v < N){ *v = N; }
     }
+    template<typename F>
+    static inline auto fetch_update(T* v, F&& f){
+      return std::exchange(*v,f(*v));
+    }
+  };
+
+  template<bool MultiThread = false>
+  class CppRingBufferIndex {
+    // Next index and "is full" flag are packed into a single word (the flag
+    // is the highest bit), so that they are always updated together by a
+    // single atomic operation. The word can be placed on shared memory.
+  private:
+    using ThreadSafe_t = ThreadSafe<MultiThread, std::size_t>;
+    static constexpr const std::size_t full_bit = ~(~std::size_t(0) >> 1);
+    std::size_t buffer_size;
+    typename ThreadSafe_t::type* word;
+    std::shared_ptr<typename ThreadSafe_t::type> view;
+  public:
+    CppRingBufferIndex(std::size_t buffer_size,
+                       std::size_t* word_ptr = nullptr,
+                       bool initialize = true)
+      : buffer_size{buffer_size},
+        word{(typename ThreadSafe_t::type*)word_ptr},
+        view{}
+    {
+      if(!word){
+        word = new typename ThreadSafe_t::type{};
+        view.reset(word);
+      }
+      if(initialize){ clear(); }
+    }
+    CppRingBufferIndex(): CppRingBufferIndex{1} {}
+    CppRingBufferIndex(const CppRingBufferIndex&) = default;
+    CppRingBufferIndex(CppRingBufferIndex&&) = default;
+    CppRingBufferIndex& operator=(const CppRingBufferIndex&) = default;
+    CppRingBufferIndex& operator=(CppRingBufferIndex&&) = default;
+    ~CppRingBufferIndex() = default;
+
+    std::size_t fetch_add(std::size_t N){
+      // Add then return original index
+      const auto w = ThreadSafe_t::fetch_update(word, [=](auto w){
+        const auto next = (w & ~full_bit) + N;
+        const auto full = (w & full_bit) | ((next >= buffer_size) ? full_bit : 0);
+        return (next % buffer_size) | full;
+      });
+      return w & ~full_bit;
+    }
+
+    std::size_t get_next_index() const {
+      return ThreadSafe_t::load(word, std::memory_order_acquire) & ~full_bit;
+    }
+
+    std::size_t get_stored_size() const {
+      const auto w = ThreadSafe_t::load(word, std::memory_order_acquire);
+      return (w & full_bit) ? buffer_size : w;
+    }
+
+    void clear(){
+      ThreadSafe_t::store(word, std::size_t(0), std::memory_order_release);
+    }
+  };
+
+  using CppThreadSafeRingBufferIndex = CppRingBufferIndex<true>;
+
+  template<bool MultiThread = false>
+  class CppSlotSequence {
+    // Per-slot sequence numbers to publish slots without lock (seqlock).
+    // The lower 32 bits count in-flight writers and the upper 32 bits count
+    // commits. A reader accepts a slot only when it has been committed, no
+    // writer is in-flight, and its sequence is unchanged during the read.
+    // (Even when explorers lap each other and write the same slot at the
+    // same time, readers never accept it during writing.)
+  private:
+    using ThreadSafe_t = ThreadSafe<MultiThread, std::uint64_t>;
+    static constexpr const std::uint64_t writer = 1;
+    static constexpr const std::uint64_t version = std::uint64_t(1) << 32;
+    static constexpr const std::uint64_t writer_mask = version - 1;
+    std::size_t buffer_size;
+    typename ThreadSafe_t::type* seq;
+    std::shared_ptr<typename ThreadSafe_t::type[]> view;
+
+    template<typename F>
+    void for_range(std::size_t index, std::size_t N, F&& f){
+      N = std::min(N, buffer_size);
+      for(auto k = std::size_t(0); k < N; ++k){
+        f(seq + (index + k) % buffer_size);
+      }
+    }
+
+  public:
+    CppSlotSequence(std::size_t buffer_size,
+                    std::uint64_t* seq_ptr = nullptr,
+                    bool initialize = true)
+      : buffer_size{buffer_size},
+        seq{(typename ThreadSafe_t::type*)seq_ptr},
+        view{}
+    {
+      if(!seq){
+        seq = new typename ThreadSafe_t::type[buffer_size]{};
+        view.reset(seq);
+      }
+      if(initialize){
+        std::for_each(seq, seq + buffer_size, [](auto& s){
+          ThreadSafe_t::store(&s, std::uint64_t(0), std::memory_order_release);
+        });
+      }
+    }
+    CppSlotSequence(): CppSlotSequence{1} {}
+    CppSlotSequence(const CppSlotSequence&) = default;
+    CppSlotSequence(CppSlotSequence&&) = default;
+    CppSlotSequence& operator=(const CppSlotSequence&) = default;
+    CppSlotSequence& operator=(CppSlotSequence&&) = default;
+    ~CppSlotSequence() = default;
+
+    void reserve(std::size_t index, std::size_t N){
+      // Mark slots [index, index+N) (wrapped around) as writing.
+      for_range(index, N, [](auto s){
+        ThreadSafe_t::fetch_add(s, writer, std::memory_order_relaxed);
+      });
+      std::atomic_thread_fence(std::memory_order_release);
+    }
+
+    void commit(std::size_t index, std::size_t N){
+      // Publish slots [index, index+N) (wrapped around).
+      for_range(index, N, [](auto s){
+        ThreadSafe_t::fetch_add(s, version - writer, std::memory_order_release);
+      });
+    }
+
+    template<typename I>
+    void load(const I* indexes, std::size_t N, std::uint64_t* out) const {
+      // Snapshot sequences before reading slots.
+      for(auto k = std::size_t(0); k < N; ++k){
+        out[k] = ThreadSafe_t::load(seq + indexes[k], std::memory_order_acquire);
+      }
+    }
+
+    template<typename I>
+    std::size_t validate(const I* indexes, std::size_t N,
+                         const std::uint64_t* before, bool* ok) const {
+      // Check slots have been committed during read, after reading slots.
+      std::atomic_thread_fence(std::memory_order_acquire);
+
+      auto n = std::size_t(0);
+      for(auto k = std::size_t(0); k < N; ++k){
+        const auto after = ThreadSafe_t::load(seq + indexes[k],
+                                              std::memory_order_relaxed);
+        ok[k] = (before[k] != 0) && !(before[k] & writer_mask) && (before[k] == after);
+        n += ok[k];
+      }
+      return n;
+    }
   };
 
+  using CppThreadSafeSlotSequence = CppSlotSequence<true>;
+
   template<typename Observation, typename Action, typename Reward, typename Done>
   class CppSelectiveEnvironment :public Environment<Observation, Action, Reward, Done>{
   public:
@@ -306,28 +475,74 @@ namespace ymd {
     typename ThreadSafePriority_t::type* max_priority;
     std::shared_ptr<typename ThreadSafePriority_t::type> max_priority_view;
     const Priority default_max_priority;
-    SegmentTree<Priority, MultiThread> sum;
-    SegmentTree<Priority, MultiThread> min;
+    // Binary (default) or wide node (cache-friendly for huge buffer) layout
+    std::variant<SumTree<Priority, MultiThread>,
+                 WideSumTree<Priority, MultiThread>> sum;
+    std::variant<MinTree<Priority, MultiThread>,
+                 WideMinTree<Priority, MultiThread>> min;
     std::mt19937 g;
     Priority eps;
+    std::vector<Priority> masses;
+    std::vector<Priority> values;
+    std::vector<std::size_t> found;
+    std::vector<std::size_t> order;
 
     void sample_proportional(std::size_t batch_size,
                              std::vector<std::size_t>& indexes,
                              std::size_t stored_size){
-      indexes.resize(0);
-      indexes.reserve(batch_size);
+      indexes.resize(batch_size);
+      masses.resize(batch_size);
 
-      auto every_range_len
-        = Priority{1.0} * sum.reduce(0, stored_size) / batch_size;
+      std::visit([&](auto& sum){
+        auto every_range_len
+          = Priority{1.0} * sum.reduce(0, stored_size) / batch_size;
 
-      std::generate_n(std::back_inserter(indexes),batch_size,
+        // Stratified masses are sorted, so that all of them can be searched
+        // at a single tree descent.
+        std::generate(masses.begin(), masses.end(),
                       [=,i=std::size_t(0),
                        d=std::uniform_real_distribution<Priority>{}]()mutable{
-                        auto mass = (d(this->g) + (i++))*every_range_len;
-                        return this->sum.largest_region_index([=](auto v){
-                          return v <= mass;
-                        }, stored_size);
+                        return (d(this->g) + (i++))*every_range_len;
                       });
+
+        sum.largest_region_indexes(masses.begin(), masses.end(), indexes.begin(),
+                                   stored_size);
+      }, sum);
+    }
+
+    void sample_proportional(std::size_t k, std::size_t batch_size,
+                             std::vector<std::size_t>& indexes,
+                             std::size_t stored_size){
+      const auto N = k * batch_size;
+      indexes.resize(N);
+      masses.resize(N);
+      found.resize(N);
+      order.resize(N);
+
+      std::visit([&](auto& sum){
+        auto every_range_len
+          = Priority{1.0} * sum.reduce(0, stored_size) / batch_size;
+        auto d = std::uniform_real_distribution<Priority>{};
+
+        // Masses are grouped by stratum and sorted, so that all batches are
+        // searched at a single tree descent. Each batch takes a random one
+        // in every stratum, which keeps batches independent.
+        for(std::size_t i = 0; i < batch_size; ++i){
+          auto m = masses.begin() + i*k;
+          std::generate(m, m+k, [&](){ return (d(this->g) + i)*every_range_len; });
+          std::sort(m, m+k);
+
+          auto o = order.begin() + i*k;
+          std::iota(o, o+k, std::size_t(0));
+          std::shuffle(o, o+k, this->g);
+          std::transform(o, o+k, o, [=](auto j){ return j*batch_size + i; });
+        }
+
+        sum.largest_region_indexes(masses.begin(), masses.end(), found.begin(),
+                                   stored_size);
+      }, sum);
+
+      for(std::size_t n = 0; n < N; ++n){ indexes[order[n]] = found[n]; }
     }
 
     void set_weights(const std::vector<std::size_t>& indexes,Priority beta,
@@ -335,29 +550,47 @@ namespace ymd {
       weights.resize(0);
       weights.reserve(indexes.size());
 
-      auto b_size = stored_size;
-      auto inv_sum = Priority{1.0} / sum.reduce(0,b_size);
-      auto p_min = min.reduce(0,b_size) * inv_sum;
-      auto inv_max_weight = Priority{1.0} / std::pow(p_min * b_size,-beta);
+      std::visit([&](auto& sum, auto& min){
+        auto b_size = stored_size;
+        auto inv_sum = Priority{1.0} / sum.reduce(0,b_size);
+        auto p_min = min.reduce(0,b_size) * inv_sum;
+        auto inv_max_weight = Priority{1.0} / std::pow(p_min * b_size,-beta);
 
-      std::transform(indexes.begin(), indexes.end(), std::back_inserter(weights),
-                     [=](auto idx){
-                       auto p_sample = this->sum.get(idx) * inv_sum;
-                       return std::pow(p_sample*b_size,-beta)*inv_max_weight;
-                     });
+        std::transform(indexes.begin(), indexes.end(), std::back_inserter(weights),
+                       [=,&sum](auto idx){
+                         auto p_sample = sum.get(idx) * inv_sum;
+                         return std::pow(p_sample*b_size,-beta)*inv_max_weight;
+                       });
+      }, sum, min);
     }
 
     template<typename F>
     void set_priorities(std::size_t next_index, F&& f,
                         std::size_t N, std::size_t buffer_size){
-      sum.set(next_index, std::forward<F>(f), N, buffer_size);
-      min.set(next_index, std::forward<F>(f), N, buffer_size);
+      std::visit([&](auto& sum, auto& min){
+        sum.set(next_index, f, N, buffer_size);
+        min.set(next_index, f, N, buffer_size);
+      }, sum, min);
     }
 
     void set_priority(std::size_t next_index, Priority p){
       auto v = std::pow(p+eps,alpha);
-      sum.set(next_index,v);
-      min.set(next_index,v);
+      std::visit([=](auto& sum, auto& min){
+        sum.set(next_index,v);
+        min.set(next_index,v);
+      }, sum, min);
+    }
+
+    template<typename Tree, typename BinaryTree, typename WideTree, typename Op>
+    static Tree make_tree(bool wide, std::size_t buffer_size, Priority v,
+                          Priority* ptr, bool* anychanged, bool initialize,
+                          std::uint64_t* dirty){
+      if(wide){
+        return Tree{std::in_place_type<WideTree>,
+                    buffer_size, Op{}, v, ptr, anychanged, initialize, dirty};
+      }
+      return Tree{std::in_place_type<BinaryTree>,
+                  PowerOf2(buffer_size), Op{}, v, ptr, anychanged, initialize, dirty};
     }
 
   public:
@@ -368,23 +601,36 @@ namespace ymd {
                           Priority* min_ptr = nullptr,
                           bool* min_anychanged = nullptr,
                           bool initialize = true,
-                          Priority eps = Priority{1e-4})
+                          Priority eps = Priority{1e-4},
+                          std::uint64_t* sum_dirty = nullptr,
+                          std::uint64_t* min_dirty = nullptr,
+                          bool wide = false)
       : alpha{alpha},
         max_priority{(typename ThreadSafePriority_t::type*)max_p},
         max_priority_view{},
         default_max_priority{1.0},
         sum{
-          PowerOf2(buffer_size), [](auto a,auto b){ return a+b; },
-          Priority{0},
-          sum_ptr, sum_anychanged, initialize
+          make_tree<decltype(sum),
+                    SumTree<Priority, MultiThread>,
+                    WideSumTree<Priority, MultiThread>,
+                    SumOp<Priority>>(
+                      wide, buffer_size, Priority{0},
+                      sum_ptr, sum_anychanged, initialize, sum_dirty)
         },
         min{
-          PowerOf2(buffer_size), [](Priority a,Priority b){ return std::min(a,b); },
-          std::numeric_limits<Priority>::max(),
-          min_ptr,min_anychanged,initialize
+          make_tree<decltype(min),
+                    MinTree<Priority, MultiThread>,
+                    WideMinTree<Priority, MultiThread>,
+                    MinOp<Priority>>(
+                      wide, buffer_size, std::numeric_limits<Priority>::max(),
+                      min_ptr, min_anychanged, initialize, min_dirty)
         },
         g{std::random_device{}()},
-        eps{eps}
+        eps{eps},
+        masses{},
+        values{},
+        found{},
+        order{}
     {
       if(!max_priority){
         max_priority = new typename ThreadSafePriority_t::type{};
@@ -408,11 +654,41 @@ namespace ymd {
       sample_proportional(batch_size,indexes,stored_size);
       set_weights(indexes,beta,weights,stored_size);
     }
+
+    void sample_many(std::size_t k,std::size_t batch_size,Priority beta,
+                     std::vector<Priority>& weights,
+                     std::vector<std::size_t>& indexes,
+                     std::size_t stored_size){
+      // k independent batches laid out batch-major, whose weights are
+      // normalized by the same reductions.
+      sample_proportional(k,batch_size,indexes,stored_size);
+      set_weights(indexes,beta,weights,stored_size);
+    }
+
+    void update_changed(){
+      // Repair trees in advance, so that the following sample() only reads
+      // them and can run concurrently with other samplers.
+      std::visit([](auto& sum, auto& min){
+        sum.update_changed();
+        min.update_changed();
+      }, sum, min);
+    }
+
+    void seed(std::uint32_t s){
+      g.seed(s);
+    }
+
+    void seed(){
+      seed(std::random_device{}());
+    }
+
     virtual void clear(){
       ThreadSafePriority_t::store(max_priority,default_max_priority,
                                   std::memory_order_release);
-      sum.clear();
-      min.clear(std::numeric_limits<Priority>::max());
+      std::visit([](auto& sum, auto& min){
+        sum.clear();
+        min.clear(std::numeric_limits<Priority>::max());
+      }, sum, min);
     }
 
     Priority get_max_priority() const {
@@ -459,20 +735,23 @@ namespace ymd {
              std::enable_if_t<std::is_convertible_v<P,Priority>,
                               std::nullptr_t> = nullptr>
     void update_priorities(I* indexes, P* priorities, std::size_t N = 1){
+      if(!N){ return; }
+
+      // Transform all priorities at first in a contiguous loop, then write
+      // them to the trees in bulk, where shared ancestors are updated once.
+      values.resize(N);
+      std::transform(priorities, priorities+N, values.begin(),
+                     [a=alpha, e=eps](auto p){
+                       return std::pow(Priority(p) + e, a);
+                     });
 
-      const auto max_p =
-        std::accumulate(indexes,indexes+N,
-                        ThreadSafePriority_t::load(max_priority,
-                                                   std::memory_order_acquire),
-                        [=,p=priorities]
-                        (auto max_p, auto index) mutable {
-                          Priority v = std::pow(*p + this->eps, this->alpha);
-                          this->sum.set(index,v);
-                          this->min.set(index,v);
+      std::visit([&](auto& sum, auto& min){
+        sum.scatter(indexes, values.data(), N);
+        min.scatter(indexes, values.data(), N);
+      }, sum, min);
 
-                          return std::max<Priority>(max_p, *(p++));
-                        });
-      ThreadSafePriority_t::store_max(max_priority, max_p);
+      ThreadSafePriority_t::store_max(max_priority,
+                                      *std::max_element(priorities, priorities+N));
     }
 
     template<typename I,typename P,
@@ -494,5 +773,302 @@ namespace ymd {
 
   template<typename Priority>
   using CppThreadSafePrioritizedSampler = CppPrioritizedSampler<Priority,true>;
+
+  template<typename Priority>
+  inline std::size_t PriorityTreeSize(std::size_t buffer_size, bool wide){
+    // Memory size of a segment tree in CppPrioritizedSampler
+    return wide ? WideTreeSize<Priority>(buffer_size) : 2*PowerOf2(buffer_size)-1;
+  }
+
+  template<typename Index, typename Priority, typename Stamp>
+  inline std::size_t FilterUnchangedSinceSample(const Index* indexes,
+                                                const Priority* priorities,
+                                                std::size_t N,
+                                                const Stamp* write_stamp,
+                                                Stamp sample_epoch,
+                                                std::size_t stored_size,
+                                                std::vector<std::size_t>& out_indexes,
+                                                std::vector<Priority>& out_priorities){
+    // Keep (index, priority) pairs whose slot is stored and has not been
+    // written since the last sample (write_stamp < sample_epoch).
+    // Pairs are always copied and the output position is advanced only for
+    // valid ones, so that the loop has no data dependent branch.
+    out_indexes.resize(N);
+    out_priorities.resize(N);
+
+    auto n = std::size_t(0);
+    for(auto k = std::size_t(0); k < N; ++k){
+      const std::size_t i = indexes[k];
+      out_indexes[n] = i;
+      out_priorities[n] = priorities[k];
+      n += (i < stored_size) && (write_stamp[i] < sample_epoch);
+    }
+
+    out_indexes.resize(n);
+    out_priorities.resize(n);
+    return n;
+  }
+
+  template<typename Error, typename Priority>
+  inline void SequencePriorities(const Error* errors, const bool* mask,
+                                 std::size_t N, std::size_t T, Priority eta,
+                                 Priority* out){
+    // Sequence priority of R2D2: eta * max|error| + (1 - eta) * mean|error|
+    // over valid steps. When mask is nullptr, all the steps are valid.
+    for(auto n = std::size_t(0); n < N; ++n){
+      auto max = Priority(0);
+      auto sum = Priority(0);
+      auto count = std::size_t(0);
+      for(auto t = n*T; t < (n+1)*T; ++t){
+        const bool valid = !mask || mask[t];
+        const auto e = valid ? Priority(std::abs(errors[t])) : Priority(0);
+        max = std::max(max, e);
+        sum += e;
+        count += valid;
+      }
+      out[n] = count ? eta * max + (1 - eta) * sum / count : Priority(0);
+    }
+  }
+
+  class CppGather {
+    // Gather rows of (possibly strided) buffers into dense outputs.
+    // Memory layouts are analyzed once at add_field(), and every row is
+    // copied by a few contiguous or strided loops.
+  private:
+    struct Dim {
+      std::size_t n;
+      std::ptrdiff_t src;
+      std::ptrdiff_t dst;
+    };
+
+    struct Field {
+      const char* src;
+      std::size_t rows;
+      std::ptrdiff_t row_stride;
+      std::size_t shift;
+      std::size_t itemsize;
+      std::size_t row_bytes;
+      std::vector<Dim> dims;
+    };
+
+    class Workers {
+      // Persistent threads running tasks 1, ..., n-1 of each job, while the
+      // caller runs task 0.
+    private:
+      std::vector<std::thread> threads;
+      std::mutex m;
+      std::condition_variable start;
+      std::condition_variable done;
+      std::function<void(std::size_t)> job;
+      std::size_t n_tasks;
+      std::size_t remaining;
+      std::size_t generation;
+      bool stop;
+
+      void loop(std::size_t task){
+        auto seen = std::size_t(0);
+        auto lock = std::unique_lock<std::mutex>{m};
+        while(true){
+          start.wait(lock, [&](){ return stop || (generation != seen); });
+          if(stop){ return; }
+          seen = generation;
+          if(task >= n_tasks){ continue; }
+
+          auto f = job;
+          lock.unlock();
+          f(task);
+          lock.lock();
+          if(--remaining == 0){ done.notify_one(); }
+        }
+      }
+
+    public:
+      explicit Workers(std::size_t n)
+        : threads{}, m{}, start{}, done{}, job{},
+          n_tasks{0}, remaining{0}, generation{0}, stop{false} {
+        threads.reserve(n);
+        for(auto t = std::size_t(1); t <= n; ++t){
+          threads.emplace_back([this, t](){ this->loop(t); });
+        }
+      }
+      Workers(const Workers&) = delete;
+      Workers& operator=(const Workers&) = delete;
+      ~Workers(){
+        {
+          auto lock = std::lock_guard<std::mutex>{m};
+          stop = true;
+        }
+        start.notify_all();
+        for(auto& t: threads){ t.join(); }
+      }
+
+      std::size_t size() const { return threads.size(); }
+
+      template<typename F>
+      void run(std::size_t n, F&& f){
+        {
+          auto lock = std::lock_guard<std::mutex>{m};
+          job = f;
+          n_tasks = n;
+          remaining = n - 1;
+          ++generation;
+        }
+        start.notify_all();
+
+        f(std::size_t(0));
+
+        auto lock = std::unique_lock<std::mutex>{m};
+        done.wait(lock, [&](){ return remaining == 0; });
+        job = nullptr;
+      }
+    };
+
+    std::vector<Field> fields;
+    std::size_t bytes_per_index;
+
+    // Threads are kept over gather calls. Concurrent calls don't wait for
+    // the workers being used, but gather by themselves.
+    mutable std::unique_ptr<Workers> workers;
+    mutable std::mutex workers_mutex;
+
+    template<typename T>
+    static void strided_copy(const char* src, char* dst, const Dim& d){
+      for(auto i = std::size_t(0); i < d.n; ++i, src += d.src, dst += d.dst){
+        T v;
+        std::memcpy(&v, src, sizeof(T));
+        std::memcpy(dst, &v, sizeof(T));
+      }
+    }
+
+    static void copy_inner(const char* src, char* dst, const Dim& d,
+                           std::size_t itemsize){
+      if((d.src == std::ptrdiff_t(itemsize)) && (d.dst == std::ptrdiff_t(itemsize))){
+        std::memcpy(dst, src, d.n * itemsize);
+        return;
+      }
+
+      switch(itemsize){
+      case 1: strided_copy<std::uint8_t>(src, dst, d); break;
+      case 2: strided_copy<std::uint16_t>(src, dst, d); break;
+      case 4: strided_copy<std::uint32_t>(src, dst, d); break;
+      case 8: strided_copy<std::uint64_t>(src, dst, d); break;
+      default:
+        for(auto i = std::size_t(0); i < d.n; ++i){
+          std::memcpy(dst + i*d.dst, src + i*d.src, itemsize);
+        }
+      }
+    }
+
+    static void copy_row(const Field& f, std::size_t d,
+                         const char* src, char* dst){
+      const auto& dim = f.dims[d];
+      if(d + 1 == f.dims.size()){
+        copy_inner(src, dst, dim, f.itemsize);
+        return;
+      }
+
+      for(auto i = std::size_t(0); i < dim.n; ++i, src += dim.src, dst += dim.dst){
+        copy_row(f, d+1, src, dst);
+      }
+    }
+
+    template<typename Index>
+    void gather_range(const Index* indexes, std::size_t first, std::size_t last,
+                      void* const* outputs) const {
+      for(auto k = std::size_t(0); k < fields.size(); ++k){
+        if(!outputs[k]){ continue; }
+        const auto& f = fields[k];
+        auto dst = static_cast<char*>(outputs[k]) + first * f.row_bytes;
+        for(auto b = first; b < last; ++b, dst += f.row_bytes){
+          auto row = std::size_t(indexes[b]) + f.shift;
+          if(row >= f.rows){ row -= f.rows; }
+          copy_row(f, 0, f.src + std::ptrdiff_t(row) * f.row_stride, dst);
+        }
+      }
+    }
+
+  public:
+    CppGather(): fields{}, bytes_per_index{0}, workers{}, workers_mutex{} {}
+
+    std::size_t add_field(const void* src, std::size_t rows,
+                          std::ptrdiff_t row_stride, std::size_t itemsize,
+                          std::size_t ndim, const std::size_t* shape,
+                          const std::ptrdiff_t* strides,
+                          const std::ptrdiff_t* dst_strides,
+                          std::size_t shift = 0){
+      // shape / strides / dst_strides are those of a single row (without the
+      // first axis). Output rows are dense, so that `dst_strides` must be a
+      // permutation of C-contiguous strides.
+      auto f = Field{static_cast<const char*>(src), rows, row_stride, shift,
+                     itemsize, itemsize, {}};
+
+      for(auto d = std::size_t(0); d < ndim; ++d){
+        if(shape[d] != 1){
+          f.dims.push_back(Dim{shape[d], strides[d], dst_strides[d]});
+        }
+        f.row_bytes *= shape[d];
+      }
+      std::sort(f.dims.begin(), f.dims.end(),
+                [](auto& a, auto& b){ return a.dst > b.dst; });
+
+      // Merge dimensions contiguous at both source and destination.
+      auto merged = std::vector<Dim>{};
+      for(const auto& d: f.dims){
+        if(!merged.empty() &&
+           (merged.back().src == d.src * std::ptrdiff_t(d.n)) &&
+           (merged.back().dst == d.dst * std::ptrdiff_t(d.n))){
+          merged.back() = Dim{merged.back().n * d.n, d.src, d.dst};
+        }else{
+          merged.push_back(d);
+        }
+      }
+      if(merged.empty()){
+        merged.push_back(Dim{1, std::ptrdiff_t(itemsize), std::ptrdiff_t(itemsize)});
+      }
+
+      // Read the most contiguous source dimension at the innermost loop.
+      auto inner = std::min_element(merged.begin(), merged.end(),
+                                    [](auto& a, auto& b){
+                                      return std::abs(a.src) < std::abs(b.src);
+                                    });
+      std::rotate(inner, inner+1, merged.end());
+
+      f.dims = std::move(merged);
+      bytes_per_index += f.row_bytes;
+      fields.push_back(std::move(f));
+      return fields.size() - 1;
+    }
+
+    std::size_t size() const { return fields.size(); }
+
+    // outputs[k] is the destination of k-th field. Field with nullptr is skipped.
+    template<typename Index>
+    void gather(const Index* indexes, std::size_t N, void* const* outputs,
+                std::size_t n_threads = 1) const {
+      // Small gather doesn't pay for launching threads.
+      constexpr const std::size_t min_bytes_per_thread = std::size_t(1) << 18;
+      n_threads = std::max(std::size_t(1),
+                           std::min({n_threads, N,
+                                     N * bytes_per_index / min_bytes_per_thread}));
+
+      auto lock = std::unique_lock<std::mutex>{workers_mutex, std::defer_lock};
+      if((n_threads == 1) || !lock.try_lock()){
+        gather_range(indexes, 0, N, outputs);
+        return;
+      }
+
+      if(!workers || (workers->size() < n_threads - 1)){
+        workers.reset();
+        workers = std::make_unique<Workers>(n_threads - 1);
+      }
+
+      const auto chunk = (N + n_threads - 1) / n_threads;
+      workers->run(n_threads, [=](std::size_t t){
+        const auto first = std::min(t * chunk, N);
+        const auto last = std::min(first + chunk, N);
+        this->gather_range(indexes, first, last, outputs);
+      });
+    }
+  };
 }
 #endif // YMD_REPLAY_BUFFER_HH
@@ -1,11 +1,21 @@
 from libcpp.vector cimport vector
 from libcpp cimport bool
+from libc.stdint cimport uint64_t
+from libc.stddef cimport ptrdiff_t
+
+cdef extern from "SegmentTree.hh" namespace "ymd":
+    size_t DirtyBitmapSize(size_t)
 
 cdef extern from "ReplayBuffer.hh" namespace "ymd":
     void clear[B](B*)
     size_t get_buffer_size[B](B*)
     size_t get_stored_size[B](B*)
     size_t get_next_index[B](B*)
+    size_t PriorityTreeSize[P](size_t,bool)
+    size_t FilterUnchangedSinceSample[I,P,S](const I*,const P*,size_t,
+                                             const S*,S,size_t,
+                                             vector[size_t]&,vector[P]&) nogil
+    void SequencePriorities[E,P](const E*,const bool*,size_t,size_t,P,P*) nogil
 
     cdef cppclass CppSelectiveEnvironment[Obs,Act,Rew,Done]:
         CppSelectiveEnvironment(size_t,size_t,size_t,size_t,size_t) except +
@@ -17,22 +27,50 @@ cdef extern from "ReplayBuffer.hh" namespace "ymd":
         void get_buffer_pointers(Obs*&,Act*&,Rew*&,Obs*&,Done*&)
     cdef cppclass CppPrioritizedSampler[Prio]:
         CppPrioritizedSampler(size_t,Prio) except +
-        void sample(size_t,Prio,vector[Prio]&,vector[size_t]&,size_t)
+        CppPrioritizedSampler(size_t,Prio,Prio*,
+                              Prio*,bool*,Prio*,bool*,
+                              bool,Prio,
+                              uint64_t*,uint64_t*,bool) except +
+        void sample(size_t,Prio,vector[Prio]&,vector[size_t]&,size_t) nogil
+        void sample_many(size_t,size_t,Prio,vector[Prio]&,vector[size_t]&,size_t) nogil
         void set_priorities(size_t)
         void set_priorities[P](size_t,P)
-        void set_priorities(size_t,size_t,size_t)
-        void set_priorities[P](size_t,P*,size_t,size_t)
-        void update_priorities[I,P](I*,P*,size_t)
+        void set_priorities(size_t,size_t,size_t) nogil
+        void set_priorities[P](size_t,P*,size_t,size_t) nogil
+        void update_priorities[I,P](I*,P*,size_t) nogil
         Prio get_max_priority()
         void set_eps(Prio)
     cdef cppclass CppThreadSafePrioritizedSampler[Prio]:
         CppThreadSafePrioritizedSampler(size_t,Prio,Prio*,
                                         Prio*,bool*,Prio*,bool*,
-                                        bool,float) except +
+                                        bool,float,
+                                        uint64_t*,uint64_t*,bool) except +
         void sample(size_t,Prio,vector[Prio]&,vector[size_t]&,size_t)
+        void sample_many(size_t,size_t,Prio,vector[Prio]&,vector[size_t]&,size_t)
         void set_priorities(size_t)
         void set_priorities[P](size_t,P)
         void set_priorities(size_t,size_t,size_t)
         void set_priorities[P](size_t,P*,size_t,size_t)
         void update_priorities[I,P](I*,P*,size_t)
         Prio get_max_priority()
+        void update_changed()
+        void seed()
+    cdef cppclass CppThreadSafeRingBufferIndex:
+        CppThreadSafeRingBufferIndex(size_t,size_t*,bool) except +
+        size_t fetch_add(size_t)
+        size_t get_next_index()
+        size_t get_stored_size()
+        void clear()
+    cdef cppclass CppThreadSafeSlotSequence:
+        CppThreadSafeSlotSequence(size_t,uint64_t*,bool) except +
+        void reserve(size_t,size_t)
+        void commit(size_t,size_t)
+        void load[I](const I*,size_t,uint64_t*)
+        size_t validate[I](const I*,size_t,const uint64_t*,bool*)
+    cdef cppclass CppGather:
+        CppGather() except +
+        size_t add_field(const void*,size_t,ptrdiff_t,size_t,size_t,
+                         const size_t*,const ptrdiff_t*,const ptrdiff_t*,
+                         size_t) except +
+        size_t size()
+        void gather[I](const I*,size_t,void**,size_t) nogil
@@ -8,6 +8,12 @@
 #include <set>
 #include <atomic>
 #include <memory>
+#include <cstdint>
+#include <algorithm>
+
+#if defined(_MSC_VER)
+#include <intrin.h>
+#endif
 
 namespace ymd {
   inline constexpr auto PowerOf2(const std::size_t n) noexcept {
@@ -16,35 +22,154 @@ namespace ymd {
     return m;
   }
 
-  template<typename T,bool MultiThread = false>
+  inline std::size_t CountTrailingZero(std::uint64_t v) noexcept {
+#if defined(_MSC_VER)
+    unsigned long i;
+    _BitScanForward64(&i, v);
+    return i;
+#else
+    return __builtin_ctzll(v);
+#endif
+  }
+
+  inline constexpr std::size_t DirtyBitmapSize(const std::size_t n) noexcept {
+    // Leaf bitmap (1 bit / leaf) followed by summary bitmap (1 bit / leaf word)
+    constexpr const std::size_t bits = 64;
+    const auto words = (n + bits - 1) / bits;
+    return words + (words + bits - 1) / bits;
+  }
+
+  class DirtyBitmap {
+    // Two level bitmap of dirty leaves, which can be placed on shared memory.
+    // Leaf bits are published before summary bits, so that consumer never
+    // misses any dirty leaves.
+  private:
+    static constexpr const std::size_t bits = 64;
+    std::size_t size;
+    std::size_t words;
+    std::atomic<std::uint64_t>* bitmap;
+    std::shared_ptr<std::atomic<std::uint64_t>[]> view;
+  public:
+    DirtyBitmap(std::size_t n, std::uint64_t* ptr = nullptr, bool allocate = true)
+      : size{DirtyBitmapSize(n)},
+        words{(n + bits - 1) / bits},
+        bitmap{(std::atomic<std::uint64_t>*)ptr},
+        view{}
+    {
+      if(!bitmap && allocate){
+        bitmap = new std::atomic<std::uint64_t>[size]{};
+        view.reset(bitmap);
+      }
+    }
+    DirtyBitmap(): DirtyBitmap{0, nullptr, false} {}
+    DirtyBitmap(const DirtyBitmap&) = default;
+    DirtyBitmap(DirtyBitmap&&) = default;
+    DirtyBitmap& operator=(const DirtyBitmap&) = default;
+    DirtyBitmap& operator=(DirtyBitmap&&) = default;
+    ~DirtyBitmap() = default;
+
+    void mark(std::size_t i, std::size_t N){
+      // Mark leaves [i, i+N) as dirty.
+      const auto end = i + N;
+      while(i < end){
+        const auto w = i / bits;
+        const auto b = i % bits;
+        const auto n = std::min(bits - b, end - i);
+        const auto mask = (n == bits) ?
+          ~std::uint64_t(0) : (((std::uint64_t(1) << n) - 1) << b);
+
+        bitmap[w].fetch_or(mask, std::memory_order_release);
+        bitmap[words + w / bits].fetch_or(std::uint64_t(1) << (w % bits),
+                                          std::memory_order_release);
+        i += n;
+      }
+    }
+
+    void clear(){
+      std::for_each(bitmap, bitmap + size,
+                    [](auto& d){ d.store(0, std::memory_order_release); });
+    }
+
+    template<typename F>
+    void consume(F&& f){
+      // Call f(i) for every dirty leaf i, and clear its bit.
+      for(auto s = words; s < size; ++s){
+        auto summary = bitmap[s].exchange(0, std::memory_order_acq_rel);
+        while(summary){
+          const auto w = (s - words) * bits + CountTrailingZero(summary);
+          summary &= summary - 1;
+
+          auto word = bitmap[w].exchange(0, std::memory_order_acq_rel);
+          while(word){
+            f(w * bits + CountTrailingZero(word));
+            word &= word - 1;
+          }
+        }
+      }
+    }
+  };
+
+  template<typename T>
+  struct SumOp {
+    constexpr T operator()(T a, T b) const noexcept { return a + b; }
+  };
+
+  template<typename T>
+  struct MinOp {
+    constexpr T operator()(T a, T b) const noexcept { return std::min(a, b); }
+  };
+
+  template<typename T,bool MultiThread = false,
+           typename F = std::function<T(T, T)>>
   class SegmentTree {
   private:
-    using F = std::function<T(T, T)>;
     const std::size_t buffer_size;
     T* buffer;
     std::shared_ptr<T[]> view;
     F f;
     std::atomic_bool *any_changed;
     std::shared_ptr<std::atomic_bool> any_changed_view;
-
-    auto _reduce(const std::size_t start, const std::size_t end, std::size_t index,
-                 const std::size_t region_s, const std::size_t region_e) const {
-      if((start <= region_s) && (region_e <= end)){
-        return buffer[index];
+    DirtyBitmap dirty;
+    bool incremental;
+    std::vector<std::size_t> nodes;
+
+    T _reduce(std::size_t start, std::size_t end) const {
+      // Iterative bottom-up reduction on [start, end).
+      // Node indices are shifted by 1 (root = 1), so that odd nodes are
+      // right children. Left and right partial results are kept separately
+      // to preserve operation order.
+      constexpr const std::size_t one = 1;
+
+      auto l = start + buffer_size;
+      auto r = end + buffer_size;
+      T left{}, right{};
+      bool has_left = false, has_right = false;
+
+      while(l < r){
+        if(l & one){
+          left = has_left ? f(left, buffer[l - one]) : buffer[l - one];
+          has_left = true;
+          ++l;
+        }
+        if(r & one){
+          --r;
+          right = has_right ? f(buffer[r - one], right) : buffer[r - one];
+          has_right = true;
+        }
+        l >>= one;
+        r >>= one;
       }
 
-      auto region_m = (region_s + region_e)/2;
-
-      if(end <= region_m){
-        return _reduce(start, end, 2*index+1, region_s, region_m);
-      }
+      if(has_left && has_right){ return f(left, right); }
+      return has_left ? left : right;
+    }
 
-      if(region_m <= start){
-        return _reduce(start, end, 2*index+2, region_m, region_e);
+    static F default_f(){
+      if constexpr (std::is_same_v<F, std::function<T(T, T)>>){
+        return [](auto a, auto b){ return a + b; };
+      }else{
+        return F{};
       }
-
-      return f(_reduce(start, end, 2*index+1, region_s, region_m),
-               _reduce(start, end, 2*index+2, region_m, region_e));
     }
 
     constexpr std::size_t parent(std::size_t node) const {
@@ -69,11 +194,60 @@ namespace ymd {
       return tmp != buffer[i];
     }
 
+    void propagate(std::size_t n){
+      constexpr const std::size_t zero = 0;
+      auto updated = true;
+      while((n != zero) && updated){
+        n = parent(n);
+        updated = update_buffer(n);
+      }
+    }
+
+    void update_dirty(){
+      // Repair only ancestors of dirty leaves: O(k log N)
+      dirty.consume([this](auto i){ this->propagate(this->access_index(i)); });
+    }
+
+    template<typename RandomIt, typename OutputIt>
+    void descend(std::size_t b, std::size_t min, std::size_t max, T red,
+                 RandomIt first, RandomIt last, OutputIt out,
+                 std::size_t n) const {
+      // Masses in [first, last) must be sorted in ascending order.
+      // Shared upper nodes are visited only once, and only the left branch of
+      // a split is recursed, so that recursion depth is bounded by tree depth.
+      constexpr const std::size_t one = 1;
+      constexpr const std::size_t two = 2;
+
+      while(max - min > one){
+        const auto b_left = child_left(b);
+        const auto v = f(red, buffer[b_left]);
+        const auto mid = std::partition_point(first, last,
+                                              [=](auto m){ return !(v <= m); });
+        if(mid == last){
+          max = (min + max) / two;
+          b = b_left;
+          continue;
+        }
+
+        if(first != mid){
+          descend(b_left, min, (min + max) / two, red, first, mid, out, n);
+          out += std::distance(first, mid);
+          first = mid;
+        }
+        min = (min + max) / two;
+        red = v;
+        b = child_right(b);
+      }
+
+      std::fill_n(out, std::distance(first, last), std::min(min, n-one));
+    }
+
     void update_init(){
       for(std::size_t i = access_index(0) -1, end = -1; i != end; --i){
         update_buffer(i);
       }
       if constexpr (MultiThread){
+        dirty.clear();
         any_changed->store(false, std::memory_order_release);
       }
     }
@@ -95,16 +269,34 @@ namespace ymd {
     }
 
   public:
+    // Repair nodes whose descendants were changed by other threads
+    void update_changed(){
+      if constexpr (MultiThread){
+        if(incremental){
+          if(any_changed->exchange(false, std::memory_order_acq_rel)){
+            update_dirty();
+          }
+        }else if(any_changed->load(std::memory_order_acquire)){
+          update_all();
+        }
+      }
+    }
+
     SegmentTree(std::size_t n, F f, T v = T{0},
                 T* buffer_ptr = nullptr,
                 bool* any_changed_ptr = nullptr,
-                bool initialize = true)
+                bool initialize = true,
+                std::uint64_t* dirty_ptr = nullptr,
+                bool incremental = true)
       : buffer_size(n),
         buffer(buffer_ptr),
         view{},
         f(f),
         any_changed{(std::atomic_bool*)any_changed_ptr},
-        any_changed_view{}
+        any_changed_view{},
+        dirty{n, dirty_ptr, MultiThread},
+        incremental{incremental},
+        nodes{}
     {
       if(!buffer){
         buffer = new T[2*n-1];
@@ -124,7 +316,7 @@ namespace ymd {
         update_init();
       }
     }
-    SegmentTree(): SegmentTree{2, [](auto a,auto b){ return a+b; }} {}
+    SegmentTree(): SegmentTree{2, default_f()} {}
     SegmentTree(const SegmentTree&) = default;
     SegmentTree(SegmentTree&&) = default;
     SegmentTree& operator=(const SegmentTree&) = default;
@@ -140,63 +332,97 @@ namespace ymd {
       buffer[n] = std::move(v);
 
       if constexpr (MultiThread){
+        if(incremental){ dirty.mark(i, 1); }
         any_changed->store(true,std::memory_order_release);
       }else{
-        constexpr const std::size_t zero = 0;
-        auto updated = true;
-        while((n != zero) && updated){
-          n = parent(n);
-          updated = update_buffer(n);
-        }
+        propagate(n);
       }
     }
 
-    template<typename F,
-             typename std::enable_if<!(std::is_convertible_v<F,T>),
+    template<typename Generator,
+             typename std::enable_if<!(std::is_convertible_v<Generator,T>),
                                      std::nullptr_t>::type = nullptr>
-    void set(std::size_t i, F&& f, std::size_t N, std::size_t max = std::size_t(0)){
+    void set(std::size_t i, Generator&& f, std::size_t N,
+             std::size_t max = std::size_t(0)){
       constexpr const std::size_t zero = 0;
       if(zero == max){ max = buffer_size; }
 
-      if constexpr (MultiThread){
-        if(N){ any_changed->store(true, std::memory_order_release); }
-      }
+      const auto notify = (N != zero);
+
+      // Generator continues over the wrap, while caller's one is kept
+      // (e.g. to be reused for another tree).
+      auto g = f;
 
       while(N){
         auto copy_N = std::min(N, max-i);
-        std::generate_n(buffer+access_index(i), copy_N, f);
+        std::generate_n(buffer+access_index(i), copy_N, std::ref(g));
 
-        if constexpr (!MultiThread){
+        if constexpr (MultiThread){
+          if(incremental){ dirty.mark(i, copy_N); }
+        }else{
           for(auto n = std::size_t(0); n < copy_N; ++n){
-            auto _i = access_index(i+n);
-            auto updated = true;
-            while((_i != zero) && updated){
-              _i = parent(_i);
-              updated = update_buffer(_i);
-            }
+            propagate(access_index(i+n));
           }
         }
 
         N = (N > copy_N) ? N - copy_N: zero;
         i = zero;
       }
+
+      if constexpr (MultiThread){
+        if(notify){ any_changed->store(true, std::memory_order_release); }
+      }
     }
 
     void set(std::size_t i, T v, std::size_t N, std::size_t max = std::size_t(0)){
       set(i, [=](){ return v; }, N, max);
     }
 
-    auto reduce(std::size_t start, std::size_t end) {
-      // Operation on [start, end)  # buffer[end] is not included
+    template<typename I>
+    void scatter(const I* indexes, const T* values, std::size_t N){
+      // Set values[k] at indexes[k] for k in [0, N). For duplicated indexes,
+      // the last one wins. Every affected internal node is recomputed only
+      // once, level by level.
+      constexpr const std::size_t zero = 0;
+      if(N == zero){ return; }
+
+      for(auto k = zero; k < N; ++k){
+        buffer[access_index(indexes[k])] = values[k];
+      }
+
       if constexpr (MultiThread){
-        if(any_changed->load(std::memory_order_acquire)){
-          update_all();
+        if(incremental){
+          for(auto k = zero; k < N; ++k){ dirty.mark(indexes[k], 1); }
+        }
+        any_changed->store(true, std::memory_order_release);
+      }else if(buffer_size > 1){
+        nodes.resize(N);
+        std::transform(indexes, indexes+N, nodes.begin(),
+                       [this](auto i){ return this->parent(this->access_index(i)); });
+        std::sort(nodes.begin(), nodes.end());
+
+        // All leaves are at the same depth, so that nodes stay sorted.
+        while(true){
+          nodes.erase(std::unique(nodes.begin(), nodes.end()), nodes.end());
+          nodes.erase(std::remove_if(nodes.begin(), nodes.end(),
+                                     [this](auto n){ return !this->update_buffer(n); }),
+                      nodes.end());
+          if(nodes.empty() || (nodes.front() == zero)){ break; }
+
+          std::transform(nodes.begin(), nodes.end(), nodes.begin(),
+                         [this](auto n){ return this->parent(n); });
         }
       }
-      return _reduce(start, end, 0, 0, buffer_size);
     }
 
-    auto largest_region_index(std::function<bool(T)> condition,
+    auto reduce(std::size_t start, std::size_t end) {
+      // Operation on [start, end)  # buffer[end] is not included
+      update_changed();
+      return _reduce(start, end);
+    }
+
+    template<typename Condition>
+    auto largest_region_index(Condition&& condition,
                               std::size_t n=std::size_t(0),
                               T init = T{0}) {
       // max index of reduce( [0,index) ) -> true
@@ -205,11 +431,7 @@ namespace ymd {
       constexpr const std::size_t one  = 1;
       constexpr const std::size_t two  = 2;
 
-      if constexpr (MultiThread){
-        if(any_changed->load(std::memory_order_acquire)){
-          update_all();
-        }
-      }
+      update_changed();
 
       if(n == zero){ n = buffer_size; }
       auto b = zero;
@@ -218,15 +440,16 @@ namespace ymd {
 
       auto min = zero;
       auto max = buffer_size;
-      auto cond = condition;
       auto red = init;
+      auto moved_right = false;
 
       while(max - min > one){
-        auto b_left = child_left(b);
-        if(cond(buffer[b_left])){
+        const auto b_left = child_left(b);
+        const auto v = f(red, buffer[b_left]);
+        if(condition(moved_right ? v : buffer[b_left])){
           min = (min + max) / two;
-          red = f(red, buffer[b_left]);
-          cond = [=](auto v){ return condition(f(red, v)); };
+          red = v;
+          moved_right = true;
           b = child_right(b);
         }else{
           max = (min + max) / two;
@@ -237,10 +460,398 @@ namespace ymd {
       return std::min(min, n-1);
     }
 
+    template<typename RandomIt, typename OutputIt>
+    void largest_region_indexes(RandomIt first, RandomIt last, OutputIt out,
+                                std::size_t n=std::size_t(0), T init = T{0}) {
+      // Batched version of largest_region_index([](auto v){ return v <= mass; })
+      // for every mass in sorted [first, last), written into out.
+
+      constexpr const std::size_t zero = 0;
+      constexpr const std::size_t one  = 1;
+
+      update_changed();
+
+      if(n == zero){ n = buffer_size; }
+
+      // Masses larger than or equal to total are mapped to the last index.
+      const auto total = f(init, buffer[zero]);
+      const auto over = std::partition_point(first, last,
+                                             [=](auto m){ return !(total <= m); });
+      std::fill_n(out + std::distance(first, over), std::distance(over, last), n-one);
+
+      if(first != over){
+        descend(zero, zero, buffer_size, init, first, over, out, n);
+      }
+    }
+
     void clear(T v = T{0}){
       std::fill(buffer + access_index(0), buffer + access_index(buffer_size), v);
+      if constexpr (MultiThread){
+        dirty.clear();
+      }
       update_all();
     }
   };
+
+  template<typename T>
+  inline constexpr std::size_t CacheLineWidth
+  = std::max<std::size_t>(2, 64 / sizeof(T));
+
+  template<typename T, std::size_t Width = CacheLineWidth<T>>
+  inline std::vector<std::size_t> WideLevelOffsets(std::size_t n){
+    // Offsets of every level (leaves first, root node last) and the total
+    // size at the back. Every level is padded to a multiple of Width.
+    auto offsets = std::vector<std::size_t>{0};
+    auto count = std::max<std::size_t>(n, 1);
+    while(true){
+      const auto padded = ((count + Width - 1) / Width) * Width;
+      offsets.push_back(offsets.back() + padded);
+      if(count <= Width){ break; }
+      count = padded / Width;
+    }
+    return offsets;
+  }
+
+  template<typename T, std::size_t Width = CacheLineWidth<T>>
+  inline std::size_t WideTreeSize(std::size_t n){
+    return WideLevelOffsets<T, Width>(n).back();
+  }
+
+  template<typename T, bool MultiThread = false,
+           typename F = std::function<T(T, T)>,
+           std::size_t Width = CacheLineWidth<T>>
+  class WideSegmentTree {
+    // Segment tree whose node has Width children packed in a cache line.
+    // Compared to binary SegmentTree, a root-to-leaf path touches only
+    // log_{Width}(N) cache lines.
+    static_assert(Width >= 2, "Width must be 2 or larger");
+  private:
+    const std::size_t buffer_size;
+    std::vector<std::size_t> offsets;
+    T* buffer;
+    std::shared_ptr<T[]> view;
+    F f;
+    std::atomic_bool *any_changed;
+    std::shared_ptr<std::atomic_bool> any_changed_view;
+    DirtyBitmap dirty;
+    bool incremental;
+    std::vector<std::size_t> nodes;
+
+    std::size_t levels() const { return offsets.size() - 1; }
+
+    std::size_t count(std::size_t level) const {
+      // The number of real (non-padding) entries at level
+      return level ? (offsets[level] - offsets[level-1]) / Width : buffer_size;
+    }
+
+    T reduce_node(std::size_t first) const {
+      auto v = buffer[first];
+      for(auto k = std::size_t(1); k < Width; ++k){ v = f(v, buffer[first + k]); }
+      return v;
+    }
+
+    T total() const { return reduce_node(offsets[levels() - 1]); }
+
+    bool update_parent(std::size_t level, std::size_t group){
+      // Recompute parent entry of `group`-th node at `level`.
+      const auto p = offsets[level + 1] + group;
+      const auto tmp = buffer[p];
+      buffer[p] = reduce_node(offsets[level] + group * Width);
+      return tmp != buffer[p];
+    }
+
+    void propagate(std::size_t i){
+      for(auto l = std::size_t(0); l + 1 < levels(); ++l){
+        i /= Width;
+        if(!update_parent(l, i)){ break; }
+      }
+    }
+
+    void propagate(std::size_t first, std::size_t last){
+      // Recompute every ancestor of leaves [first, last) once, level by level.
+      for(auto l = std::size_t(0); (l + 1 < levels()) && (first < last); ++l){
+        first /= Width;
+        last = (last + Width - 1) / Width;
+        for(auto g = first; g < last; ++g){ update_parent(l, g); }
+      }
+    }
+
+    void update_all(){
+      for(auto l = std::size_t(0); l + 1 < levels(); ++l){
+        const auto groups = (offsets[l+1] - offsets[l]) / Width;
+        for(auto g = std::size_t(0); g < groups; ++g){ update_parent(l, g); }
+      }
+      if constexpr (MultiThread){
+        any_changed->store(false, std::memory_order_release);
+      }
+    }
+
+    template<typename Condition>
+    std::size_t descend(Condition&& condition, T red) const {
+      // Branch-less scan inside each node: prefix reductions are computed,
+      // then the number of children satisfying the (monotone) condition is
+      // counted. The last child is chosen when all the others satisfy.
+      auto index = std::size_t(0);
+      for(auto l = levels(); l > 0; --l){
+        const auto node = buffer + offsets[l-1] + index * Width;
+
+        T prefix[Width];
+        prefix[0] = f(red, node[0]);
+        for(auto k = std::size_t(1); k < Width; ++k){
+          prefix[k] = f(prefix[k-1], node[k]);
+        }
+
+        auto j = std::size_t(0);
+        for(auto k = std::size_t(0); k < Width - 1; ++k){
+          j += condition(prefix[k]);
+        }
+
+        if(j){ red = prefix[j-1]; }
+
+        // Rounding error might lead to padding, so that we clamp it.
+        index = std::min(index * Width + j, count(l-1) - 1);
+      }
+      return index;
+    }
+
+    static F default_f(){
+      if constexpr (std::is_same_v<F, std::function<T(T, T)>>){
+        return [](auto a, auto b){ return a + b; };
+      }else{
+        return F{};
+      }
+    }
+
+  public:
+    // Repair nodes whose descendants were changed by other threads
+    void update_changed(){
+      if constexpr (MultiThread){
+        if(incremental){
+          if(any_changed->exchange(false, std::memory_order_acq_rel)){
+            dirty.consume([this](auto i){ this->propagate(i); });
+          }
+        }else if(any_changed->load(std::memory_order_acquire)){
+          update_all();
+        }
+      }
+    }
+
+    WideSegmentTree(std::size_t n, F f, T v = T{0},
+                    T* buffer_ptr = nullptr,
+                    bool* any_changed_ptr = nullptr,
+                    bool initialize = true,
+                    std::uint64_t* dirty_ptr = nullptr,
+                    bool incremental = true)
+      : buffer_size(n),
+        offsets(WideLevelOffsets<T, Width>(n)),
+        buffer(buffer_ptr),
+        view{},
+        f(f),
+        any_changed{(std::atomic_bool*)any_changed_ptr},
+        any_changed_view{},
+        dirty{n, dirty_ptr, MultiThread},
+        incremental{incremental},
+        nodes{}
+    {
+      if(!buffer){
+        buffer = new T[offsets.back()];
+        view.reset(buffer);
+      }
+
+      if constexpr (MultiThread){
+        if(!any_changed){
+          any_changed = new std::atomic_bool{true};
+          any_changed_view.reset(any_changed);
+        }
+      }
+
+      if(initialize){
+        std::fill_n(buffer, offsets.back(), v);
+        update_all();
+        if constexpr (MultiThread){ dirty.clear(); }
+      }
+    }
+    WideSegmentTree(): WideSegmentTree{2, default_f()} {}
+    WideSegmentTree(const WideSegmentTree&) = default;
+    WideSegmentTree(WideSegmentTree&&) = default;
+    WideSegmentTree& operator=(const WideSegmentTree&) = default;
+    WideSegmentTree& operator=(WideSegmentTree&&) = default;
+    ~WideSegmentTree() = default;
+
+    T get(std::size_t i) const {
+      return buffer[i];
+    }
+
+    void set(std::size_t i, T v){
+      buffer[i] = std::move(v);
+
+      if constexpr (MultiThread){
+        if(incremental){ dirty.mark(i, 1); }
+        any_changed->store(true, std::memory_order_release);
+      }else{
+        propagate(i);
+      }
+    }
+
+    template<typename Generator,
+             typename std::enable_if<!(std::is_convertible_v<Generator,T>),
+                                     std::nullptr_t>::type = nullptr>
+    void set(std::size_t i, Generator&& f, std::size_t N,
+             std::size_t max = std::size_t(0)){
+      constexpr const std::size_t zero = 0;
+      if(zero == max){ max = buffer_size; }
+
+      const auto notify = (N != zero);
+
+      // Generator continues over the wrap, while caller's one is kept
+      // (e.g. to be reused for another tree).
+      auto g = f;
+
+      while(N){
+        auto copy_N = std::min(N, max-i);
+        std::generate_n(buffer + i, copy_N, std::ref(g));
+
+        if constexpr (MultiThread){
+          if(incremental){ dirty.mark(i, copy_N); }
+        }else{
+          propagate(i, i + copy_N);
+        }
+
+        N = (N > copy_N) ? N - copy_N: zero;
+        i = zero;
+      }
+
+      if constexpr (MultiThread){
+        if(notify){ any_changed->store(true, std::memory_order_release); }
+      }
+    }
+
+    void set(std::size_t i, T v, std::size_t N, std::size_t max = std::size_t(0)){
+      set(i, [=](){ return v; }, N, max);
+    }
+
+    template<typename I>
+    void scatter(const I* indexes, const T* values, std::size_t N){
+      // Set values[k] at indexes[k] for k in [0, N). For duplicated indexes,
+      // the last one wins. Every affected internal node is recomputed only
+      // once, level by level.
+      constexpr const std::size_t zero = 0;
+      if(N == zero){ return; }
+
+      for(auto k = zero; k < N; ++k){ buffer[indexes[k]] = values[k]; }
+
+      if constexpr (MultiThread){
+        if(incremental){
+          for(auto k = zero; k < N; ++k){ dirty.mark(indexes[k], 1); }
+        }
+        any_changed->store(true, std::memory_order_release);
+      }else{
+        nodes.assign(indexes, indexes+N);
+        std::sort(nodes.begin(), nodes.end());
+
+        for(auto l = zero; (l + 1 < levels()) && !nodes.empty(); ++l){
+          std::transform(nodes.begin(), nodes.end(), nodes.begin(),
+                         [](auto i){ return i / Width; });
+          nodes.erase(std::unique(nodes.begin(), nodes.end()), nodes.end());
+          nodes.erase(std::remove_if(nodes.begin(), nodes.end(),
+                                     [this, l](auto g){ return !this->update_parent(l, g); }),
+                      nodes.end());
+        }
+      }
+    }
+
+    T reduce(std::size_t start, std::size_t end) {
+      // Operation on [start, end)  # buffer[end] is not included
+      update_changed();
+
+      T left{}, right{};
+      bool has_left = false, has_right = false;
+      const auto top = levels() - 1;
+
+      for(auto l = std::size_t(0); start < end; ++l){
+        const auto b = buffer + offsets[l];
+        if(l == top){
+          for(; start < end; ++start){
+            left = has_left ? f(left, b[start]) : b[start];
+            has_left = true;
+          }
+          break;
+        }
+
+        for(; (start < end) && (start % Width); ++start){
+          left = has_left ? f(left, b[start]) : b[start];
+          has_left = true;
+        }
+        for(; (start < end) && (end % Width); ){
+          --end;
+          right = has_right ? f(b[end], right) : b[end];
+          has_right = true;
+        }
+        start /= Width;
+        end /= Width;
+      }
+
+      if(has_left && has_right){ return f(left, right); }
+      return has_left ? left : right;
+    }
+
+    template<typename Condition>
+    auto largest_region_index(Condition&& condition,
+                              std::size_t n=std::size_t(0),
+                              T init = T{0}) {
+      // max index of reduce( [0,index) ) -> true
+      // `init` must be the identity element of the operation.
+
+      constexpr const std::size_t zero = 0;
+      constexpr const std::size_t one  = 1;
+
+      update_changed();
+
+      if(n == zero){ n = buffer_size; }
+      if(condition(f(init, total()))){ return n-one; }
+
+      return std::min(descend(condition, init), n-one);
+    }
+
+    template<typename RandomIt, typename OutputIt>
+    void largest_region_indexes(RandomIt first, RandomIt last, OutputIt out,
+                                std::size_t n=std::size_t(0), T init = T{0}) {
+      // Batched version of largest_region_index([](auto v){ return v <= mass; })
+      // for every mass in [first, last), written into out.
+
+      constexpr const std::size_t zero = 0;
+      constexpr const std::size_t one  = 1;
+
+      update_changed();
+
+      if(n == zero){ n = buffer_size; }
+      const auto sum = f(init, total());
+
+      std::transform(first, last, out, [=](auto m){
+        if(sum <= m){ return n-one; }
+        return std::min(this->descend([=](auto v){ return v <= m; }, init), n-one);
+      });
+    }
+
+    void clear(T v = T{0}){
+      std::fill(buffer, buffer + offsets[1], v);
+      if constexpr (MultiThread){
+        dirty.clear();
+      }
+      update_all();
+    }
+  };
+
+  template<typename T, bool MultiThread = false>
+  using SumTree = SegmentTree<T, MultiThread, SumOp<T>>;
+
+  template<typename T, bool MultiThread = false>
+  using MinTree = SegmentTree<T, MultiThread, MinOp<T>>;
+
+  template<typename T, bool MultiThread = false>
+  using WideSumTree = WideSegmentTree<T, MultiThread, SumOp<T>>;
+
+  template<typename T, bool MultiThread = false>
+  using WideMinTree = WideSegmentTree<T, MultiThread, MinOp<T>>;
 }
 #endif // YMD_SEGMENTTREE_HH
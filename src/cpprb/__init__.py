@@ -38,6 +38,8 @@ import contextlib
 __all__ = [
     "ReplayBuffer",
     "PrioritizedReplayBuffer",
+    "ThreadSafeReplayBuffer",
+    "ThreadSafePrioritizedReplayBuffer",
     "MPReplayBuffer",
     "MPPrioritizedReplayBuffer",
     "SelectiveReplayBuffer",
@@ -46,7 +48,9 @@ __all__ = [
     "LaBERlazy",
     "LaBERmax",
     "HindsightReplayBuffer",
+    "PrefetchSampler",
     "create_buffer",
+    "sequence_priorities",
     "train",
 ]
 
@@ -58,11 +62,15 @@ from cpprb.PyReplayBuffer import (  # noqa: I001
     ReplayBuffer,
     ReverseReplayBuffer,
     SelectiveReplayBuffer,
+    ThreadSafePrioritizedReplayBuffer,
+    ThreadSafeReplayBuffer,
     create_buffer,
+    sequence_priorities,
     train,
 )
 from cpprb.HER import HindsightReplayBuffer
 from cpprb.LaBER import LaBERlazy, LaBERmax, LaBERmean
+from cpprb.prefetch import PrefetchSampler
 
 with contextlib.suppress(ImportError):
     # If gym is not installed, util functions are not defined.
@@ -0,0 +1,193 @@
+import queue
+import threading
+
+import numpy as np
+
+
+class PrefetchSampler:
+    def __init__(self, rb, batch_size: int, *, prefetch: int = 2,
+                 max_staleness=None, **kwargs):
+        """
+        Initialize PrefetchSampler class
+
+        Batches are sampled by a background thread into a ring of reusable
+        output arrays, so that sampling overlaps with learner computation.
+
+        Parameters
+        ----------
+        rb : ReplayBuffer or PrioritizedReplayBuffer
+            Replay buffer to sample from. It must store at least a transition.
+        batch_size : int
+            Batch size
+        prefetch : int, optional
+            The number of batches kept ready. Default value is ``2``.
+        max_staleness : int, optional
+            Max number of ``update_priorities`` calls after a batch was sampled.
+            Staler batches are dropped and sampled again. If ``None`` (default),
+            batches are never dropped.
+        **kwargs : key-value
+            Additional keyword arguments passed to ``rb.sample``
+            (e.g. ``beta``, ``keys``).
+
+        Raises
+        ------
+        ValueError
+            When ``batch_size <= 0``, ``prefetch <= 0``, or ``max_staleness < 0``.
+
+        Notes
+        -----
+        Returned batch is overwritten after the next batch is taken. Copy it
+        if it is needed longer.
+
+        Sampling and ``update_priorities`` of this class are serialized by
+        an internal lock. When transitions are added concurrently from other
+        threads, use ``ThreadSafeReplayBuffer`` or
+        ``ThreadSafePrioritizedReplayBuffer``. ``gather_threads`` of the
+        buffer lets the background thread release the GIL during gathers.
+
+        Examples
+        --------
+        >>> rb = PrioritizedReplayBuffer(1e+6, {"obs": {"shape": 3}})
+        >>> rb.add(obs=np.ones((64,3)))
+        >>> with PrefetchSampler(rb, 32, max_staleness=1) as sampler:
+        ...     for _, sample in zip(range(10), sampler):
+        ...         sampler.update_priorities(sample["indexes"], np.random.rand(32))
+        """
+        self.rb = rb
+
+        self.batch_size = int(batch_size)
+        if self.batch_size <= 0:
+            raise ValueError("``batch_size`` must be positive integer.")
+
+        self.prefetch = int(prefetch)
+        if self.prefetch <= 0:
+            raise ValueError("``prefetch`` must be positive integer.")
+
+        if (max_staleness is not None) and (max_staleness < 0):
+            raise ValueError("``max_staleness`` must be non negative")
+        self.max_staleness = max_staleness
+
+        self.kwargs = kwargs
+
+        self.lock = threading.Lock()
+        self.updates = 0
+
+        # One more slot than ``prefetch`` is held by the consumer.
+        sample = self.rb.sample(self.batch_size, **self.kwargs)
+        self.slots = [{k: np.empty_like(v) for k, v in sample.items()}
+                      for _ in range(self.prefetch + 1)]
+        for k, v in sample.items():
+            np.copyto(self.slots[0][k], v)
+
+        self.free = queue.SimpleQueue()
+        self.ready = queue.SimpleQueue()
+        self.ready.put((0, self.updates, None))
+        for i in range(1, len(self.slots)):
+            self.free.put(i)
+        self.held = None
+
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        while True:
+            i = self.free.get()
+            if self.stop.is_set():
+                return
+
+            try:
+                with self.lock:
+                    stamp = self.updates
+                    self.rb.sample(self.batch_size, out=self.slots[i],
+                                   **self.kwargs)
+            except Exception as e:
+                self.ready.put((i, None, e))
+                return
+
+            self.ready.put((i, stamp, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Take the next batch
+
+        Returns
+        -------
+        dict of numpy.ndarray
+            Sampled batch, which is valid until the next call.
+
+        Raises
+        ------
+        StopIteration
+            When this sampler is closed.
+        """
+        if self.held is not None:
+            self.free.put(self.held)
+            self.held = None
+
+        while True:
+            if self.stop.is_set():
+                raise StopIteration
+
+            item = self.ready.get()
+            if item is None:
+                # Closed while waiting
+                raise StopIteration
+
+            i, stamp, e = item
+            if e is not None:
+                self.close()
+                raise e
+
+            if ((self.max_staleness is None) or
+                (self.updates - stamp <= self.max_staleness)):
+                break
+
+            self.free.put(i)
+
+        self.held = i
+        return self.slots[i]
+
+    def update_priorities(self, indexes, priorities, **kwargs):
+        """
+        Update priorities
+
+        Parameters
+        ----------
+        indexes : array_like
+            Indexes to update priorities
+        priorities : array_like
+            Priorities to update
+        **kwargs : key-value
+            Additional keyword arguments passed to ``rb.update_priorities``
+
+        See Also
+        --------
+        PrioritizedReplayBuffer.update_priorities
+        """
+        with self.lock:
+            self.rb.update_priorities(indexes, priorities, **kwargs)
+            self.updates += 1
+
+    def close(self):
+        """
+        Stop background thread
+
+        This method can be called from another thread than the consumer,
+        which is woken up and stops iteration.
+        """
+        if not self.stop.is_set():
+            self.stop.set()
+            self.free.put(None)
+            self.ready.put(None)
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
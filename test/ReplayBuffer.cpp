@@ -92,6 +92,147 @@ void test_PrioritizedSampler(){
   ALMOST_EQUAL(ps.get_max_priority(),LARGE_P);
 }
 
+void test_PrioritizedSamplerMany(){
+  constexpr const auto N_buffer_size = 1024ul;
+  constexpr const auto N_batch_size = 16ul;
+  constexpr const auto k = 8ul;
+
+  std::cout << std::endl;
+  std::cout << "PrioritizedSampler (sample_many)" << std::endl;
+  auto ps = ymd::CppPrioritizedSampler(N_buffer_size,0.7);
+  for(auto i = 0ul; i < N_buffer_size; ++i){
+    ps.set_priorities(i,0.5);
+  }
+
+  auto ps_w = std::vector<Priority>{};
+  auto ps_i = std::vector<std::size_t>{};
+  ps.sample_many(k,N_batch_size,0.4,ps_w,ps_i,N_buffer_size);
+
+  EQUAL(ps_i.size(), k*N_batch_size);
+  EQUAL(ps_w.size(), k*N_batch_size);
+
+  // Every batch is stratified by itself.
+  constexpr const auto stratum = N_buffer_size / N_batch_size;
+  for(auto j = 0ul; j < k; ++j){
+    for(auto i = 0ul; i < N_batch_size; ++i){
+      EQUAL(ps_i[j*N_batch_size + i] / stratum, i);
+      ALMOST_EQUAL(ps_w[j*N_batch_size + i], 1.0);
+    }
+  }
+}
+
+void test_FilterUnchangedSinceSample(){
+  std::cout << std::endl;
+  std::cout << "FilterUnchangedSinceSample" << std::endl;
+
+  // Slot 1 is written at epoch 3 (after the last sample) and slot 5 is not stored.
+  auto stamp = std::vector<std::uint64_t>{0, 3, 2, 1, 0, 0};
+  auto idx = std::vector<std::size_t>{0, 1, 2, 5, 3};
+  auto p = std::vector<Priority>{0.1, 0.2, 0.3, 0.4, 0.5};
+
+  auto out_i = std::vector<std::size_t>{};
+  auto out_p = std::vector<Priority>{};
+  auto n = ymd::FilterUnchangedSinceSample(idx.data(), p.data(), idx.size(),
+                                           stamp.data(), std::uint64_t(3), 5ul,
+                                           out_i, out_p);
+  ymd::show_vector(out_i,"indexes [0,2,3]");
+
+  EQUAL(n, 3ul);
+  EQUAL(out_i.size(), 3ul);
+  EQUAL(out_i[0], 0ul);
+  EQUAL(out_i[1], 2ul);
+  EQUAL(out_i[2], 3ul);
+  ALMOST_EQUAL(out_p[2], Priority(0.5));
+}
+
+void test_SequencePriorities(){
+  std::cout << std::endl;
+  std::cout << "SequencePriorities" << std::endl;
+
+  // 2 sequences of 3 steps. The last step of the 2nd sequence is padded.
+  const auto errors = std::vector<Priority>{1.0, -4.0, 1.0, 2.0, 0.0, 100.0};
+  const bool mask[] = {true, true, true, true, true, false};
+  auto out = std::vector<Priority>(2);
+
+  ymd::SequencePriorities(errors.data(), mask, 2ul, 3ul, Priority(0.5), out.data());
+  ALMOST_EQUAL(out[0], Priority(0.5 * 4.0 + 0.5 * 2.0));
+  ALMOST_EQUAL(out[1], Priority(0.5 * 2.0 + 0.5 * 1.0));
+
+  ymd::SequencePriorities(errors.data(), (const bool*)nullptr, 2ul, 3ul,
+                          Priority(0.9), out.data());
+  ALMOST_EQUAL(out[1], Priority(0.9 * 100.0 + 0.1 * 34.0));
+}
+
+void test_RingBufferIndex(){
+  constexpr const auto buffer_size = 100ul;
+  constexpr const auto N_add = 1000ul;
+
+  std::cout << std::endl;
+  std::cout << "RingBufferIndex" << std::endl;
+
+  auto ring = ymd::CppThreadSafeRingBufferIndex(buffer_size);
+  EQUAL(ring.fetch_add(30), 0ul);
+  EQUAL(ring.get_stored_size(), 30ul);
+
+  EQUAL(ring.fetch_add(80), 30ul);
+  EQUAL(ring.get_next_index(), 10ul);
+  EQUAL(ring.get_stored_size(), buffer_size);
+
+  ring.clear();
+  auto futures = std::vector<std::future<void>>{};
+  for(auto c = 0ul; c < cores; ++c){
+    futures.push_back(std::async(std::launch::async, [&ring](){
+      for(auto i = 0ul; i < N_add; ++i){ ring.fetch_add(3); }
+    }));
+  }
+  for(auto& f : futures){ f.wait(); }
+
+  EQUAL(ring.get_next_index(), (3 * N_add * cores) % buffer_size);
+  EQUAL(ring.get_stored_size(), buffer_size);
+}
+
+void test_SlotSequence(){
+  constexpr const auto buffer_size = 8ul;
+
+  std::cout << std::endl;
+  std::cout << "SlotSequence" << std::endl;
+
+  auto seq = ymd::CppThreadSafeSlotSequence(buffer_size);
+  auto idx = std::vector<std::size_t>{0, 1, 6, 7};
+  auto before = std::vector<std::uint64_t>(idx.size());
+  bool ok[4];
+
+  // Never committed
+  seq.load(idx.data(), idx.size(), before.data());
+  EQUAL(seq.validate(idx.data(), idx.size(), before.data(), ok), 0ul);
+
+  // [6, 10) wraps around to [6, 8) + [0, 2)
+  seq.reserve(6, 4);
+  seq.load(idx.data(), idx.size(), before.data());
+  EQUAL(seq.validate(idx.data(), idx.size(), before.data(), ok), 0ul);
+  seq.commit(6, 4);
+
+  seq.load(idx.data(), idx.size(), before.data());
+  EQUAL(seq.validate(idx.data(), idx.size(), before.data(), ok), 4ul);
+
+  // Rewritten during read
+  seq.load(idx.data(), idx.size(), before.data());
+  seq.reserve(7, 1);
+  seq.commit(7, 1);
+  EQUAL(seq.validate(idx.data(), idx.size(), before.data(), ok), 3ul);
+  EQUAL(ok[3], false);
+
+  // Overlapped writers
+  seq.reserve(0, 1);
+  seq.reserve(0, 1);
+  seq.commit(0, 1);
+  seq.load(idx.data(), 1, before.data());
+  EQUAL(seq.validate(idx.data(), 1, before.data(), ok), 0ul);
+  seq.commit(0, 1);
+  seq.load(idx.data(), 1, before.data());
+  EQUAL(seq.validate(idx.data(), 1, before.data(), ok), 1ul);
+}
+
 void test_SelectiveEnvironment(){
   constexpr const auto obs_dim = 3ul;
   constexpr const auto act_dim = 1ul;
@@ -217,10 +358,135 @@ void test_SelectiveEnvironment(){
   EQUAL(se.get_stored_episode_size(),1ul);
 }
 
+void test_Gather(){
+  std::cout << std::endl;
+  std::cout << "Gather" << std::endl;
+
+  constexpr const auto rows = 6ul;
+  constexpr const auto stack = 3ul;
+
+  // Contiguous rows of shape (2,)
+  auto a = std::vector<std::int32_t>(rows * 2);
+  std::iota(a.begin(), a.end(), 0);
+
+  // Sliding window (stack compression) of shape (2, stack), whose last axis
+  // shares memory with the next row: w[i][j][k] = m[i+k][j]
+  auto m = std::vector<std::uint8_t>((rows + stack - 1) * 2);
+  std::iota(m.begin(), m.end(), 0);
+
+  auto g = ymd::CppGather{};
+  const std::size_t a_shape[] = {2};
+  const std::ptrdiff_t a_strides[] = {4};
+  g.add_field(a.data(), rows, 8, 4, 1, a_shape, a_strides, a_strides);
+  g.add_field(a.data(), rows, 8, 4, 1, a_shape, a_strides, a_strides, 1);
+
+  // Sliding window into C-contiguous output, and into output of source order
+  const std::size_t w_shape[] = {2, stack};
+  const std::ptrdiff_t w_strides[] = {1, 2};
+  const std::ptrdiff_t c_strides[] = {stack, 1};
+  g.add_field(m.data(), rows, 2, 1, 2, w_shape, w_strides, c_strides);
+  g.add_field(m.data(), rows, 2, 1, 2, w_shape, w_strides, w_strides);
+
+  const auto idx = std::vector<std::size_t>{5, 0, 3, 5};
+  auto out_a = std::vector<std::int32_t>(idx.size() * 2);
+  auto out_next = std::vector<std::int32_t>(idx.size() * 2);
+  auto out_w = std::vector<std::uint8_t>(idx.size() * 2 * stack);
+  auto out_wk = std::vector<std::uint8_t>(idx.size() * 2 * stack);
+  void* outs[] = {out_a.data(), out_next.data(), out_w.data(), out_wk.data()};
+
+  for(auto n_threads : {1ul, 3ul}){
+    g.gather(idx.data(), idx.size(), outs, n_threads);
+
+    for(auto b = 0ul; b < idx.size(); ++b){
+      const auto next = (idx[b] + 1) % rows;
+      for(auto j = 0ul; j < 2; ++j){
+        EQUAL(out_a[b*2 + j], a[idx[b]*2 + j]);
+        EQUAL(out_next[b*2 + j], a[next*2 + j]);
+        for(auto k = 0ul; k < stack; ++k){
+          EQUAL(out_w[(b*2 + j)*stack + k], m[(idx[b] + k)*2 + j]);
+          EQUAL(out_wk[b*2*stack + k*2 + j], m[(idx[b] + k)*2 + j]);
+        }
+      }
+    }
+  }
+
+  // Large enough to be split into multiple threads
+  constexpr const auto dim = 1024ul;
+  auto large = std::vector<float>(rows * dim);
+  std::iota(large.begin(), large.end(), 0.0f);
+
+  auto lg = ymd::CppGather{};
+  const std::size_t l_shape[] = {dim};
+  const std::ptrdiff_t l_strides[] = {sizeof(float)};
+  lg.add_field(large.data(), rows, dim*sizeof(float), sizeof(float),
+               1, l_shape, l_strides, l_strides);
+
+  auto large_idx = std::vector<std::size_t>(512);
+  for(auto b = 0ul; b < large_idx.size(); ++b){ large_idx[b] = (b * 7) % rows; }
+  auto out_large = std::vector<float>(large_idx.size() * dim);
+  void* large_outs[] = {out_large.data()};
+  lg.gather(large_idx.data(), large_idx.size(), large_outs, 4);
+
+  auto large_ok = true;
+  for(auto b = 0ul; b < large_idx.size(); ++b){
+    large_ok &= std::equal(out_large.begin() + b*dim,
+                           out_large.begin() + (b+1)*dim,
+                           large.begin() + large_idx[b]*dim);
+  }
+  EQUAL(large_ok, true);
+
+  // Field without output is skipped.
+  void* skip_outs[] = {nullptr};
+  lg.gather(large_idx.data(), large_idx.size(), skip_outs, 4);
+
+  // Worker threads are reused over calls, and concurrent calls share them.
+  auto check_large = [&](const std::vector<float>& out){
+    auto ok = true;
+    for(auto b = 0ul; b < large_idx.size(); ++b){
+      ok &= std::equal(out.begin() + b*dim, out.begin() + (b+1)*dim,
+                       large.begin() + large_idx[b]*dim);
+    }
+    return ok;
+  };
+
+  auto reuse_ok = true;
+  for(auto n_threads : {4ul, 2ul, 6ul, 4ul}){
+    std::fill(out_large.begin(), out_large.end(), -1.0f);
+    lg.gather(large_idx.data(), large_idx.size(), large_outs, n_threads);
+    reuse_ok &= check_large(out_large);
+  }
+  EQUAL(reuse_ok, true);
+
+  auto concurrent_ok = std::vector<char>(4, false);
+  auto callers = std::vector<std::thread>{};
+  for(auto c = 0ul; c < concurrent_ok.size(); ++c){
+    callers.emplace_back([&, c](){
+      auto out = std::vector<float>(large_idx.size() * dim);
+      void* o[] = {out.data()};
+      auto ok = true;
+      for(auto i = 0; i < 20; ++i){
+        std::fill(out.begin(), out.end(), -1.0f);
+        lg.gather(large_idx.data(), large_idx.size(), o, 4);
+        ok &= check_large(out);
+      }
+      concurrent_ok[c] = ok;
+    });
+  }
+  for(auto& t: callers){ t.join(); }
+  EQUAL(std::all_of(concurrent_ok.begin(), concurrent_ok.end(),
+                    [](auto ok){ return ok; }), true);
+}
+
 int main(){
 
   test_DimensionalBuffer();
   test_PrioritizedSampler();
+  test_PrioritizedSamplerMany();
+  test_FilterUnchangedSinceSample();
+  test_SequencePriorities();
+  test_RingBufferIndex();
+  test_SlotSequence();
+  test_Gather();
   test_SelectiveEnvironment();
 
   return 0;
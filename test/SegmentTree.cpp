@@ -3,6 +3,9 @@
 #include <type_traits>
 #include <future>
 #include <thread>
+#include <vector>
+#include <limits>
+#include <utility>
 
 #include <SegmentTree.hh>
 
@@ -33,6 +36,155 @@ void multi_thread_test(){
   std::cout << std::endl;
 }
 
+void incremental_test(){
+  constexpr auto buffer_size = 1024ul;
+  auto add = [](auto a,auto b){ return a+b; };
+  auto st = ymd::SegmentTree<double>(buffer_size, add);
+  auto mt = ymd::SegmentTree<double,true>(buffer_size, add);
+
+  for(auto n = 0ul; n < 10ul; ++n){
+    for(auto i = 0ul; i < 37ul; ++i){
+      auto index = (n * 131 + i * 17) % buffer_size;
+      st.set(index, i * 0.5);
+      mt.set(index, i * 0.5);
+    }
+    st.set((n * 97) % buffer_size, 2.0, 50);
+    mt.set((n * 97) % buffer_size, 2.0, 50);
+
+    ymd::AlmostEqual(mt.reduce(0, buffer_size), st.reduce(0, buffer_size));
+    ymd::AlmostEqual(mt.reduce(100, 600), st.reduce(100, 600));
+  }
+  std::cout << "incremental update: "
+            << mt.reduce(0, buffer_size) << std::endl;
+}
+
+void batch_search_test(){
+  constexpr auto buffer_size = 1000ul;
+  auto st = ymd::SegmentTree<double>(ymd::PowerOf2(buffer_size),
+                                     [](auto a,auto b){ return a+b; });
+  for(auto i = 0ul; i < buffer_size; ++i){ st.set(i, (i % 7) * 0.25); }
+
+  auto masses = std::vector<double>{};
+  for(auto m = -1.0; m < st.reduce(0, buffer_size) + 10.0; m += 3.7){
+    masses.push_back(m);
+  }
+
+  auto indexes = std::vector<std::size_t>(masses.size());
+  st.largest_region_indexes(masses.begin(), masses.end(), indexes.begin(),
+                            buffer_size);
+
+  for(auto i = 0ul; i < masses.size(); ++i){
+    auto m = masses[i];
+    ymd::Equal(indexes[i],
+               st.largest_region_index([=](auto v){ return v <= m; },
+                                       buffer_size));
+  }
+  std::cout << "batch search: " << masses.size() << " masses" << std::endl;
+}
+
+void functor_test(){
+  constexpr auto buffer_size = 100ul;
+  auto sum = ymd::SumTree<double>(ymd::PowerOf2(buffer_size), ymd::SumOp<double>{});
+  auto min = ymd::MinTree<double>(ymd::PowerOf2(buffer_size), ymd::MinOp<double>{},
+                                  std::numeric_limits<double>::max());
+  for(auto i = 0ul; i < buffer_size; ++i){
+    sum.set(i, (i % 11) + 1.0);
+    min.set(i, (i % 11) + 1.0);
+  }
+
+  for(auto [s, e] : {std::pair{0ul, 100ul}, {3ul, 4ul}, {5ul, 37ul}, {63ul, 65ul}}){
+    auto expected_sum = 0.0;
+    auto expected_min = std::numeric_limits<double>::max();
+    for(auto i = s; i < e; ++i){
+      expected_sum += (i % 11) + 1.0;
+      expected_min = std::min(expected_min, (i % 11) + 1.0);
+    }
+    ymd::AlmostEqual(sum.reduce(s, e), expected_sum);
+    ymd::AlmostEqual(min.reduce(s, e), expected_min);
+  }
+  std::cout << "functor: [0,100) sum: " << sum.reduce(0, buffer_size)
+            << " min: " << min.reduce(0, buffer_size) << std::endl;
+}
+
+template<bool MultiThread>
+void wide_test(std::size_t buffer_size){
+  auto add = [](auto a,auto b){ return a+b; };
+  auto st = ymd::SegmentTree<double>(ymd::PowerOf2(buffer_size), add);
+  auto wide = ymd::WideSegmentTree<double,MultiThread>(buffer_size, add);
+  auto wide_min = ymd::WideMinTree<double,MultiThread>(buffer_size, ymd::MinOp<double>{},
+                                                       std::numeric_limits<double>::max());
+
+  for(auto i = 0ul; i < buffer_size; ++i){
+    st.set(i, (i % 13) * 0.5);
+    wide.set(i, (i % 13) * 0.5);
+    wide_min.set(i, (i % 13) + 1.0);
+  }
+  st.set(buffer_size / 3, 4.0, buffer_size / 2);
+  wide.set(buffer_size / 3, 4.0, buffer_size / 2);
+
+  for(auto [s, e] : {std::pair{0ul, buffer_size}, {1ul, 2ul},
+                     {3ul, buffer_size / 2}, {buffer_size / 5, buffer_size - 1}}){
+    ymd::AlmostEqual(wide.reduce(s, e), st.reduce(s, e));
+  }
+  ymd::AlmostEqual(wide_min.reduce(0, buffer_size), 1.0);
+  ymd::AlmostEqual(wide_min.reduce(2, 3), 3.0);
+
+  auto masses = std::vector<double>{};
+  for(auto m = 0.25; m < st.reduce(0, buffer_size) + 10.0; m += 7.3){
+    masses.push_back(m);
+  }
+  auto indexes = std::vector<std::size_t>(masses.size());
+  wide.largest_region_indexes(masses.begin(), masses.end(), indexes.begin(),
+                              buffer_size);
+  for(auto i = 0ul; i < masses.size(); ++i){
+    auto m = masses[i];
+    ymd::Equal(indexes[i],
+               st.largest_region_index([=](auto v){ return v <= m; }, buffer_size));
+    ymd::Equal(wide.largest_region_index([=](auto v){ return v <= m; }, buffer_size),
+               indexes[i]);
+  }
+
+  std::cout << "wide (MultiThread: " << MultiThread << ", size: " << buffer_size
+            << "): " << wide.reduce(0, buffer_size) << std::endl;
+}
+
+template<typename Tree>
+void scatter_test(Tree&& bulk, std::size_t buffer_size, const char* name){
+  auto add = [](auto a,auto b){ return a+b; };
+  auto st = ymd::SegmentTree<double>(ymd::PowerOf2(buffer_size), add);
+
+  // Duplicated indexes: the last write wins.
+  auto indexes = std::vector<std::size_t>{};
+  auto values = std::vector<double>{};
+  for(auto i = 0ul; i < 3 * buffer_size; i += 3){
+    indexes.push_back((i * 7) % buffer_size);
+    values.push_back((i % 17) * 0.25);
+  }
+  for(auto i = 0ul; i < indexes.size(); ++i){ st.set(indexes[i], values[i]); }
+  bulk.scatter(indexes.data(), values.data(), indexes.size());
+  bulk.scatter(indexes.data(), values.data(), 0);
+
+  for(auto i = 0ul; i < buffer_size; ++i){ ymd::AlmostEqual(bulk.get(i), st.get(i)); }
+  for(auto [s, e] : {std::pair{0ul, buffer_size}, {0ul, 1ul},
+                     {buffer_size / 3, buffer_size - buffer_size / 4}}){
+    ymd::AlmostEqual(bulk.reduce(s, e), st.reduce(s, e));
+  }
+
+  std::cout << "scatter (" << name << ", size: " << buffer_size << "): "
+            << bulk.reduce(0, buffer_size) << std::endl;
+}
+
+template<typename Tree>
+void wrap_generator_test(Tree&& st, const char* name){
+  // Generator continues over the ring wrap: [12, 16) and [0, 6)
+  st.set(12, [v = 0.0]() mutable { return v += 1.0; }, 10);
+  for(auto i = 0ul; i < 10ul; ++i){
+    ymd::AlmostEqual(st.get((12 + i) % 16), i + 1.0);
+  }
+  std::cout << "wrap generator (" << name << "): "
+            << ymd::AlmostEqual(st.reduce(0, 16), 55.0) << std::endl;
+}
+
 int main(){
   constexpr auto buffer_size = 16;
 
@@ -75,6 +227,28 @@ int main(){
 	    << std::endl;
 
   multi_thread_test();
+  incremental_test();
+  batch_search_test();
+  functor_test();
+  wide_test<false>(7);
+  wide_test<false>(1000);
+  wide_test<false>(5000);
+  wide_test<true>(1000);
+
+  {
+    auto add = [](auto a,auto b){ return a+b; };
+    wrap_generator_test(ymd::SegmentTree<double>(16, add), "binary");
+    wrap_generator_test(ymd::WideSegmentTree<double,true>(16, add), "wide MultiThread");
+  }
+
+  for(auto n : {1ul, 16ul, 1000ul}){
+    auto add = [](auto a,auto b){ return a+b; };
+    scatter_test(ymd::SegmentTree<double>(ymd::PowerOf2(n), add), n, "binary");
+    scatter_test(ymd::SegmentTree<double,true>(ymd::PowerOf2(n), add), n,
+                 "binary MultiThread");
+    scatter_test(ymd::WideSegmentTree<double>(n, add), n, "wide");
+    scatter_test(ymd::WideSegmentTree<double,true>(n, add), n, "wide MultiThread");
+  }
 
   return 0;
 }
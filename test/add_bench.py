@@ -0,0 +1,32 @@
+"""
+Benchmark of adding a single transition with five small fields
+
+$ python add_bench.py
+"""
+import timeit
+
+import numpy as np
+
+from cpprb import ReplayBuffer, PrioritizedReplayBuffer
+
+
+env_dict = {"obs": {"shape": 4}, "act": {}, "rew": {},
+            "next_obs": {"shape": 4}, "done": {}}
+n_steps = 20000
+
+
+def bench(cls, dtype, **kwargs):
+    rb = cls(int(1e+5), env_dict, **kwargs)
+    obs = np.ones(4, dtype=dtype)
+    next_obs = np.ones(4, dtype=dtype)
+    f = lambda: rb.add(obs=obs, act=1, rew=0.5, next_obs=next_obs, done=0.0)
+    return min(timeit.repeat(f, number=n_steps, repeat=5)) / n_steps * 1e+6
+
+
+if __name__ == "__main__":
+    for cls in [ReplayBuffer, PrioritizedReplayBuffer]:
+        for dtype in [np.single, np.double]:
+            for unchecked_add in [False, True]:
+                t = bench(cls, dtype, unchecked_add=unchecked_add)
+                print(f"{cls.__name__}, obs: {np.dtype(dtype).name}, "
+                      f"unchecked_add: {unchecked_add}: {t:.2f} us/add")
@@ -0,0 +1,62 @@
+"""
+Benchmark of sampling gather: NumPy indexing vs C++ kernel (gather_threads)
+
+Atari-like frames (84x84 uint8, 4 stacked) with next_of and stack_compress are
+stored, then batches are sampled repeatedly. Gathers of the same indexes are
+also timed alone, which include the overhead of worker threads per call.
+
+$ python gather_bench.py
+"""
+import time
+
+import numpy as np
+
+from cpprb import ReplayBuffer
+
+
+buffer_size = int(1e+5)
+batch_size = 512
+n_steps = 200
+env_dict = {"obs": {"shape": (84, 84, 4), "dtype": np.ubyte},
+            "act": {"dtype": np.int64}, "rew": {}, "done": {}}
+
+
+def fill(gather_threads):
+    rb = ReplayBuffer(buffer_size, env_dict, next_of="obs",
+                      stack_compress="obs", gather_threads=gather_threads)
+    obs = np.random.randint(0, 256, (84, 84, 4), dtype=np.ubyte)
+    for _ in range(buffer_size // 1000):
+        rb.add(obs=np.broadcast_to(obs, (1000, 84, 84, 4)),
+               act=np.zeros(1000, dtype=np.int64),
+               rew=np.zeros(1000), done=np.zeros(1000),
+               next_obs=np.broadcast_to(obs, (1000, 84, 84, 4)))
+    return rb
+
+
+def bench(rb):
+    rb.sample(batch_size)
+    t = time.perf_counter()
+    for _ in range(n_steps):
+        rb.sample(batch_size)
+    return n_steps / (time.perf_counter() - t)
+
+
+def bench_gather(rb):
+    idx = np.random.randint(0, buffer_size, batch_size)
+    rb._encode_sample(idx, keys="obs")
+    t = time.perf_counter()
+    for _ in range(n_steps):
+        rb._encode_sample(idx, keys="obs")
+    return (time.perf_counter() - t) / n_steps * 1e+6
+
+
+if __name__ == "__main__":
+    rb = fill(0)
+    base = bench(rb)
+    print(f"NumPy: {base:.0f} batches/s, gather {bench_gather(rb):.0f} us")
+    for n in [1, 2, 4]:
+        rb = fill(n)
+        throughput = bench(rb)
+        print(f"gather_threads={n}: "
+              f"{throughput:.0f} batches/s ({throughput/base:.2f}x), "
+              f"gather {bench_gather(rb):.0f} us")
@@ -0,0 +1,76 @@
+"""
+Scaling benchmark of MPPrioritizedReplayBuffer with multiple learners
+
+Explorers keep adding transitions, while 1 to 8 learners sample and update
+priorities on a single shared buffer. Total learner throughput is reported.
+
+$ python mp_learner_bench.py
+"""
+from multiprocessing import Barrier, Event, Process, SimpleQueue
+import time
+
+import numpy as np
+
+from cpprb import MPPrioritizedReplayBuffer
+
+
+buffer_size = int(1e+6)
+batch_size = 256
+n_explorers = 4
+n_steps = 500
+env_dict = {"obs": {"shape": 64}, "act": {"dtype": np.int64}, "rew": {}}
+
+
+def explorer(rb, stop):
+    obs = np.zeros((32, 64))
+    act = np.zeros(32, dtype=np.int64)
+    rew = np.zeros(32)
+    while not stop.is_set():
+        rb.add(obs=obs, act=act, rew=rew, priorities=np.random.rand(32))
+
+
+def learner(rb, barrier, queue):
+    barrier.wait()
+    t = time.perf_counter()
+    for _ in range(n_steps):
+        s = rb.sample(batch_size)
+        rb.update_priorities(s["indexes"], np.random.rand(batch_size))
+    queue.put(time.perf_counter() - t)
+
+
+def bench(n_learners):
+    rb = MPPrioritizedReplayBuffer(buffer_size, env_dict)
+    rb.add(obs=np.zeros((buffer_size, 64)),
+           act=np.zeros(buffer_size, dtype=np.int64),
+           rew=np.zeros(buffer_size))
+
+    stop = Event()
+    barrier = Barrier(n_learners)
+    queue = SimpleQueue()
+
+    explorers = [Process(target=explorer, args=[rb, stop])
+                 for _ in range(n_explorers)]
+    learners = [Process(target=learner, args=[rb, barrier, queue])
+                for _ in range(n_learners)]
+
+    for p in explorers + learners:
+        p.start()
+
+    elapsed = max(queue.get() for _ in learners)
+
+    for p in learners:
+        p.join()
+    stop.set()
+    for p in explorers:
+        p.join()
+
+    return n_learners * n_steps / elapsed
+
+
+if __name__ == "__main__":
+    base = None
+    for n in [1, 2, 4, 8]:
+        throughput = bench(n)
+        base = base or throughput
+        print(f"learners: {n}, "
+              f"throughput: {throughput:.0f} steps/s ({throughput/base:.2f}x)")
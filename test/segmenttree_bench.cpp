@@ -2,6 +2,7 @@
 #include <iostream>
 #include <iterator>
 #include <chrono>
+#include <random>
 #include <vector>
 
 #include <SegmentTree.hh>
@@ -21,6 +22,69 @@ auto bench = [](auto&& F, auto n, auto fmt=""){
  };
 
 
+template<typename Tree>
+void bench_update(Tree& tree, std::size_t buffer_size, std::size_t k,
+                  std::size_t n, const char* fmt){
+  // Explorers set k random leaves, then learner reduces (sample) once.
+  auto g = std::mt19937{0};
+  auto d = std::uniform_int_distribution<std::size_t>{0, buffer_size-1};
+  bench([&]() mutable {
+    for(auto i=0ul; i < k; ++i){ tree.set(d(g), 0.5f); }
+    tree.reduce(0, buffer_size);
+  }, n, fmt);
+}
+
+void bench_dirty(std::size_t buffer_size){
+  const auto size = ymd::PowerOf2(buffer_size);
+  auto add = [](auto a, auto b){ return a+b; };
+
+  // Full rebuild (legacy) vs Incremental (dirty leaf bitmap)
+  auto full = ymd::SegmentTree<float,true>(size, add, 0.0f,
+                                           nullptr, nullptr, true, nullptr, false);
+  auto incr = ymd::SegmentTree<float,true>(size, add);
+
+  std::cout << "buffer_size: " << buffer_size << std::endl;
+  for(auto k : {10ul, 1000ul, 100000ul}){
+    std::cout << " k: " << k << std::endl;
+    bench_update(full, buffer_size, k, 10, "  full: ");
+    bench_update(incr, buffer_size, k, 10, "  incr: ");
+  }
+  std::cout << full.reduce(0, buffer_size) << " "
+            << incr.reduce(0, buffer_size) << std::endl;
+}
+
+template<typename Tree>
+void bench_search(Tree& tree, std::size_t buffer_size, const char* name){
+  auto g = std::mt19937{0};
+  auto d = std::uniform_int_distribution<std::size_t>{0, buffer_size-1};
+  auto u = std::uniform_real_distribution<float>{0.0f, 1.0f};
+
+  tree.set(0, [](){ return 1.0f; }, buffer_size, buffer_size);
+  tree.reduce(0, buffer_size);
+
+  auto sink = 0.0;
+  std::cout << name << std::endl;
+  bench([&]() mutable { tree.set(d(g), u(g)); }, 100000, "  set1: ");
+  bench([&]() mutable { sink += tree.reduce(0, buffer_size); }, 1, "  red : ");
+  bench([&]() mutable {
+    const auto m = u(g) * buffer_size * 0.5f;
+    sink += tree.largest_region_index([=](auto v){ return v <= m; },
+                                      buffer_size);
+  }, 100000, "  lridx: ");
+  std::cout << "  (" << sink << ")" << std::endl;
+}
+
+void bench_wide(std::size_t buffer_size){
+  // Binary tree (power of 2 leaves) vs Cache-line wide tree
+  auto binary = ymd::SumTree<float>(ymd::PowerOf2(buffer_size), ymd::SumOp<float>{});
+  auto wide = ymd::WideSumTree<float>(buffer_size, ymd::SumOp<float>{});
+
+  std::cout << "buffer_size: " << buffer_size << std::endl;
+  bench_search(binary, buffer_size, " binary");
+  bench_search(wide, buffer_size, " wide");
+}
+
+
 int main(int argc, char** argv){
   constexpr const auto buffer_size = 1000000ul;
   constexpr const auto size = ymd::PowerOf2(buffer_size);
@@ -43,6 +107,39 @@ int main(int argc, char** argv){
     sum.largest_region_index([&](auto v){ return v <= 79.8*(i++); }, 30000);
   },
     10000, "sum1.lridx: ");
+  {
+    auto masses = std::vector<float>{};
+    std::generate_n(std::back_inserter(masses), 10000,
+                    [i=0]() mutable { return 79.8*(i++); });
+    auto indexes = std::vector<std::size_t>(masses.size());
+    bench([&]() mutable {
+      sum.largest_region_indexes(masses.begin(), masses.end(), indexes.begin(),
+                                 30000);
+    },
+      1, "sum1.lridxs: ");
+  }
+
+  // Template functor (no std::function)
+  auto sum3 = ymd::SumTree<float>(size, ymd::SumOp<float>{});
+
+  bench([&,i=0, j=0]() mutable { sum3.set(i++, j++); }, 10000, "sum3.set A: ");
+  bench([&,i=100]() mutable { sum3.set(100*(i++),
+				      [j=0]()mutable{ return j++; },
+				      100,
+				      buffer_size); }, 100, "sum3.set B: ");
+  bench([&,i=20]() mutable { sum3.set(1000*(i++),
+				     [j=0]()mutable{ return j++; },
+				     1000,
+				      buffer_size); }, 10, "sum3.set C: ");
+  auto sink = 0.0;
+  bench([&,i=0ul]() mutable { sink += sum.reduce(i, 30000 + i); ++i; },
+        10000, "sum1.red C: ");
+  bench([&,i=0ul]() mutable { sink += sum3.reduce(i, 30000 + i); ++i; },
+        10000, "sum3.red C: ");
+  bench([&,i=0]() mutable {
+    sink += sum3.largest_region_index([&](auto v){ return v <= 79.8*(i++); }, 30000);
+  },
+    10000, "sum3.lridx: ");
 
   bench([&,i=0, j=0]() mutable { sum2.set(i++, j++); }, 10000, "sum2.set A: ");
   bench([&,i=100]() mutable { sum2.set(100*(i++),
@@ -60,8 +157,10 @@ int main(int argc, char** argv){
   },
     10000, "sum2.lridx: ");
 
-  std::cout << sum.get(1) << " " << sum2.get(1) << std::endl;
-  std::cout << sum.get(10001) << " " << sum2.get(10001) << std::endl;
+  std::cout << sink << std::endl;
+  std::cout << sum.get(1) << " " << sum2.get(1) << " " << sum3.get(1) << std::endl;
+  std::cout << sum.get(10001) << " " << sum2.get(10001) << " " << sum3.get(10001)
+            << std::endl;
 
   //
 
@@ -89,6 +188,14 @@ int main(int argc, char** argv){
 	1, "  PER.smpA: ");
   bench([&]() mutable { per.sample(32,beta,weights,indexes,20000); },
 	1, "  PER.smpB: ");
+  bench([&]() mutable { per.sample(4096,beta,weights,indexes,20000); },
+	10, "  PER.smpC: ");
+  per.sample(4096,beta,weights,indexes,buffer_size);
+  auto td = std::vector<float>(indexes.size(), 0.7f);
+  bench([&, j=0]() mutable {
+    std::fill(td.begin(), td.end(), 0.01f * (++j));
+    per.update_priorities(indexes, td);
+  }, 10, "  PER.updC: ");
 
   bench([&, i=0,j=0]() mutable { mpper.set_priorities(i++, 0.02*(j++ % 321)); },
 	10000, "MPPER.add1: ");
@@ -101,5 +208,13 @@ int main(int argc, char** argv){
   bench([&]() mutable { mpper.sample(32,beta,weights,indexes,20000); },
 	1, "MPPER.smpB: ");
 
+  //
+
+  bench_dirty(1000000ul);
+  bench_dirty(10000000ul);
+
+  bench_wide(1000000ul);
+  bench_wide(10000000ul);
+
   return 0;
 }
@@ -253,6 +253,42 @@ class TestPrioritizedReplayBuffer(TestReplayBuffer,TestPrioritizedBase):
         self.assertAlmostEqual(p[0],1.0)
         self.assertAlmostEqual(unchange_rb.get_max_priority(),2.0)
 
+    def test_wide_tree(self):
+        buffer_size = 1000
+        wide_rb = PrioritizedReplayBuffer(buffer_size,{"done": {}},
+                                          alpha=1.0,wide_tree=True)
+
+        p = np.arange(buffer_size) % 7 + 1.0
+        wide_rb.add(done=np.zeros(buffer_size),priorities=p)
+        self.assertAlmostEqual(wide_rb.get_max_priority(),7.0)
+
+        s = wide_rb.sample(self.batch_size,beta=1.0)
+        self.assertTrue((s["indexes"] < buffer_size).all())
+        np.testing.assert_allclose(s["weights"],
+                                   (1.0 + 1e-4) / (p[s["indexes"]] + 1e-4),
+                                   rtol=1e-5)
+
+        one_hot = 42
+        wide_rb.update_priorities(np.arange(buffer_size),
+                                  np.where(np.arange(buffer_size) == one_hot,
+                                           1e+8, 1e-8))
+        s = wide_rb.sample(self.batch_size)
+        u, counts = np.unique(s["indexes"],return_counts=True)
+        self.assertEqual(u[counts.argmax()],one_hot)
+
+
+    def test_update_duplicated_indexes(self):
+        dup_rb = PrioritizedReplayBuffer(8,{"done": {}},alpha=1.0,eps=0.0)
+        dup_rb.add(done=np.zeros(8),priorities=np.ones(8))
+
+        # The last priority wins for duplicated indexes.
+        dup_rb.update_priorities([3,5,3,3],[100.0,2.0,1e+8,1e-8])
+        self.assertAlmostEqual(dup_rb.get_max_priority(),1e+8)
+
+        s = dup_rb.sample(64,beta=1.0)
+        self.assertTrue((s["indexes"] != 3).all())
+        w = s["weights"][s["indexes"] == 5]
+        np.testing.assert_allclose(w,np.full_like(w,1e-8 / 2.0),rtol=1e-5)
 
 class TestNstepBase:
     pass
@@ -5,7 +5,9 @@ import unittest
 
 import numpy as np
 
-from cpprb import create_buffer, ReplayBuffer, PrioritizedReplayBuffer
+from cpprb import (create_buffer, ReplayBuffer, PrioritizedReplayBuffer,
+                   MPReplayBuffer, MPPrioritizedReplayBuffer, ReverseReplayBuffer,
+                   sequence_priorities)
 
 
 @contextmanager
@@ -102,5 +104,751 @@ class TestShuffleTransitions(unittest.TestCase):
         self.assertFalse(set(np.ravel(s1)) ^ set(np.ravel(s2)))
 
 
+class TestSampleOut(unittest.TestCase):
+    env_dict = {"obs": {"shape": (4,4)}, "act": {"dtype": np.int64}}
+
+    def _check(self, rb, *args, prioritized=False):
+        obs = np.arange(64, dtype=np.single)
+        rb.add(obs=np.repeat(obs, 16).reshape(64,4,4), act=np.arange(64),
+               next_obs=np.repeat(obs+1, 16).reshape(64,4,4))
+        rb.on_episode_end()
+
+        out = {"obs": np.empty((32,4,4), dtype=np.single),
+               "act": np.empty((32,1), dtype=np.int64),
+               "next_obs": np.empty((32,4,4), dtype=np.single)}
+        if prioritized:
+            out["weights"] = np.empty(32, dtype=np.single)
+            out["indexes"] = np.empty(32, dtype=np.uintp)
+
+        for _ in range(3):
+            s = rb.sample(32, *args, out=out)
+            for k, v in out.items():
+                self.assertIs(s[k], v)
+            np.testing.assert_array_equal(s["obs"][:,0,0],
+                                          np.ravel(s["act"]))
+            np.testing.assert_array_equal(s["next_obs"][:,0,0],
+                                          np.ravel(s["act"]) + 1)
+            if prioritized:
+                np.testing.assert_array_equal(s["indexes"],
+                                              np.ravel(s["act"]))
+
+        # Values not in `out` are allocated.
+        s = rb.sample(32, *args, out={"obs": out["obs"]})
+        self.assertIs(s["obs"], out["obs"])
+        self.assertEqual(s["act"].shape, (32,1))
+
+        with self.assertRaises(ValueError):
+            rb.sample(16, *args, out=out)
+
+    def test_ReplayBuffer(self):
+        self._check(ReplayBuffer(64, self.env_dict, next_of="obs"))
+
+    def test_PrioritizedReplayBuffer(self):
+        self._check(PrioritizedReplayBuffer(64, self.env_dict, next_of="obs"),
+                    0.4, prioritized=True)
+
+    def test_MPReplayBuffer(self):
+        env_dict = {**self.env_dict, "next_obs": {"shape": (4,4)}}
+        self._check(MPReplayBuffer(64, env_dict))
+
+    def test_MPPrioritizedReplayBuffer(self):
+        env_dict = {**self.env_dict, "next_obs": {"shape": (4,4)}}
+        self._check(MPPrioritizedReplayBuffer(64, env_dict), 0.4,
+                    prioritized=True)
+
+
+class TestGatherThreads(unittest.TestCase):
+    env_dict = {"obs": {"shape": (4,3), "dtype": np.ubyte},
+                "act": {"dtype": np.int64}, "rew": {}}
+
+    def _fill(self, rb):
+        for i in range(150):
+            obs = np.full((4,3), i % 256, dtype=np.ubyte)
+            rb.add(obs=obs, act=i, rew=0.5*i, next_obs=obs+1)
+            if i % 37 == 36:
+                rb.on_episode_end()
+
+    def test_same_as_numpy(self):
+        kwargs = {"next_of": "obs", "stack_compress": "obs"}
+        rb = ReplayBuffer(64, self.env_dict, **kwargs)
+        grb = ReplayBuffer(64, self.env_dict, gather_threads=4, **kwargs)
+        self._fill(rb)
+        self._fill(grb)
+
+        for idx in [np.arange(64), np.random.randint(0, 64, 20000), [63]]:
+            s = rb._encode_sample(idx)
+            g = grb._encode_sample(idx)
+            self.assertEqual(s.keys(), g.keys())
+            for k in s:
+                np.testing.assert_array_equal(s[k], g[k])
+
+    def test_out(self):
+        rb = PrioritizedReplayBuffer(64, self.env_dict, next_of="obs",
+                                     stack_compress="obs", gather_threads=2)
+        self._fill(rb)
+
+        # C-contiguous "out" differs from stack_compress layout.
+        out = {"obs": np.empty((32,4,3), dtype=np.ubyte),
+               "next_obs": np.empty((32,4,3), dtype=np.ubyte)}
+        for _ in range(2):
+            s = rb.sample(32, out=out)
+            self.assertIs(s["obs"], out["obs"])
+            self.assertIs(s["next_obs"], out["next_obs"])
+            np.testing.assert_array_equal(s["obs"][:,0,0],
+                                          np.ravel(s["act"]) % 256)
+            out = s
+
+        with self.assertRaises(ValueError):
+            rb.sample(16, out=out)
+
+    def test_out_of_range(self):
+        rb = ReplayBuffer(64, self.env_dict, gather_threads=1)
+        with self.assertRaises(IndexError):
+            rb._encode_sample([64])
+
+
+class TestAddPlan(unittest.TestCase):
+    env_dict = {"obs": {"shape": (2,3)}, "act": {"dtype": np.int64},
+                "rew": {"dtype": np.double}, "flag": {"dtype": np.bool_},
+                "done": {}}
+
+    def _values(self, i, N=None):
+        obs = np.arange(6, dtype=np.single).reshape(2,3) + i
+        if N is None:
+            return {"obs": obs, "act": i, "rew": 0.5*i, "flag": bool(i%2),
+                    "done": float(i%2)}
+        return {"obs": np.stack([obs+n for n in range(N)]),
+                "act": np.arange(i, i+N)[:,np.newaxis],
+                "rew": np.arange(N)[:,np.newaxis] + 0.5*i,
+                "flag": np.ones((N,1), dtype=bool),
+                "done": np.zeros((N,1), dtype=np.single)}
+
+    def _check(self, **kwargs):
+        rb = ReplayBuffer(8, self.env_dict, **kwargs)
+        ref = {k: [] for k in self.env_dict}
+        shape = {k: (2,3) if k == "obs" else (1,) for k in self.env_dict}
+
+        def add(v):
+            rb.add(**v)
+            for k in self.env_dict:
+                ref[k].extend(np.reshape(v[k], (-1,) + shape[k]))
+
+        for i in range(5):
+            add(self._values(i))
+        add(self._values(10, N=3))
+        add({k: np.asarray(v, dtype=np.double)
+             for k, v in self._values(20).items()})
+        add(self._values(30, N=6))
+
+        idx = np.arange(rb.get_next_index() - 8, rb.get_next_index()) % 8
+        s = rb.get_all_transitions()
+        for k in self.env_dict:
+            np.testing.assert_array_equal(s[k][idx], ref[k][-8:])
+
+    def test_checked(self):
+        self._check()
+
+    def test_unchecked(self):
+        self._check(unchecked_add=True)
+
+    def test_converted(self):
+        rb = ReplayBuffer(4, {"obs": {"shape": 3}}, next_of="obs")
+        rb.add(obs=[1,2,3], next_obs=[[2,3,4]])
+        rb.add(obs=[[3,4,5],[4,5,6]], next_obs=[[4,5,6],[5,6,7]])
+
+        s = rb.get_all_transitions()
+        np.testing.assert_array_equal(s["obs"], [[1,2,3],[3,4,5],[4,5,6]])
+        np.testing.assert_array_equal(s["next_obs"], [[3,4,5],[4,5,6],[5,6,7]])
+
+        with self.assertRaises(ValueError):
+            rb.add(obs=[1,2], next_obs=[1,2])
+
+    def test_larger_than_buffer(self):
+        for unchecked in [False, True]:
+            rb = ReplayBuffer(4, {"obs": {"shape": 1024}, "done": {}},
+                              unchecked_add=unchecked)
+            rb.add(obs=np.ones((4000,1024), dtype=np.single),
+                   done=np.zeros(4000, dtype=np.single))
+            self.assertEqual(rb.get_next_index(), 0)
+
+            # Only the last transitions are stored, as if added one by one.
+            rb.add(obs=np.ones((10,1024), dtype=np.single),
+                   done=np.arange(10, dtype=np.single))
+            self.assertEqual(rb.get_next_index(), 2)
+            np.testing.assert_array_equal(rb.get_all_transitions()["done"][:,0],
+                                          [8, 9, 6, 7])
+
+        rb = PrioritizedReplayBuffer(4, {"done": {}}, alpha=1.0)
+        rb.add(done=np.arange(10), priorities=np.arange(10) + 1)
+        self.assertEqual(rb.get_max_priority(), 10)
+        s = rb.sample(64, beta=1.0)
+        np.testing.assert_allclose(s["weights"] * (s["done"][:,0] + 1), 7,
+                                   rtol=1e-4)
+
+
+class TestReserveCommit(unittest.TestCase):
+    env_dict = {"obs": {"shape": (2,3)}, "act": {}}
+    kwargs = {"next_of": "obs", "stack_compress": "obs"}
+
+    def _obs(self, i):
+        return np.stack([np.full((2,), i+k) for k in range(3)], axis=-1)
+
+    def _commit(self, rb, first, n, **kwargs):
+        segments = rb.reserve(n)
+        self.assertEqual(sum(len(seg["act"]) for seg in segments), n)
+        i = first
+        for seg in segments:
+            for j in range(len(seg["act"])):
+                seg["obs"][j] = self._obs(i)
+                seg["act"][j] = i
+                i += 1
+        return rb.commit(next_obs=self._obs(first+n), **kwargs)
+
+    def test_same_as_add(self):
+        rb = ReplayBuffer(8, self.env_dict, **self.kwargs)
+        crb = ReplayBuffer(8, self.env_dict, **self.kwargs)
+
+        i = 0
+        for n in [3, 1, 5, 2, 6]:
+            for j in range(i, i+n):
+                rb.add(obs=self._obs(j), act=j, next_obs=self._obs(j+1))
+            index = crb.get_next_index()
+            self.assertEqual(self._commit(crb, i, n), index)
+            i += n
+            if n == 5:
+                rb.on_episode_end()
+                crb.on_episode_end()
+                i += 10
+
+        self.assertEqual(rb.get_next_index(), crb.get_next_index())
+        s = rb._encode_sample(np.arange(8))
+        c = crb._encode_sample(np.arange(8))
+        for k in s:
+            np.testing.assert_array_equal(s[k], c[k])
+
+    def test_priorities(self):
+        rb = PrioritizedReplayBuffer(8, self.env_dict, **self.kwargs)
+        self._commit(rb, 0, 6, priorities=np.full(6, 0.5))
+        self._commit(rb, 6, 4, priorities=[2.0, 3.0, 0.5, 0.5])
+        self.assertAlmostEqual(rb.get_max_priority(), 3.0)
+
+        s = rb.sample(64)
+        np.testing.assert_array_equal(s["obs"][:,0,0], np.ravel(s["act"]))
+
+        with self.assertRaises(ValueError):
+            rb.reserve(2)
+            rb.commit(next_obs=self._obs(0), priorities=[1.0])
+
+    def test_errors(self):
+        rb = ReplayBuffer(8, self.env_dict, next_of="obs")
+        with self.assertRaises(ValueError):
+            rb.commit()
+
+        rb.reserve(2)
+        with self.assertRaises(ValueError):
+            rb.reserve(2)
+        with self.assertRaises(ValueError):
+            rb.add(obs=np.ones((2,3)), act=1, next_obs=np.ones((2,3)))
+        with self.assertRaises(KeyError):
+            rb.commit()
+        self.assertEqual(rb.get_stored_size(), 0)
+
+        rb.clear()
+        with self.assertRaises(ValueError):
+            rb.reserve(9)
+
+
+class TestSlotCache(unittest.TestCase):
+    def _obs(self, i):
+        return np.stack([np.full((2,), i+k) for k in range(3)], axis=-1)
+
+    def test_short_episodes(self):
+        rb = ReplayBuffer(32, {"obs": {"shape": (2,3)}, "act": {}},
+                          next_of="obs", stack_compress="obs")
+        truth = {}
+
+        i = 0
+        for episode in range(60):
+            for _ in range(3 + episode % 3):
+                index = rb.add(obs=self._obs(i), act=i,
+                               next_obs=self._obs(i+1))
+                truth[index] = i
+                i += 1
+            rb.on_episode_end()
+            i += 100
+
+            s = rb._encode_sample(np.arange(rb.get_stored_size()))
+            for index, v in truth.items():
+                np.testing.assert_array_equal(s["obs"][index], self._obs(v))
+                np.testing.assert_array_equal(s["next_obs"][index],
+                                              self._obs(v+1))
+
+        rb.clear()
+        rb.add(obs=self._obs(0), act=0, next_obs=self._obs(1))
+        rb.on_episode_end()
+        np.testing.assert_array_equal(rb.get_all_transitions()["next_obs"][0],
+                                      self._obs(1))
+
+
+class TestSampleSequences(unittest.TestCase):
+    def _obs(self, i):
+        return np.stack([np.full((2,), i+k) for k in range(3)], axis=-1)
+
+    def _fill(self, rb, lengths):
+        episode = {}
+        i = 1
+        for e, n in enumerate(lengths):
+            for _ in range(n):
+                index = rb.add(obs=self._obs(i), act=i, next_obs=self._obs(i+1))
+                episode[index] = e
+                i += 1
+            if e != len(lengths) - 1:
+                rb.on_episode_end()
+                i += 100
+        return episode
+
+    def _check(self, rb, episode, s, B, T):
+        for k in ["obs", "act", "next_obs", "mask", "indexes"]:
+            self.assertEqual(s[k].shape[:2], (B, T))
+
+        for b in range(B):
+            idx = s["indexes"][b]
+            np.testing.assert_array_equal(idx, (idx[0] + np.arange(T)) % 16)
+
+            first = episode[idx[0]]
+            expected = np.array([episode.get(i, -1) == first for i in idx])
+            if first == max(episode.values()):
+                # Ongoing episode ends at the latest transition.
+                expected &= ((idx - rb.get_next_index()) % 16 >=
+                             (idx[0] - rb.get_next_index()) % 16)
+            np.testing.assert_array_equal(s["mask"][b], expected)
+
+            act = s["act"][b,:,0]
+            m = s["mask"][b]
+            np.testing.assert_array_equal(act[m], act[0] + np.arange(T)[m])
+            np.testing.assert_array_equal(act[~m], 0)
+            np.testing.assert_array_equal(s["obs"][b,m,0,:],
+                                          [self._obs(a)[0] for a in act[m]])
+            np.testing.assert_array_equal(s["next_obs"][b,m,0,:],
+                                          [self._obs(a+1)[0] for a in act[m]])
+
+    def test_sequences(self):
+        env_dict = {"obs": {"shape": (2,3)}, "act": {}}
+        for kwargs in [{"next_of": "obs", "stack_compress": "obs"},
+                       {"env_dict": {**env_dict, "next_obs": {"shape": (2,3)}}}]:
+            with self.subTest(kwargs=kwargs):
+                rb = ReplayBuffer(16, **{"env_dict": env_dict, **kwargs})
+                episode = self._fill(rb, [5, 7])
+                s = rb.sample_sequences(64, 4, burn_in=2)
+                self._check(rb, episode, s, 64, 6)
+
+                # Wrap around and overwrite old episodes
+                episode = self._fill(rb, [3, 6, 4, 5, 2])
+                s = rb.sample_sequences(128, 5)
+                self._check(rb, episode, s, 128, 5)
+
+    def test_wrapped_episode(self):
+        for cls in [ReplayBuffer, PrioritizedReplayBuffer]:
+            with self.subTest(cls=cls):
+                rb = cls(8, {"obs": {}})
+                rb.add(obs=np.arange(12))
+
+                # A single episode longer than the buffer must not continue
+                # from the latest transition to its own oldest one.
+                s = rb._encode_sequences([3], 4)
+                np.testing.assert_array_equal(s["obs"][0,:,0], [11, 0, 0, 0])
+                np.testing.assert_array_equal(s["mask"][0],
+                                              [True, False, False, False])
+
+                s = rb.sample_sequences(64, 4)
+                for o, m in zip(s["obs"][:,:,0], s["mask"]):
+                    np.testing.assert_array_equal(o[m], o[0] + np.arange(m.sum()))
+
+
+class TestIterTransitions(unittest.TestCase):
+    def _buffers(self):
+        env_dict = {"obs": {"shape": (2,3)}, "act": {}}
+        return [(ReplayBuffer(16, env_dict), False),
+                (ReplayBuffer(16, env_dict, next_of="obs"), True),
+                (ReplayBuffer(16, env_dict, next_of="obs", stack_compress="obs"), True)]
+
+    def _fill(self, rb, next_of, lengths):
+        i = 1
+        for n in lengths:
+            for _ in range(n):
+                obs = np.stack([np.full((2,), i+k) for k in range(3)], axis=-1)
+                if next_of:
+                    rb.add(obs=obs, act=i, next_obs=obs + 1)
+                else:
+                    rb.add(obs=obs, act=i)
+                i += 1
+            rb.on_episode_end()
+            i += 100
+
+    def _chronological(self, rb):
+        N = rb.get_stored_size()
+        first = rb.get_next_index() if N == rb.get_buffer_size() else 0
+        return (first + np.arange(N)) % rb.get_buffer_size()
+
+    def _assert_equal(self, a, b):
+        self.assertEqual(a.keys(), b.keys())
+        for k in a:
+            np.testing.assert_array_equal(a[k], b[k])
+
+    def test_chronological(self):
+        for lengths in [[5, 4], [5, 7, 3, 6]]:
+            for rb, next_of in self._buffers():
+                with self.subTest(lengths=lengths, next_of=next_of):
+                    self._fill(rb, next_of, lengths)
+                    idx = self._chronological(rb)
+                    batches = list(rb.iter_transitions(5))
+                    self.assertEqual([len(b["act"]) for b in batches],
+                                     [min(5, len(idx)-i) for i in range(0,len(idx),5)])
+                    self._assert_equal({k: np.concatenate([b[k] for b in batches])
+                                        for k in batches[0]},
+                                       rb._encode_sample(idx))
+
+                    segments = rb.unroll()
+                    self.assertEqual(len(segments), 2 if sum(lengths) > 16 else 1)
+                    self._assert_equal({k: np.concatenate([s[k] for s in segments])
+                                        for k in segments[0]},
+                                       rb._encode_sample(idx))
+
+                    batches = list(rb.iter_transitions(5, drop_last=True))
+                    self.assertEqual(len(batches), len(idx) // 5)
+
+    def test_views(self):
+        rb = ReplayBuffer(16, {"obs": {}})
+        rb.add(obs=np.arange(20))
+        old, new = rb.unroll()
+        self.assertFalse(old["obs"].flags.writeable)
+        np.testing.assert_array_equal(old["obs"].ravel(), np.arange(4, 16))
+        np.testing.assert_array_equal(new["obs"].ravel(), np.arange(16, 20))
+
+        batch = next(rb.iter_transitions(8))
+        self.assertTrue(np.shares_memory(batch["obs"], old["obs"]))
+
+    def test_shuffle(self):
+        for rb, next_of in self._buffers():
+            with self.subTest(next_of=next_of):
+                self._fill(rb, next_of, [5, 7, 3, 6])
+                batches = list(rb.iter_transitions(4, shuffle=True))
+                act = np.concatenate([b["act"] for b in batches]).ravel()
+                np.testing.assert_array_equal(np.sort(act),
+                                              np.sort(rb.get_all_transitions()["act"].ravel()))
+                for b in batches:
+                    for k in b:
+                        self.assertEqual(len(b[k]), len(b["act"]))
+
+
+class TestSampleMany(unittest.TestCase):
+    env_dict = {"obs": {"shape": 3}, "act": {}}
+
+    def _fill(self, rb):
+        rb.add(obs=np.arange(64*3).reshape(64,3), act=np.arange(64))
+
+    def _check(self, rb, s, k, B):
+        self.assertEqual(s["obs"].shape, (k, B, 3))
+        self.assertEqual(s["act"].shape, (k, B, 1))
+        np.testing.assert_array_equal(s["obs"][...,0], 3*s["act"][...,0])
+
+    def test_uniform(self):
+        for cls in [ReplayBuffer, MPReplayBuffer]:
+            with self.subTest(cls=cls):
+                rb = cls(64, self.env_dict)
+                self._fill(rb)
+                self._check(rb, rb.sample_many(8, 16), 8, 16)
+
+    def test_prioritized(self):
+        for cls in [PrioritizedReplayBuffer, MPPrioritizedReplayBuffer]:
+            with self.subTest(cls=cls):
+                rb = cls(64, self.env_dict)
+                self._fill(rb)
+                s = rb.sample_many(8, 16)
+                self._check(rb, s, 8, 16)
+                self.assertEqual(s["weights"].shape, (8, 16))
+                self.assertEqual(s["indexes"].shape, (8, 16))
+                np.testing.assert_array_equal(s["act"][...,0], s["indexes"])
+
+                # Every batch is stratified by itself.
+                np.testing.assert_array_equal(s["indexes"] // 4,
+                                              np.broadcast_to(np.arange(16), (8, 16)))
+                self.assertFalse((s["indexes"] == s["indexes"][0]).all())
+
+                rb.update_priorities(s["indexes"].ravel(), np.random.rand(8*16))
+
+    def test_reverse(self):
+        rb1 = ReverseReplayBuffer(64, self.env_dict, stride=5)
+        rb2 = ReverseReplayBuffer(64, self.env_dict, stride=5)
+        self._fill(rb1)
+        self._fill(rb2)
+
+        s = rb1.sample_many(4, 8)
+        self._check(rb1, s, 4, 8)
+        for i in range(4):
+            np.testing.assert_array_equal(s["act"][i], rb2.sample(8)["act"])
+
+
+class TestSampleKeys(unittest.TestCase):
+    env_dict = {"obs": {"shape": (2,3)}, "act": {}, "rew": {}}
+
+    def _fill(self, rb, next_of):
+        for i in range(20):
+            obs = np.stack([np.full((2,), i+k) for k in range(3)], axis=-1)
+            kw = {"next_obs": obs + 1} if next_of else {}
+            rb.add(obs=obs, act=i, rew=0.5*i, **kw)
+            if i % 7 == 6:
+                rb.on_episode_end()
+
+    def test_encode_sample(self):
+        for kwargs in [{}, {"next_of": "obs"},
+                       {"next_of": "obs", "stack_compress": "obs"},
+                       {"next_of": "obs", "stack_compress": "obs", "gather_threads": 2}]:
+            with self.subTest(kwargs=kwargs):
+                rb = ReplayBuffer(16, self.env_dict, **kwargs)
+                self._fill(rb, "next_of" in kwargs)
+                idx = np.arange(16)
+                full = rb._encode_sample(idx)
+
+                for keys, exclude in [("act", None), (["obs", "rew"], None),
+                                      (None, "obs"), (["obs", "act"], ["act"])]:
+                    expected = set(full) if keys is None else set(np.ravel(keys))
+                    expected -= set(() if exclude is None else np.ravel(exclude))
+                    s = rb._encode_sample(idx, keys=keys, exclude=exclude)
+                    self.assertEqual(set(s), expected)
+                    for k in s:
+                        np.testing.assert_array_equal(s[k], full[k])
+
+                if "next_of" in kwargs:
+                    s = rb._encode_sample(idx, keys="next_obs")
+                    self.assertEqual(set(s), {"next_obs"})
+                    np.testing.assert_array_equal(s["next_obs"], full["next_obs"])
+
+                self.assertEqual(set(rb.sample(4, keys=["act"])), {"act"})
+                self.assertEqual(set(rb.get_all_transitions(exclude="obs")),
+                                 set(full) - {"obs"})
+
+                with self.assertRaises(KeyError):
+                    rb.sample(4, keys="unknown")
+
+    def test_out(self):
+        rb = ReplayBuffer(16, self.env_dict)
+        self._fill(rb, False)
+        out = {"act": np.empty((4, 1), np.single), "obs": np.empty((4, 2, 3), np.single)}
+        s = rb.sample(4, out=out, keys="act")
+        self.assertEqual(set(s), {"act"})
+        self.assertIs(s["act"], out["act"])
+
+    def test_prioritized(self):
+        for cls in [PrioritizedReplayBuffer, MPPrioritizedReplayBuffer]:
+            with self.subTest(cls=cls):
+                rb = cls(16, self.env_dict)
+                self._fill(rb, False)
+                s = rb.sample(4, keys=["act", "rew"])
+                self.assertEqual(set(s), {"act", "rew", "weights", "indexes"})
+                np.testing.assert_array_equal(s["rew"], 0.5*s["act"])
+
+    def test_mp(self):
+        rb = MPReplayBuffer(16, self.env_dict)
+        self._fill(rb, False)
+        self.assertEqual(set(rb.sample(4, exclude="obs")), {"act", "rew"})
+        self.assertEqual(set(rb.get_all_transitions(keys="obs")), {"obs"})
+
+
+class TestSequencePER(unittest.TestCase):
+    def test_sequence_priorities(self):
+        errors = np.array([[1, -3, 2], [0.5, 4, -8]])
+        mask = np.array([[True, True, False], [True, True, True]])
+        np.testing.assert_allclose(sequence_priorities(errors, eta=0.5),
+                                   [0.5*3 + 0.5*2, 0.5*8 + 0.5*12.5/3])
+        np.testing.assert_allclose(sequence_priorities(errors, mask, eta=0.9),
+                                   [0.9*3 + 0.1*2, 0.9*8 + 0.1*12.5/3])
+        np.testing.assert_allclose(sequence_priorities(errors, np.zeros((2,3), bool)),
+                                   [0, 0])
+
+    def test_update_sequences(self):
+        rb = PrioritizedReplayBuffer(16, {"obs": {}}, check_for_update=True)
+        rb.add(obs=np.arange(16))
+        rb.on_episode_end()
+
+        s = rb.sample_sequences(8, 3, burn_in=1)
+        self.assertEqual(s["obs"].shape, (8, 4, 1))
+        self.assertEqual(s["weights"].shape, (8,))
+        np.testing.assert_array_equal(s["obs"][:,0,0], s["indexes"][:,0])
+
+        # Only sequence starts are updated, once per sequence.
+        rb.update_priorities(np.arange(16), np.full(16, 1e-8))
+        errors = np.zeros((8, 4))
+        errors[:,1] = 10
+        rb.update_priorities(s["indexes"], errors, mask=s["mask"])
+
+        starts = np.unique(s["indexes"][:,0])
+        s = rb.sample_sequences(256, 2)
+        self.assertGreater(np.isin(s["indexes"][:,0], starts).mean(), 0.95)
+
+
+class TestNstepBatchAdd(unittest.TestCase):
+    env_dict = {"obs": {}, "rew": {}, "done": {}, "next_obs": {}}
+    Nstep = {"size": 5, "gamma": 0.5, "rew": "rew", "next": "next_obs"}
+
+    def _episode(self, rb, chunks, done):
+        T = sum(chunks)
+        rew = np.linspace(1, 2, T)
+        d = np.zeros(T)
+        d[-1] = done
+        i = 0
+        for c in chunks:
+            rb.add(obs=np.arange(i, i+c), rew=rew[i:i+c], done=d[i:i+c],
+                   next_obs=np.arange(i, i+c)+1)
+            i += c
+        rb.on_episode_end()
+
+    def test_batch_equals_single(self):
+        for chunks in [[20], [3, 1, 9, 7], [4, 4, 12], [2, 18]]:
+            for done in [0, 1]:
+                single = ReplayBuffer(64, self.env_dict, Nstep=self.Nstep)
+                batch = ReplayBuffer(64, self.env_dict, Nstep=self.Nstep)
+                for _ in range(2):
+                    self._episode(single, [1] * sum(chunks), done)
+                    self._episode(batch, chunks, done)
+
+                s = single.get_all_transitions()
+                b = batch.get_all_transitions()
+                for k in self.env_dict:
+                    with self.subTest(chunks=chunks, done=done, key=k):
+                        np.testing.assert_allclose(b[k], s[k], rtol=1e-6)
+
+    def test_episode_end(self):
+        rb = ReplayBuffer(64, self.env_dict, Nstep=self.Nstep)
+        self._episode(rb, [20], 1)
+        self._episode(rb, [3], 0)
+        s = rb.get_all_transitions()
+
+        np.testing.assert_array_equal(s["done"][15:20,0], [0, 1, 1, 1, 1])
+        np.testing.assert_array_equal(s["next_obs"][:16,0], np.arange(16)+5)
+
+        # Truncated episode bootstraps from the last next_obs.
+        np.testing.assert_array_equal(s["done"][20:,0], [0, 0, 0])
+        np.testing.assert_array_equal(s["next_obs"][20:,0], [3, 3, 3])
+        np.testing.assert_allclose(s["rew"][20:,0], [1 + 0.5*1.5 + 0.25*2,
+                                                     1.5 + 0.5*2, 2])
+
+    def test_flush_done(self):
+        # Flushed done was accumulated in place, and became 2 or more.
+        for size in [2, 3, 4, 5, 8]:
+            for chunks in [[20], [1] * 20]:
+                with self.subTest(size=size, chunks=chunks):
+                    rb = ReplayBuffer(64, self.env_dict,
+                                      Nstep={**self.Nstep, "size": size})
+                    self._episode(rb, chunks, 1)
+                    np.testing.assert_array_equal(
+                        rb.get_all_transitions()["done"][20-size+1:,0], 1)
+
+    def test_flush_next(self):
+        # Flushed next_obs of truncated episode was not the last next_obs.
+        for T in [2, 4, 9]:
+            with self.subTest(T=T):
+                rb = ReplayBuffer(64, self.env_dict, Nstep=self.Nstep)
+                self._episode(rb, [T], 0)
+                s = rb.get_all_transitions()
+                np.testing.assert_array_equal(s["next_obs"][max(T-4,0):,0], T)
+                np.testing.assert_array_equal(s["done"][:,0], 0)
+
+    def test_done_over_chunks(self):
+        # Batch add accumulated done of windows over chunks for Nstep >= 4.
+        rng = np.random.default_rng(0)
+        T = 30
+        done = (rng.random(T) < 0.3).astype(float)
+        for size in [3, 4, 5]:
+            results = []
+            for chunks in [[1] * T, [7, 8, 15], [T]]:
+                rb = ReplayBuffer(64, self.env_dict,
+                                  Nstep={**self.Nstep, "size": size})
+                i = 0
+                for c in chunks:
+                    rb.add(obs=np.arange(i, i+c), rew=np.ones(c),
+                           done=done[i:i+c], next_obs=np.arange(i, i+c)+1)
+                    i += c
+                results.append(rb.get_all_transitions()["done"][:,0])
+
+            with self.subTest(size=size):
+                np.testing.assert_array_equal(results[1], results[0])
+                np.testing.assert_array_equal(results[2], results[0])
+
+    def test_random_chunks(self):
+        rng = np.random.default_rng(42)
+        for size in [2, 3, 7]:
+            single = ReplayBuffer(256, self.env_dict,
+                                  Nstep={**self.Nstep, "size": size})
+            batch = ReplayBuffer(256, self.env_dict,
+                                 Nstep={**self.Nstep, "size": size})
+            for _ in range(10):
+                T = int(rng.integers(1, 20))
+                chunks = []
+                while sum(chunks) < T:
+                    chunks.append(int(rng.integers(1, min(T - sum(chunks),
+                                                          2*size) + 1)))
+                done = int(rng.integers(0, 2))
+                self._episode(single, [1] * T, done)
+                self._episode(batch, chunks, done)
+
+            s = single.get_all_transitions()
+            b = batch.get_all_transitions()
+            for k in self.env_dict:
+                with self.subTest(size=size, key=k):
+                    np.testing.assert_allclose(b[k], s[k], rtol=1e-6)
+
+
+class TestSampleNstep(unittest.TestCase):
+    def _fill(self, rb):
+        # Episode with done (obs: 0-9), truncated episode (obs: 10-15), and
+        # running episode (obs: 16-19).
+        for begin, end, done in [(0, 10, 1), (10, 16, 0), (16, 20, None)]:
+            d = np.zeros(end - begin)
+            d[-1] = done or 0
+            rb.add(obs=np.arange(begin, end), rew=np.ones(end - begin),
+                   done=d, next_obs=np.arange(begin, end) + 1)
+            if done is not None:
+                rb.on_episode_end()
+
+    def test_nstep(self):
+        for next_of in [None, "obs"]:
+            env_dict = {"obs": {}, "rew": {}, "done": {}}
+            if next_of is None:
+                env_dict["next_obs"] = {}
+            rb = ReplayBuffer(32, env_dict, next_of=next_of)
+            self._fill(rb)
+
+            for size, gamma in [(3, 0.5), (5, 0.9)]:
+                with self.subTest(next_of=next_of, size=size):
+                    s = rb.sample_nstep(64, size, gamma=gamma,
+                                        rew="rew", next="next_obs")
+                    obs = s["obs"][:,0].astype(int)
+                    end = np.select([obs < 10, obs < 16], [10, 16], 20)
+                    n = np.minimum(size, end - obs)
+
+                    np.testing.assert_allclose(s["rew"][:,0],
+                                               (1 - gamma**n) / (1 - gamma),
+                                               rtol=1e-6)
+                    np.testing.assert_allclose(s["discounts"][:,0], gamma**n,
+                                               rtol=1e-6)
+                    np.testing.assert_array_equal(s["next_obs"][:,0], obs + n)
+                    np.testing.assert_array_equal(s["done"][:,0],
+                                                  (obs + n == 10))
+
+    def test_keys(self):
+        rb = PrioritizedReplayBuffer(32, {"obs": {}, "rew": {}, "done": {}},
+                                     next_of="obs")
+        self._fill(rb)
+
+        s = rb.sample_nstep(16, 3, rew="rew", next="next_obs",
+                            exclude=["obs", "done"])
+        self.assertEqual(set(s),
+                         {"rew", "next_obs", "discounts", "weights", "indexes"})
+        np.testing.assert_array_equal(s["next_obs"][:,0] - s["indexes"],
+                                      np.round(np.log(s["discounts"][:,0]) /
+                                               np.log(0.99)))
+
+
 if __name__ == '__main__':
     unittest.main()
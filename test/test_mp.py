@@ -1,13 +1,16 @@
+import asyncio
 from multiprocessing import Process, get_context
 from multiprocessing.context import ProcessError
 from multiprocessing.managers import SyncManager
 import unittest
 import sys
+import threading
 
 import numpy as np
 
 from cpprb import (MPReplayBuffer as ReplayBuffer,
                    MPPrioritizedReplayBuffer as PrioritizedReplayBuffer)
+from cpprb import ReplayBuffer as SingleReplayBuffer
 
 def add(rb):
     for _ in range(100):
@@ -21,6 +24,49 @@ def add_args(rb,args):
     for arg in args:
         rb.add(**arg)
 
+def learn(rb,batch_size,q):
+    q.put(rb.sample(batch_size)["indexes"])
+    for _ in range(20):
+        s = rb.sample(batch_size)
+        np.testing.assert_array_equal(s["obs"][:,0],s["obs"][:,-1])
+        rb.update_priorities(s["indexes"],np.abs(s["obs"][:,0])+1)
+
+def explore(rb,k,**kwargs):
+    for T in [5, 7, 2]:
+        obs = 100*k + 10*T + np.arange(T)
+        done = np.zeros(T)
+        done[-1] = (T != 7)
+        for t in range(T):
+            rb.add(obs=obs[t], rew=t+1, done=done[t], next_obs=obs[t]+1,
+                   **{key: v[t] for key, v in kwargs.items()})
+        rb.on_episode_end()
+
+async def explore_async(rb,k):
+    for T in [5, 7, 2]:
+        obs = 100*k + 10*T + np.arange(T)
+        done = np.zeros(T)
+        done[-1] = (T != 7)
+        for t in range(T):
+            await rb.add_async(obs=obs[t], rew=t+1, done=done[t],
+                               next_obs=obs[t]+1)
+            # Let other explorers add between steps
+            await asyncio.sleep(0)
+        rb.on_episode_end()
+
+def assert_explored(test,rb,n_explorers):
+    ref = SingleReplayBuffer(rb.get_buffer_size(), TestNstep.env_dict,
+                             Nstep=TestNstep.Nstep)
+    for k in range(n_explorers):
+        explore(ref, k)
+
+    s = rb.get_all_transitions()
+    r = ref.get_all_transitions()
+    s_order = np.argsort(s["obs"][:,0])
+    r_order = np.argsort(r["obs"][:,0])
+    for k in TestNstep.env_dict:
+        with test.subTest(key=k):
+            np.testing.assert_allclose(s[k][s_order], r[k][r_order])
+
 class TestReplayBuffer(unittest.TestCase):
     def test_buffer(self):
 
@@ -163,6 +209,71 @@ class TestReplayBuffer(unittest.TestCase):
         self.assertEqual(rb.get_next_index() ,200)
         self.assertEqual(rb.get_stored_size(),200)
 
+    def test_sample_during_add(self):
+        buffer_size = 1024
+        obs_shape = (32, 32)
+
+        rb = ReplayBuffer(buffer_size,{"obs": {"shape": obs_shape}})
+
+        # Explorers never wrap around, so that only in-flight slots can be torn.
+        ps = [Process(target=add_args,
+                      args=[rb,[{"obs": np.full((64,)+obs_shape, 8*k+i)}
+                                for i in range(8)]])
+              for k in range(2)]
+        for p in ps:
+            p.start()
+
+        while rb.get_stored_size() == 0:
+            pass
+
+        while any(p.is_alive() for p in ps):
+            obs = rb.sample(32)["obs"].reshape(32, -1)
+            np.testing.assert_array_equal(obs, np.broadcast_to(obs[:, :1],
+                                                               obs.shape))
+
+        for p in ps:
+            p.join()
+
+        self.assertEqual(rb.get_stored_size(), 2*8*64)
+        all_obs = rb.get_all_transitions()["obs"]
+        self.assertEqual(all_obs.shape, (2*8*64,)+obs_shape)
+
+    def test_concurrent_index(self):
+        buffer_size = 256
+        n_explorers = 8
+
+        for backend in (["sharedctypes", "SharedMemory"]
+                        if sys.version_info >= (3,8) else ["sharedctypes"]):
+            with self.subTest(backend=backend):
+                rb = ReplayBuffer(buffer_size,{"done": {}},backend=backend)
+
+                ps = [Process(target=add,args=[rb]) for _ in range(n_explorers)]
+                for p in ps:
+                    p.start()
+
+                for p in ps:
+                    p.join()
+
+                self.assertEqual(rb.get_next_index(),
+                                 (100 * n_explorers) % buffer_size)
+                self.assertEqual(rb.get_stored_size(),buffer_size)
+
+                rb.clear()
+                self.assertEqual(rb.get_next_index(),0)
+                self.assertEqual(rb.get_stored_size(),0)
+
+    def test_sample_timeout(self):
+        class Writing(ReplayBuffer):
+            # Every slot looks like being written.
+            def _encode_committed(self,idx,out=None,keys=None,exclude=None):
+                sample, ok = super()._encode_committed(idx,out,keys,exclude)
+                return sample, np.zeros_like(ok)
+
+        rb = Writing(16, {"done": {}})
+        rb.add(done=np.zeros(4))
+        with self.assertRaises(TimeoutError):
+            rb.sample(8, timeout=0.05)
+
     def test_context(self):
         buffer_size = 256
 
@@ -438,6 +549,44 @@ class TestPrioritizedReplayBuffer(unittest.TestCase):
         u, counts = np.unique(s["obs"],return_counts=True)
         self.assertEqual(u[counts.argmax()],one_hot)
 
+    def test_mp_wide_tree(self):
+        buffer_size = 256
+        add_size = 200
+        one_hot = 3
+
+        rb = PrioritizedReplayBuffer(buffer_size,{"obs": {"dtype": int}},
+                                     wide_tree=True)
+
+        p = Process(target=add_args,args=[rb,
+                                          [{"obs": i,
+                                            "priorities": 0 if i != one_hot else 1e+8}
+                                           for i in range(add_size)]])
+        p.start()
+        p.join()
+
+        self.assertEqual(rb.get_stored_size(),add_size)
+
+        s = rb.sample(100,beta=1.0)
+
+        self.assertTrue((s["obs"] >= 0).all())
+        self.assertTrue((s["obs"] < add_size).all())
+
+        u, counts = np.unique(s["obs"],return_counts=True)
+        self.assertEqual(u[counts.argmax()],one_hot)
+
+
+    def test_update_duplicated_indexes(self):
+        rb = PrioritizedReplayBuffer(8,{"done": {}},alpha=1.0,eps=0.0)
+        rb.add(done=np.zeros(8),priorities=np.ones(8))
+        rb.sample(8)
+
+        # The last priority wins for duplicated indexes.
+        rb.update_priorities([3,5,3,3],[100.0,2.0,1e+8,1e-8])
+
+        s = rb.sample(64,beta=1.0)
+        self.assertTrue((s["indexes"] != 3).all())
+        w = s["weights"][s["indexes"] == 5]
+        np.testing.assert_allclose(w,np.full_like(w,1e-8 / 2.0),rtol=1e-5)
 
     def test_mp_update_priority(self):
         buffer_size = 256
@@ -474,6 +623,49 @@ class TestPrioritizedReplayBuffer(unittest.TestCase):
         u, counts = np.unique(s["obs"],return_counts=True)
         self.assertEqual(u[counts.argmax()],one_hot)
 
+    def test_multi_learner(self):
+        buffer_size = 256
+        n_learners = 4
+
+        rb = PrioritizedReplayBuffer(buffer_size,{"obs": {"shape": 16}})
+        rb.add(obs=np.repeat(np.arange(buffer_size)[:,np.newaxis],16,axis=1))
+
+        q = get_context().Queue()
+        ps = [Process(target=add_args,
+                      args=[rb,[{"obs": np.full((4,16),i)} for i in range(50)]])
+              for _ in range(2)]
+        ps += [Process(target=learn,args=[rb,32,q]) for _ in range(n_learners)]
+        for p in ps:
+            p.start()
+
+        first = [q.get() for _ in range(n_learners)]
+
+        for p in ps:
+            p.join()
+            self.assertEqual(p.exitcode,0)
+
+        # Forked learners have their own random sequences.
+        self.assertGreater(len({i.tobytes() for i in first}),1)
+
+    def test_unsampled_mask_multi_learner(self):
+        rb = PrioritizedReplayBuffer(4, {"done": {}})
+        rb.add(done=np.zeros(4))
+        rb.sample(16)
+
+        # Index 0 is overwritten, then another learner samples.
+        p = Process(target=add_args,args=[rb,[{"done": 1.0}]])
+        p.start()
+        p.join()
+        p = Process(target=sample,args=[rb,16])
+        p.start()
+        p.join()
+
+        rb.update_priorities([0], [5.0])
+        self.assertEqual(rb.get_max_priority(), 1.0)
+
+        rb.update_priorities([1], [3.0])
+        self.assertEqual(rb.get_max_priority(), 3.0)
+
     def test_float_size(self):
         rb = PrioritizedReplayBuffer(1e+2, {"done": {}})
         self.assertEqual(rb.get_buffer_size(), 100)
@@ -522,6 +714,25 @@ class TestPrioritizedReplayBuffer(unittest.TestCase):
 
         m.shutdown()
 
+    def test_unsampled_mask_overwritten_after_sample(self):
+        rb = PrioritizedReplayBuffer(4, {"done": {}})
+        rb.add(done=np.zeros(4))
+        rb.sample(16)
+
+        # Index 0 is overwritten by another process after sample.
+        p = Process(target=add_args,args=[rb,[{"done": 1.0}]])
+        p.start()
+        p.join()
+
+        rb.update_priorities([0], [5.0])
+        self.assertEqual(rb.get_max_priority(), 1.0)
+
+        rb.update_priorities([1, 2], [3.0, 4.0])
+        self.assertEqual(rb.get_max_priority(), 4.0)
+
+        rb.update_priorities([], [])
+        self.assertEqual(rb.get_max_priority(), 4.0)
+
     @unittest.skipUnless(sys.version_info >= (3,8),
                          "SharedMemory is supported Python 3.8+")
     def test_unsampled_mask_SharedMemory(self):
@@ -561,5 +772,181 @@ class TestPrioritizedReplayBuffer(unittest.TestCase):
         with self.assertRaises(ProcessError):
             PrioritizedReplayBuffer(10, {"done": {}}, ctx=m)
 
+class TestNstep(unittest.TestCase):
+    env_dict = {"obs": {}, "rew": {}, "done": {}, "next_obs": {}}
+    Nstep = {"size": 3, "gamma": 0.5, "rew": "rew", "next": "next_obs"}
+
+    def test_replay_buffer(self):
+        rb = ReplayBuffer(64, self.env_dict, Nstep=self.Nstep)
+        self.assertTrue(rb.is_Nstep())
+
+        # Staged at this process until flush
+        self.assertIsNone(rb.add(obs=0, rew=1, done=0, next_obs=1))
+        self.assertIsNone(rb.add(obs=1, rew=1, done=0, next_obs=2))
+        self.assertEqual(rb.get_stored_size(), 0)
+        rb.clear()
+
+        ps = [Process(target=explore, args=[rb, k]) for k in range(2)]
+        for p in ps:
+            p.start()
+        for p in ps:
+            p.join()
+
+        assert_explored(self, rb, 2)
+
+    def test_threads(self):
+        rb = ReplayBuffer(64, self.env_dict, Nstep=self.Nstep)
+
+        # Each thread stages its own Nstep transitions.
+        ts = [threading.Thread(target=explore, args=[rb, k]) for k in range(2)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+
+        assert_explored(self, rb, 2)
+
+    def test_prioritized_replay_buffer(self):
+        rb = PrioritizedReplayBuffer(64, self.env_dict, Nstep=self.Nstep,
+                                     alpha=1.0)
+        p = Process(target=explore, args=[rb, 0],
+                    kwargs={"priorities": np.arange(10) + 0.5})
+        p.start()
+        p.join()
+        self.assertEqual(rb.get_stored_size(), 14)
+
+        # Priorities are carried with their transitions.
+        s = rb.sample(32, beta=1.0)
+        p = s["obs"][:,0] % 10 + 0.5
+        np.testing.assert_allclose(s["weights"] * p, 0.5, rtol=1e-3)
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+    env_dict = {"obs": {"shape": 3}, "done": {}}
+
+    async def test_replay_buffer(self):
+        rb = ReplayBuffer(32, self.env_dict)
+        self.assertEqual(await rb.add_async(obs=np.ones((4,3)), done=np.zeros(4)), 0)
+        self.assertEqual(await rb.add_async(obs=np.ones(3), done=1), 4)
+
+        s = await rb.sample_async(8, keys="obs")
+        self.assertEqual(set(s), {"obs"})
+        self.assertEqual(s["obs"].shape, (8, 3))
+
+        n = 0
+        async for batch in rb.batches(16):
+            self.assertEqual(batch["done"].shape, (16, 1))
+            n += 1
+            if n == 3:
+                break
+
+    async def test_prioritized_replay_buffer(self):
+        rb = PrioritizedReplayBuffer(32, self.env_dict)
+        await rb.add_async(obs=np.arange(48).reshape(16,3), done=np.zeros(16),
+                           priorities=np.full(16, 0.5))
+        self.assertEqual(rb.get_stored_size(), 16)
+
+        s = await rb.sample_async(8)
+        self.assertEqual(s["weights"].shape, (8,))
+        np.testing.assert_array_equal(s["obs"][:,0], 3*s["indexes"])
+
+        await rb.update_priorities_async(s["indexes"], np.full(8, 2.0))
+        self.assertEqual(rb.get_max_priority(), 2.0)
+
+        async for batch in rb.batches(4, beta=1.0):
+            self.assertEqual(batch["indexes"].shape, (4,))
+            break
+
+    async def test_concurrent(self):
+        rb = PrioritizedReplayBuffer(64, self.env_dict)
+        await rb.add_async(obs=np.zeros((4,3)), done=np.zeros(4))
+
+        async def explorer():
+            for i in range(20):
+                await rb.add_async(obs=np.full((4,3), i), done=np.zeros(4))
+
+        async def learner():
+            for _ in range(20):
+                s = await rb.sample_async(16)
+                np.testing.assert_array_equal(s["obs"][:,0], s["obs"][:,-1])
+                await rb.update_priorities_async(s["indexes"], np.random.rand(16))
+
+        await asyncio.gather(explorer(), explorer(), learner(), learner())
+        self.assertEqual(rb.get_stored_size(), 64)
+
+    async def test_nstep(self):
+        rb = PrioritizedReplayBuffer(32, self.env_dict, Nstep={"size": 2})
+        self.assertIsNone(await rb.add_async(obs=np.ones(3), done=0))
+        self.assertEqual(await rb.add_async(obs=np.ones((2,3)), done=np.zeros(2)), 0)
+        rb.on_episode_end()
+        self.assertEqual(rb.get_stored_size(), 3)
+
+    async def test_nstep_explorers(self):
+        rb = ReplayBuffer(64, TestNstep.env_dict, Nstep=TestNstep.Nstep)
+
+        # Each task stages its own Nstep transitions.
+        await asyncio.gather(explore_async(rb, 0), explore_async(rb, 1))
+        self.assertEqual(rb.get_stored_size(), 28)
+        assert_explored(self, rb, 2)
+
+    async def test_cancel(self):
+        rb = PrioritizedReplayBuffer(64, self.env_dict)
+        rb.add(obs=np.zeros((64,3)), done=np.zeros(64))
+
+        tasks = [asyncio.create_task(rb.sample_async(8)) for _ in range(8)]
+        tasks += [asyncio.create_task(rb.add_async(obs=np.ones(3), done=0))
+                  for _ in range(8)]
+        await asyncio.sleep(0)
+        for t in tasks[::2]:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Locks are not leaked.
+        rb.add(obs=np.ones(3), done=0)
+        rb.update_priorities(rb.sample(8)["indexes"], np.ones(8))
+
+    async def _cancel_reserved(self, inner):
+        resume = threading.Event()
+
+        class BlockingReplayBuffer(PrioritizedReplayBuffer):
+            def _encode_locked(self, *args):
+                resume.wait()
+                return super()._encode_locked(*args)
+
+        rb = BlockingReplayBuffer(32, self.env_dict)
+        rb.add(obs=np.full((4,3), 2), done=np.zeros(4))
+
+        # Sampler holds the data lock, so that explorer waits for it.
+        sample = asyncio.create_task(rb.sample_async(8))
+        await asyncio.sleep(0.05)
+        add = asyncio.create_task(rb.add_async(obs=np.full(3, 7), done=1))
+        await asyncio.sleep(0.05)
+        if inner:
+            # Task storing reserved slots (e.g. cancelled at loop shutdown)
+            others = {asyncio.current_task(), sample, add}
+            store, = [t for t in asyncio.all_tasks() if t not in others]
+            store.cancel()
+        else:
+            add.cancel()
+        await asyncio.sleep(0.05)
+        resume.set()
+
+        await sample
+        with self.assertRaises(asyncio.CancelledError):
+            await add
+
+        # Reserved slot is written before it is committed.
+        self.assertEqual(rb.get_stored_size(), 5)
+        s = rb.sample(64)
+        np.testing.assert_array_equal(s["obs"][:,0],
+                                      np.where(s["indexes"] == 4, 7, 2))
+        self.assertIn(4, s["indexes"])
+
+    async def test_cancel_reserved(self):
+        await self._cancel_reserved(False)
+
+    async def test_cancel_reserved_store(self):
+        await self._cancel_reserved(True)
+
+
 if __name__ == '__main__':
     unittest.main()
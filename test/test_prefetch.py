@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from cpprb import (PrefetchSampler, PrioritizedReplayBuffer, ReplayBuffer,
+                   ThreadSafeReplayBuffer)
+
+
+class TestPrefetchSampler(unittest.TestCase):
+    env_dict = {"obs": {"shape": 3}, "act": {}}
+
+    def _fill(self, rb):
+        rb.add(obs=np.arange(64*3).reshape(64,3), act=np.arange(64))
+
+    def test_init(self):
+        rb = ReplayBuffer(64, self.env_dict)
+        self._fill(rb)
+
+        with self.assertRaises(ValueError):
+            PrefetchSampler(rb, 0)
+
+        with self.assertRaises(ValueError):
+            PrefetchSampler(rb, 16, prefetch=0)
+
+        with self.assertRaises(ValueError):
+            PrefetchSampler(rb, 16, max_staleness=-1)
+
+    def test_iterate(self):
+        rb = ReplayBuffer(64, self.env_dict)
+        self._fill(rb)
+
+        with PrefetchSampler(rb, 16, prefetch=3) as sampler:
+            ids = set()
+            for _, s in zip(range(20), sampler):
+                self.assertEqual(s["obs"].shape, (16, 3))
+                np.testing.assert_array_equal(s["obs"][:,0], 3*s["act"][:,0])
+                ids.add(id(s["obs"]))
+
+        # Output arrays are reused.
+        self.assertEqual(len(ids), 4)
+        self.assertFalse(sampler.thread.is_alive())
+
+        with self.assertRaises(StopIteration):
+            next(sampler)
+
+    def test_kwargs(self):
+        rb = ReplayBuffer(64, self.env_dict)
+        self._fill(rb)
+
+        with PrefetchSampler(rb, 16, keys="act") as sampler:
+            self.assertEqual(set(next(sampler)), {"act"})
+
+    def test_staleness(self):
+        rb = PrioritizedReplayBuffer(64, self.env_dict)
+        self._fill(rb)
+
+        with PrefetchSampler(rb, 16, max_staleness=0, beta=0.5) as sampler:
+            for i, s in zip(range(20), sampler):
+                self.assertEqual(s["weights"].shape, (16,))
+                np.testing.assert_array_equal(s["act"][:,0], s["indexes"])
+                sampler.update_priorities(s["indexes"], np.full(16, 1e-8))
+
+            self.assertEqual(sampler.updates, 20)
+
+        # Batches prefetched before the update are dropped.
+        with PrefetchSampler(rb, 16, prefetch=4, max_staleness=0) as sampler:
+            p = np.full(64, 1e-8)
+            p[5] = 1e+8
+            sampler.update_priorities(np.arange(64), p)
+            for _, s in zip(range(5), sampler):
+                np.testing.assert_array_equal(s["indexes"], 5)
+
+    def test_concurrent_add(self):
+        rb = ThreadSafeReplayBuffer(64, self.env_dict)
+        self._fill(rb)
+
+        with PrefetchSampler(rb, 16) as sampler:
+            for i, s in zip(range(100), sampler):
+                rb.add(obs=[3*i, 3*i+1, 3*i+2], act=i)
+                np.testing.assert_array_equal(s["obs"][:,0], 3*s["act"][:,0])
+
+    def test_close_from_other_thread(self):
+        resume = threading.Event()
+
+        class BlockingReplayBuffer(ReplayBuffer):
+            def sample(self, *args, **kwargs):
+                s = super().sample(*args, **kwargs)
+                resume.wait()
+                return s
+
+        rb = BlockingReplayBuffer(64, self.env_dict)
+        self._fill(rb)
+        resume.set()
+        sampler = PrefetchSampler(rb, 16, prefetch=1)
+        resume.clear()
+
+        with ThreadPoolExecutor(2) as e:
+            # The 2nd batch is not ready until resume, so the consumer blocks.
+            consumer = e.submit(lambda: len([s for s in sampler]))
+            time.sleep(0.1)
+            closer = e.submit(sampler.close)
+
+            try:
+                self.assertEqual(consumer.result(timeout=5), 1)
+            finally:
+                resume.set()
+            closer.result()
+
+        self.assertFalse(sampler.thread.is_alive())
+
+    def test_error(self):
+        rb = ReplayBuffer(64, self.env_dict)
+        self._fill(rb)
+
+        sampler = PrefetchSampler(rb, 16, prefetch=1)
+        rb.clear()
+        with self.assertRaises(Exception):
+            for _ in range(3):
+                next(sampler)
+        self.assertFalse(sampler.thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
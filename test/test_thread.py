@@ -0,0 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import unittest
+
+import numpy as np
+
+from cpprb import ThreadSafeReplayBuffer, ThreadSafePrioritizedReplayBuffer
+
+
+def add(rb, k, **kwargs):
+    for i in range(100):
+        v = 100*k + i
+        rb.add(obs=np.full((4,16), v), next_obs=np.full((4,16), v+1), **kwargs)
+
+
+def blocking(cls):
+    class Blocking(cls):
+        # Block in the first copy of sampled rows, which runs without lock.
+        def __init__(self,*args,**kwargs):
+            self.copied = threading.Event()
+            self.resume = threading.Event()
+
+        def _gather_rows(self,idx,out,names,next_of):
+            rows = super()._gather_rows(idx,out,names,next_of)
+            if not self.copied.is_set():
+                self.copied.set()
+                self.resume.wait()
+            return rows
+
+    return Blocking
+
+
+def add_during_sample(test,rb,**kwargs):
+    obs = np.repeat(np.arange(4.0).reshape(4,1), 16, axis=1)
+    rb.add(obs=obs, next_obs=obs+1)
+
+    with ThreadPoolExecutor(1) as e:
+        f = e.submit(rb.sample,8,**kwargs)
+        test.assertTrue(rb.copied.wait(timeout=10))
+
+        # add makes progress while sample is in flight, and overwrites all
+        # the sampled slots.
+        rb.add(obs=obs+10, next_obs=obs+11)
+        test.assertFalse(f.done())
+
+        rb.resume.set()
+        s = f.result()
+
+    test.assertTrue((s["obs"] >= 10).all())
+    np.testing.assert_array_equal(s["obs"][:,1:], s["obs"][:,:-1])
+    np.testing.assert_array_equal(s["next_obs"], s["obs"] + 1)
+    return s
+
+
+class TestThreadSafeReplayBuffer(unittest.TestCase):
+    def test_add_sample(self):
+        rb = ThreadSafeReplayBuffer(256,{"obs": {"shape": 16},
+                                         "next_obs": {"shape": 16}})
+        rb.add(obs=np.zeros((1,16)), next_obs=np.ones((1,16)))
+
+        def sample(k):
+            for _ in range(200):
+                s = rb.sample(32)
+                np.testing.assert_array_equal(s["obs"][:,:1] + 1,
+                                              s["next_obs"][:,-1:])
+
+        with ThreadPoolExecutor(8) as e:
+            fs = ([e.submit(add,rb,k) for k in range(4)] +
+                  [e.submit(sample,k) for k in range(4)])
+            for f in fs:
+                f.result()
+
+        self.assertEqual(rb.get_stored_size(),256)
+        self.assertEqual(rb.get_next_index(),(1 + 4*100*4) % 256)
+
+    def test_add_during_sample(self):
+        rb = blocking(ThreadSafeReplayBuffer)(4,{"obs": {"shape": 16},
+                                                 "next_obs": {"shape": 16}})
+        add_during_sample(self,rb)
+
+    def test_add_during_sample_next_of(self):
+        rb = blocking(ThreadSafeReplayBuffer)(4,{"obs": {"shape": 16}},
+                                              next_of="obs",gather_threads=2)
+        add_during_sample(self,rb)
+
+    def test_reserve_wait(self):
+        rb = ThreadSafeReplayBuffer(8,{"done": {}})
+        for seg in rb.reserve(2):
+            seg["done"][:] = 1
+
+        with ThreadPoolExecutor(2) as e:
+            fs = [e.submit(rb.add,done=2), e.submit(rb.reserve,1)]
+            done, _ = wait(fs,timeout=0.1)
+            self.assertEqual(len(done),0)
+
+            rb.commit()
+            fs[1].result()
+            rb.commit()
+            fs[0].result()
+
+        self.assertEqual(rb.get_stored_size(),4)
+        np.testing.assert_array_equal(rb.get_all_transitions()["done"][:2,0],
+                                      [1,1])
+
+    def test_reserve_sample(self):
+        for n, reserved in [(8, [0,1,2]), (6, [6,7,0,1])]:
+            with self.subTest(n=n):
+                rb = ThreadSafeReplayBuffer(8,{"done": {}})
+                rb.add(done=np.arange(n))
+                for seg in rb.reserve(len(reserved)):
+                    seg["done"][:] = -1
+
+                s = rb.sample(256)
+                self.assertTrue((s["done"] >= 0).all())
+                self.assertEqual(set(np.unique(s["done"])),
+                                 set(range(n)) - set(reserved))
+
+
+class TestThreadSafePrioritizedReplayBuffer(unittest.TestCase):
+    def test_add_sample_update(self):
+        rb = ThreadSafePrioritizedReplayBuffer(256,{"obs": {"shape": 16},
+                                                    "next_obs": {"shape": 16}},
+                                               check_for_update=True)
+        rb.add(obs=np.zeros((1,16)), next_obs=np.ones((1,16)))
+
+        def learn(k):
+            for _ in range(200):
+                s = rb.sample(32)
+                np.testing.assert_array_equal(s["obs"][:,:1] + 1,
+                                              s["next_obs"][:,-1:])
+                self.assertEqual(s["weights"].shape,(32,))
+                self.assertTrue((s["indexes"] < rb.get_stored_size()).all())
+                rb.update_priorities(s["indexes"],np.random.rand(32) + 0.5)
+
+        with ThreadPoolExecutor(8) as e:
+            fs = ([e.submit(add,rb,k,priorities=np.full(4,0.5)) for k in range(4)]+
+                  [e.submit(learn,k) for k in range(4)])
+            for f in fs:
+                f.result()
+
+        self.assertEqual(rb.get_stored_size(),256)
+        self.assertLessEqual(rb.get_max_priority(),1.5)
+
+    def test_add_during_sample(self):
+        rb = blocking(ThreadSafePrioritizedReplayBuffer)(4,{"obs": {"shape": 16},
+                                                            "next_obs": {"shape": 16}})
+        s = add_during_sample(self,rb,beta=1.0)
+        self.assertEqual(s["weights"].shape,(8,))
+
+    def test_reserve_sample(self):
+        for n, reserved in [(8, [0,1,2]), (6, [6,7,0,1])]:
+            with self.subTest(n=n):
+                rb = ThreadSafePrioritizedReplayBuffer(8,{"done": {}})
+                rb.add(done=np.arange(n))
+                for seg in rb.reserve(len(reserved)):
+                    seg["done"][:] = -1
+
+                s = rb.sample(256)
+                self.assertTrue((s["done"] >= 0).all())
+                np.testing.assert_array_equal(s["done"][:,0], s["indexes"])
+                self.assertEqual(set(np.unique(s["indexes"])),
+                                 set(range(n)) - set(reserved))
+
+                rb.commit(priorities=np.full(len(reserved),1e+6))
+                self.assertTrue((rb.sample(256)["done"] < 0).any())
+
+    def test_independent_results(self):
+        rb = ThreadSafePrioritizedReplayBuffer(32,{"done": {}})
+        rb.add(done=np.zeros(32))
+
+        s1 = rb.sample(16)
+        i1 = s1["indexes"].copy()
+        rb.sample(16)
+        np.testing.assert_array_equal(s1["indexes"],i1)
+
+
+if __name__ == '__main__':
+    unittest.main()